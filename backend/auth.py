@@ -1,10 +1,17 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from database import verify_password, get_db
+from passlib.hash import bcrypt
+from database import get_db, run_db
 from models import TokenData, User
+import functools
+import threading
+import asyncio
+import time
 import os
 
 # Configurazione sicurezza
@@ -13,22 +20,112 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # 1 ora
 REFRESH_TOKEN_EXPIRE_DAYS = 7
 
+# Non c'è un ruolo nel DB: gli amministratori sono gli username elencati qui
+ADMIN_USERS = {name.strip() for name in os.getenv('ADMIN_USERS', 'admin').split(',') if name.strip()}
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def authenticate_user(username: str, password: str) -> Optional[User]:
+# Cache degli utenti per get_current_user, per username, limitata per
+# durata e numero di voci. Chi modifica o elimina un utente deve chiamare
+# user_cache.invalidate(username); il TTL limita comunque quanto a lungo
+# un dato vecchio può sopravvivere
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '60'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+
+class UserCache:
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user: User):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user.username] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user.username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+user_cache = UserCache()
+
+# bcrypt è lento di proposito (centinaia di ms): gira su thread suoi, mai
+# sull'event loop e senza occupare i thread del DB
+PASSWORD_THREADS = int(os.getenv('PASSWORD_THREADS', '2'))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_THREADS, thread_name_prefix='bcrypt')
+
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, bcrypt.hash, password)
+
+@functools.lru_cache(maxsize=1)
+def _dummy_hash() -> str:
+    return bcrypt.hash(os.urandom(16).hex())
+
+def _verify(password: str, password_hash: Optional[str]) -> bool:
+    if password_hash is None:
+        # Utente inesistente: stesso costo di una verifica vera, così i
+        # tempi di risposta non rivelano quali username esistono
+        bcrypt.verify(password, _dummy_hash())
+        return False
+    return bcrypt.verify(password, password_hash)
+
+async def check_password(password: str, password_hash: Optional[str]) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, _verify, password, password_hash)
+
+def warm_up_password_check():
+    # Calcola l'hash fittizio all'avvio, in background
+    asyncio.get_running_loop().run_in_executor(password_executor, _dummy_hash)
+
+async def authenticate_user(username: str, password: str) -> Optional[User]:
+    # Una sola lettura dal DB: la riga contiene già l'hash della password
     try:
-        if verify_password(username, password):
-            with get_db() as db:
-                user_data = db.execute(
-                    "SELECT * FROM users WHERE username = ?",
-                    (username,)
-                ).fetchone()
-                if user_data:
-                    return User(**user_data)
+        user_data = await run_db(load_user, username)
+        password_hash = user_data['password_hash'] if user_data else None
+        if not await check_password(password, password_hash):
+            return None
+        user = User(**user_data)
+        user_cache.put(user)
+        return user
     except Exception as e:
         print(f"Authentication error: {str(e)}")
     return None
 
+def load_user(username: str) -> Optional[dict]:
+    with get_db() as db:
+        return db.execute(
+            "SELECT * FROM users WHERE username = ?",
+            (username,)
+        ).fetchone()
+
 def create_token(data: dict, expires_delta: Optional[timedelta] = None, is_refresh: bool = False):
     to_encode = data.copy()
     if expires_delta:
@@ -73,17 +170,20 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     except JWTError:
         raise credentials_exception
 
+    user = user_cache.get(token_data.username)
+    if user is not None:
+        return user
+
     try:
-        with get_db() as db:
-            user_data = db.execute(
-                "SELECT * FROM users WHERE username = ?",
-                (token_data.username,)
-            ).fetchone()
+        user_data = await run_db(load_user, token_data.username)
+        if user_data is None:
+            raise credentials_exception
             
-            if user_data is None:
-                raise credentials_exception
-                
-            return User(**user_data)
+        user = User(**user_data)
+        user_cache.put(user)
+        return user
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Database error in get_current_user: {str(e)}")
         raise credentials_exception
@@ -91,6 +191,17 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
 async def get_current_user_id(current_user: User = Depends(get_current_user)) -> int:
     return current_user.id
 
+def is_admin(user: User) -> bool:
+    return user.username in ADMIN_USERS
+
+async def get_current_admin(current_user: User = Depends(get_current_user)) -> User:
+    if not is_admin(current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required"
+        )
+    return current_user
+
 def verify_refresh_token(token: str) -> Optional[str]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
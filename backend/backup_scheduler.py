@@ -0,0 +1,147 @@
+from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import asyncio
+import time
+import os
+
+from database import create_backup, list_backups
+import metrics
+
+# Backup in background: chi modifica i dati chiama request(), le richieste
+# ravvicinate vengono unite e al massimo un backup parte ogni
+# BACKUP_MIN_INTERVAL secondi. La copia gira su un thread suo, fuori dal
+# pool del DB e dall'event loop. Alla chiusura un backup in sospeso
+# viene eseguito subito
+BACKUP_ENABLED = os.getenv('BACKUP_ENABLED', '1') == '1'
+BACKUP_MIN_INTERVAL = int(os.getenv('BACKUP_MIN_INTERVAL', str(15 * 60)))
+BACKUP_COMPRESS = os.getenv('BACKUP_COMPRESS', '0') == '1'
+BACKUP_VERIFY = os.getenv('BACKUP_VERIFY', '1') == '1'
+BACKUP_RETRY_DELAY = 60
+
+def _datetime(value: Optional[float]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+class BackupScheduler:
+    def __init__(self, min_interval: int = BACKUP_MIN_INTERVAL,
+                 compress: bool = BACKUP_COMPRESS, verify: bool = BACKUP_VERIFY):
+        self.min_interval = min_interval
+        self.compress = compress
+        self.verify = verify
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+        self._run_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending = False
+        self._running = False
+        self.requested = 0
+        self.completed = 0
+        self.failures = 0
+        self.last_started: Optional[float] = None
+        self.last_finished: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_error: Optional[str] = None
+        # Dati dell'ultimo backup, letti sul thread del backup: /health
+        # non deve scorrere la cartella dei backup a ogni richiesta
+        self.last_file: Optional[str] = None
+        self.last_size: Optional[int] = None
+        self.last_backup_at: Optional[float] = None
+        self.backups: Optional[int] = None
+
+    # Ciclo di vita
+    def start(self):
+        if self._run_task is None:
+            self._wakeup = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+            self._run_task = asyncio.create_task(self._run())
+
+    async def stop(self, flush: bool = True):
+        task, self._run_task = self._run_task, None
+        self._loop = None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if flush and self._pending:
+            await self._backup()
+
+    def request(self):
+        # Può arrivare anche dai thread del DB
+        self._pending = True
+        self.requested += 1
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    # Stato
+    def stats(self) -> Dict:
+        return {
+            "pending": self._pending,
+            "running": self._running,
+            "requested": self.requested,
+            "completed": self.completed,
+            "failures": self.failures,
+            "last_started": _datetime(self.last_started),
+            "last_finished": _datetime(self.last_finished),
+            "last_duration": self.last_duration,
+            "last_error": self.last_error,
+            "last_file": self.last_file,
+            "last_size": self.last_size,
+            "last_backup_at": _datetime(self.last_backup_at),
+            "backups": self.backups,
+        }
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if self._pending:
+                ready_at = (self.last_started or 0) + self.min_interval
+                if self.failures:
+                    ready_at = (self.last_finished or 0) + BACKUP_RETRY_DELAY
+                delay = ready_at - time.time()
+                if delay <= 0:
+                    await self._backup()
+                    continue
+                await asyncio.sleep(delay)
+                continue
+            await self._wakeup.wait()
+
+    async def _backup(self):
+        # Le richieste arrivate durante la copia ne preparano un'altra
+        self._pending = False
+        self._running = True
+        self.last_started = time.time()
+        start = time.perf_counter()
+        outcome = 'cancelled'
+        try:
+            path, info, backups = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._create_backup
+            )
+        except asyncio.CancelledError:
+            self._pending = True
+            raise
+        except Exception as e:
+            self._pending = True
+            outcome = 'failure'
+            self.failures += 1
+            self.last_error = str(e)
+            print(f"Backup failed: {e}")
+        else:
+            outcome = 'success'
+            self.completed += 1
+            self.failures = 0
+            self.last_error = None
+            self.last_file = path.name
+            self.last_size = info.st_size
+            self.last_backup_at = info.st_mtime
+            self.backups = backups
+        finally:
+            self._running = False
+            self.last_duration = time.perf_counter() - start
+            metrics.BACKUP_DURATION.labels(outcome).observe(self.last_duration)
+            self.last_finished = time.time()
+
+    def _create_backup(self):
+        path = create_backup(self.compress, self.verify)
+        return path, path.stat(), len(list_backups())
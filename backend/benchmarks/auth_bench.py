@@ -0,0 +1,107 @@
+# Percorso di autenticazione: richieste autenticate al secondo (GET
+# /users/me attraverso tutta l'app ASGI) senza e con la cache degli
+# utenti, e blocco dell'event loop durante i login con bcrypt eseguito nel
+# loop (come prima) e nell'executor delle password.
+#
+#   cd backend && python -m benchmarks.auth_bench [richieste] [concorrenza]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+from passlib.hash import bcrypt
+
+import auth
+import main as server
+from database import get_db, init_db
+
+LOGINS = 8
+
+def legacy_authenticate(username, password):
+   # Login precedente: due connessioni e bcrypt sul thread chiamante
+   with get_db() as db:
+       row = db.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+       if not row or not bcrypt.verify(password, row['password_hash']):
+           return None
+   with get_db() as db:
+       return db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+
+async def authenticated_requests(client, token, total, concurrency):
+   headers = {'Authorization': f'Bearer {token}'}
+   remaining = [total]
+
+   async def worker():
+       while remaining[0] > 0:
+           remaining[0] -= 1
+           response = await client.get('/users/me', headers=headers)
+           assert response.status_code == 200, response.text
+
+   start = time.perf_counter()
+   await asyncio.gather(*(worker() for _ in range(concurrency)))
+   return total / (time.perf_counter() - start)
+
+async def loop_stall(logins):
+   # Ticker ogni millisecondo: il ritardo massimo è il blocco più lungo
+   worst = 0.0
+   done = asyncio.Event()
+
+   async def ticker():
+       nonlocal worst
+       last = time.perf_counter()
+       while not done.is_set():
+           await asyncio.sleep(0.001)
+           now = time.perf_counter()
+           worst = max(worst, now - last - 0.001)
+           last = now
+
+   task = asyncio.create_task(ticker())
+   await asyncio.sleep(0.01)
+   start = time.perf_counter()
+   await logins()
+   elapsed = time.perf_counter() - start
+   done.set()
+   await task
+   return elapsed, worst
+
+async def main():
+   total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+   concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   token = auth.create_access_token({'sub': 'admin'})
+
+   transport = httpx.ASGITransport(app=server.app)
+   async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+       await authenticated_requests(client, token, 200, concurrency)
+       ttl = auth.user_cache.ttl
+       for label, cache_ttl in (('senza cache', 0), ('con cache', ttl)):
+           auth.user_cache.ttl = cache_ttl
+           auth.user_cache.clear()
+           rate = await authenticated_requests(client, token, total, concurrency)
+           print(f'{label:<14} {rate:8.0f} richieste/s')
+       auth.user_cache.ttl = ttl
+       print(f'cache utenti: {auth.user_cache.stats()}')
+
+   async def inline_logins():
+       # Richieste separate: tra un login e l'altro il loop respira
+       for _ in range(LOGINS):
+           assert legacy_authenticate('admin', 'admin')
+           await asyncio.sleep(0)
+
+   async def executor_logins():
+       results = await asyncio.gather(*(auth.authenticate_user('admin', 'admin') for _ in range(LOGINS)))
+       assert all(results)
+
+   for label, logins in (('login nel loop', inline_logins), ('login executor', executor_logins)):
+       elapsed, worst = await loop_stall(logins)
+       print(f'{label:<14} {LOGINS} login in {elapsed * 1000:7.0f} ms   blocco massimo del loop {worst * 1000:7.1f} ms')
+
+   for label, username in (('utente esistente', 'admin'), ('utente inesistente', 'nessuno')):
+       start = time.perf_counter()
+       await auth.authenticate_user(username, 'sbagliata')
+       print(f'{label:<18} password errata in {(time.perf_counter() - start) * 1000:.0f} ms')
+
+if __name__ == '__main__':
+   asyncio.run(main())
@@ -0,0 +1,110 @@
+# Canali aggiungibili a una playlist custom: vecchia query (NOT IN su tutti
+# i canali dell'utente + ordinamento completo) contro le pagine keyset di
+# fetch_available_page. I piani di esecuzione e la paginazione sono
+# verificati in tests/test_channel_query.py, sugli stessi dati.
+#
+#   cd backend && python -m benchmarks.available_channels_bench [canali]
+import os
+import sys
+import tempfile
+import time
+
+from database import (
+   get_db, init_db, rebuild_indexes, suspend_search_indexing, index_channels_for_search
+)
+from channel_query import (
+   fetch_available_page, encode_cursor
+)
+from benchmarks.search_bench import channel_names
+
+SOURCES = 4
+PAGE_SIZE = 100
+REPEAT = 10
+
+OLD_QUERY = """
+   SELECT c.*, p.name as source_playlist_name
+   FROM channels c
+   JOIN playlists p ON c.playlist_id = p.id
+   WHERE p.user_id = ? AND c.id NOT IN (
+       SELECT channel_id
+       FROM custom_playlist_channels
+       WHERE playlist_id = ?
+   )
+   ORDER BY p.name, c.position, c.name
+"""
+
+FILTERS = (
+   ('tutti', {}),
+   ('sorgente', {'source_playlist_id': 2}),
+   ('gruppo', {'group_title': 'Gruppo Sport 7'}),
+   ('ricerca', {'search': 'rai'}),
+   ('ricerca ampia', {'search': 'ra'}),
+   ('ricerca rara', {'search': 'kinotu'}),
+)
+
+def timed(func):
+   start = time.perf_counter()
+   for _ in range(REPEAT):
+       result = func()
+   return (time.perf_counter() - start) / REPEAT * 1000, result
+
+def load(count):
+   os.chdir(tempfile.mkdtemp())
+   return populate(count)
+
+def populate(count):
+   # Database corrente: SOURCES playlist sorgente e una playlist custom
+   init_db()
+   with get_db() as db:
+       cursor = db.cursor()
+       triggers = suspend_search_indexing(cursor)
+       names = channel_names(count)
+       per_source = count // SOURCES
+       for source in range(SOURCES):
+           cursor.execute(
+               "INSERT INTO playlists (user_id, name) VALUES (1, ?)",
+               (f'Sorgente {SOURCES - source}',)
+           )
+           playlist_id = cursor.lastrowid
+           cursor.executemany(
+               """INSERT INTO channels (playlist_id, name, url, group_title, tvg_id, position)
+                  VALUES (?, ?, ?, ?, ?, ?)""",
+               (
+                   (playlist_id, name, f'http://stream/{source}/{i}', group, tvg_id, (i + 1) * 1024)
+                   for i, (name, group, tvg_id) in zip(range(per_source), names)
+               )
+           )
+       index_channels_for_search(cursor, "1")
+       rebuild_indexes(cursor, triggers)
+
+       cursor.execute("INSERT INTO playlists (user_id, name, is_custom) VALUES (1, 'Custom', 1)")
+       custom_id = cursor.lastrowid
+       # Un canale su dieci è già nella playlist custom
+       cursor.execute(
+           """INSERT INTO custom_playlist_channels (playlist_id, channel_id, position)
+              SELECT ?, id, id FROM channels WHERE id % 10 = 0""",
+           (custom_id,)
+       )
+   return custom_id
+
+def main():
+   count = int(sys.argv[1]) if len(sys.argv) > 1 else 400_000
+   custom_id = load(count)
+
+   with get_db() as db:
+       cursor = db.cursor()
+       ms, rows = timed(lambda: cursor.execute(OLD_QUERY, (1, custom_id)).fetchall())
+       print(f'{"vecchia query":<14} {ms:9.2f} ms   {len(rows):>9,} righe')
+
+       middle = rows[len(rows) // 2]
+       deep = encode_cursor(
+           middle['source_playlist_name'], middle['playlist_id'], middle['position'], middle['id']
+       )
+       print(f'{"filtro":<14} {"prima pagina":>15} {"pagina a metà":>15}')
+       for label, filters in FILTERS:
+           first, _ = timed(lambda: fetch_available_page(cursor, 1, custom_id, PAGE_SIZE, **filters))
+           later, _ = timed(lambda: fetch_available_page(cursor, 1, custom_id, PAGE_SIZE, deep, **filters))
+           print(f'{label:<14} {first:12.2f} ms {later:12.2f} ms')
+
+if __name__ == '__main__':
+   main()
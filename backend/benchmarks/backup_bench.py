@@ -0,0 +1,131 @@
+# Backup del database: vecchia copia del file (shutil.copy2) contro
+# create_backup (API di backup di SQLite, a blocchi, con verifica).
+# Controlla che la copia contenga anche le scritture ancora nel WAL,
+# quante scritture riescono ad altre connessioni durante il backup e
+# che BackupScheduler unisca le richieste ravvicinate.
+#
+#   cd backend && python -m benchmarks.backup_bench [canali]
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import database
+from database import get_db, init_db, create_backup, list_backups
+from backup_scheduler import BackupScheduler
+
+def load(count):
+   with get_db() as db:
+       cursor = db.cursor()
+       cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'bench')")
+       playlist_id = cursor.lastrowid
+       cursor.executemany(
+           """INSERT INTO channels (playlist_id, name, url, group_title, position)
+              VALUES (?, ?, ?, ?, ?)""",
+           ((playlist_id, f'Canale {i}', f'http://stream/{i}', f'Gruppo {i % 40}', i) for i in range(count))
+       )
+   return playlist_id
+
+def channel_count(path):
+   conn = sqlite3.connect(path)
+   try:
+       return conn.execute("SELECT COUNT(*) FROM channels").fetchone()[0]
+   finally:
+       conn.close()
+
+def with_writer(func):
+   # Un'altra connessione continua a scrivere mentre func lavora
+   stop = threading.Event()
+   writes = [0]
+
+   def writer():
+       conn = sqlite3.connect(database.DATABASE_PATH, timeout=10, isolation_level=None)
+       while not stop.is_set():
+           conn.execute("UPDATE playlists SET last_sync = CURRENT_TIMESTAMP WHERE id = 1")
+           writes[0] += 1
+       conn.close()
+
+   thread = threading.Thread(target=writer)
+   thread.start()
+   start = time.perf_counter()
+   try:
+       result = func()
+   finally:
+       elapsed = time.perf_counter() - start
+       stop.set()
+       thread.join()
+   return result, elapsed, writes[0]
+
+def old_backup():
+   database.BACKUP_PATH.mkdir(parents=True, exist_ok=True)
+   target = database.BACKUP_PATH / 'copy2.db'
+   shutil.copy2(database.DATABASE_PATH, target)
+   return target
+
+async def coalescing():
+   scheduler = BackupScheduler(min_interval=3600)
+   scheduler.start()
+   for _ in range(50):
+       scheduler.request()
+       await asyncio.sleep(0)
+   while scheduler.completed < 1:
+       await asyncio.sleep(0.05)
+   for _ in range(50):
+       scheduler.request()
+   await asyncio.sleep(0.5)
+   stats = scheduler.stats()
+   await scheduler.stop(flush=True)
+   return stats['requested'], stats['completed'], scheduler.completed
+
+def main():
+   count = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   load(count)
+   database.db_pool.close_all()
+
+   # Righe appena scritte e non ancora passate dal WAL al file principale
+   conn = sqlite3.connect(database.DATABASE_PATH)
+   conn.execute("PRAGMA wal_autocheckpoint = 0")
+   conn.execute("INSERT INTO channels (playlist_id, name, url, position) VALUES (1, 'nel WAL', 'x', -1)")
+   conn.commit()
+   expected = count + 1
+
+   copied, elapsed, writes = with_writer(old_backup)
+   try:
+       rows = channel_count(copied)
+   except sqlite3.DatabaseError as e:
+       rows = f'errore: {e}'
+   print(f'{"shutil.copy2":<14} {elapsed * 1000:9.1f} ms   scritture concorrenti {writes:>6}   canali nella copia {rows} (attesi {expected})')
+   copied.unlink()
+
+   for compress in (False, True):
+       path, elapsed, writes = with_writer(lambda: create_backup(compress=compress))
+       if compress:
+           size = path.stat().st_size
+           plain = database.BACKUP_PATH / 'plain.db'
+           with open(plain, 'wb') as out, gzip.open(path) as packed:
+               shutil.copyfileobj(packed, out)
+           rows = channel_count(plain)
+           plain.unlink()
+       else:
+           size = path.stat().st_size
+           rows = channel_count(path)
+       label = 'backup gzip' if compress else 'backup'
+       print(f'{label:<14} {elapsed * 1000:9.1f} ms   scritture concorrenti {writes:>6}   canali nella copia {rows} (attesi {expected})   {size / 2**20:.1f} MB')
+       assert rows == expected, 'la copia non contiene le scritture nel WAL'
+       time.sleep(1)
+   conn.close()
+
+   requested, completed, final = asyncio.run(coalescing())
+   print(f'richieste {requested}, backup durante l\'intervallo {completed}, dopo la chiusura {final}')
+   assert completed == 1 and final == 2
+   print(f'backup conservati: {len(list_backups())}')
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,87 @@
+# Righe/s scritte in SQLite durante la sync: ciclo originale con un
+# INSERT per canale contro il caricamento massivo di PlaylistDiffSync.
+#
+#   cd backend && python -m benchmarks.bulk_load_bench [canali ...]
+import json
+import os
+import sys
+import tempfile
+import time
+
+import database
+from database import get_db, init_db, bulk_load_pragmas, disk_temp_store
+from m3u_utils import parse_m3u
+from playlist_sync import PlaylistDiffSync
+from benchmarks.parse_m3u_bench import synthetic_playlist
+
+def legacy_load(cursor, playlist_id, channels):
+   # Il ciclo di inserimento di sync_playlist prima dei batch
+   cursor.execute("BEGIN")
+   for i, channel in enumerate(channels, 1):
+       cursor.execute(
+           """INSERT INTO channels 
+              (playlist_id, name, url, group_title, logo_url, 
+               tvg_id, position, extra_tags)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+           (
+               playlist_id, channel.name, channel.url,
+               channel.group, channel.logo, channel.tvg_id,
+               i, json.dumps(channel.extra_tags.copy())
+           )
+       )
+
+def bulk_load(cursor, playlist_id, channels, batch_size=1000):
+   diff = PlaylistDiffSync(cursor, playlist_id, batch_size=batch_size)
+   diff.begin()
+   for start in range(0, len(channels), batch_size):
+       diff.add(channels[start:start + batch_size])
+   return diff.apply()
+
+def run(label, load, channels, pragmas=False):
+   with get_db() as db:
+       cursor = db.cursor()
+       cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, ?)", (label,))
+       playlist_id = cursor.lastrowid
+       db.commit()
+
+       start = time.perf_counter()
+       # PlaylistDiffSync apre da sé la transazione di appoggio e quella
+       # di scrittura; il COMMIT finale resta al chiamante
+       if pragmas:
+           # Come la sync dell'app: tabelle temporanee su file
+           with disk_temp_store(db), bulk_load_pragmas(db):
+               result = load(cursor, playlist_id, channels)
+               cursor.execute("COMMIT")
+       else:
+           result = load(cursor, playlist_id, channels)
+           cursor.execute("COMMIT")
+       elapsed = time.perf_counter() - start
+
+   print(f'{label:<32} {len(channels) / elapsed:>12,.0f} righe/s  ({elapsed:.2f} s)')
+   return playlist_id, result
+
+def fresh_db():
+   # Ogni misura parte da un database vuoto
+   os.chdir(tempfile.mkdtemp())
+   database.DATABASE_PATH.parent.mkdir(exist_ok=True)
+   init_db()
+
+def main():
+   counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 500_000]
+
+   for count in counts:
+       channels = parse_m3u(synthetic_playlist(count))
+       print(f'--- {count:,} canali')
+       fresh_db()
+       run(f'originale {count}', legacy_load, channels)
+       fresh_db()
+       playlist_id, _ = run(f'bulk primo sync {count}', bulk_load, channels, pragmas=True)
+
+       # Resync senza modifiche: solo confronto, nessuna riga scritta
+       def resync(cursor, _, channels):
+           return bulk_load(cursor, playlist_id, channels)
+       _, result = run(f'diff resync {count}', resync, channels, pragmas=True)
+       print(f'{"":<32} scritte: {result["added"] + result["changed"] + result["removed"]}')
+
+if __name__ == '__main__':
+   main()
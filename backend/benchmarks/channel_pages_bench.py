@@ -0,0 +1,65 @@
+# Costo di una pagina di canali in funzione della sua posizione nella
+# playlist: paginazione keyset (fetch_channel_page) contro LIMIT/OFFSET.
+#
+#   cd backend && python -m benchmarks.channel_pages_bench [canali]
+import os
+import sys
+import tempfile
+import time
+
+from database import get_db, init_db
+from channel_query import fetch_channel_page, encode_cursor
+
+PAGE_SIZE = 100
+REPEAT = 20
+
+def timed(func):
+   start = time.perf_counter()
+   for _ in range(REPEAT):
+       func()
+   return (time.perf_counter() - start) / REPEAT * 1000
+
+def main():
+   count = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+
+   with get_db() as db:
+       cursor = db.cursor()
+       cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'bench')")
+       playlist = {"id": cursor.lastrowid, "is_custom": False}
+       cursor.executemany(
+           """INSERT INTO channels (playlist_id, name, url, group_title, position)
+              VALUES (?, ?, ?, ?, ?)""",
+           (
+               (playlist['id'], f'Canale {i}', f'http://stream/{i}', f'Gruppo {i % 40}', (i + 1) * 1024)
+               for i in range(count)
+           )
+       )
+
+   print(f'{"pagina":>10} {"keyset":>12} {"offset":>12} {"keyset gruppo":>15}')
+   with get_db() as db:
+       cursor = db.cursor()
+       for page in (0, count // PAGE_SIZE // 10, count // PAGE_SIZE // 2, count // PAGE_SIZE - 1):
+           offset = page * PAGE_SIZE
+           # Cursore equivalente all'ultima riga della pagina precedente
+           after = None
+           if offset:
+               row = cursor.execute(
+                   "SELECT id, position FROM channels WHERE playlist_id = ? ORDER BY position, id LIMIT 1 OFFSET ?",
+                   (playlist['id'], offset - 1)
+               ).fetchone()
+               after = encode_cursor(row['position'], row['id'])
+
+           keyset = timed(lambda: fetch_channel_page(cursor, playlist, PAGE_SIZE, after))
+           by_offset = timed(lambda: cursor.execute(
+               "SELECT * FROM channels WHERE playlist_id = ? ORDER BY position, id LIMIT ? OFFSET ?",
+               (playlist['id'], PAGE_SIZE, offset)
+           ).fetchall())
+           grouped = timed(lambda: fetch_channel_page(
+               cursor, playlist, PAGE_SIZE, after, group_title='Gruppo 7'
+           ))
+           print(f'{page + 1:>10} {keyset:>9.2f} ms {by_offset:>9.2f} ms {grouped:>12.2f} ms')
+
+if __name__ == '__main__':
+   main()
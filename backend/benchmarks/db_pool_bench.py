@@ -0,0 +1,86 @@
+# Latenza per richiesta dell'accesso al DB: una connessione nuova per ogni
+# get_db (come prima del pool) contro le connessioni riutilizzate del pool.
+# Ogni "richiesta" fa come un endpoint autenticato: lookup dell'utente in
+# get_current_user e poi la query dell'endpoint, su due get_db distinti.
+#
+#   cd backend && python -m benchmarks.db_pool_bench [richieste]
+from contextlib import contextmanager
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import database
+from database import get_db, init_db, dict_factory
+
+@contextmanager
+def legacy_get_db():
+   # get_db originale: mkdir, connect e row_factory a ogni chiamata
+   database.DATABASE_PATH.parent.mkdir(exist_ok=True)
+   conn = sqlite3.connect(
+       str(database.DATABASE_PATH),
+       detect_types=sqlite3.PARSE_DECLTYPES,
+       timeout=10.0,
+       isolation_level='IMMEDIATE'
+   )
+   conn.row_factory = dict_factory
+   try:
+       yield conn
+   except Exception as e:
+       conn.rollback()
+       raise e
+   else:
+       conn.commit()
+   finally:
+       conn.close()
+
+def request(open_db, playlist_id):
+   with open_db() as db:
+       db.execute("SELECT * FROM users WHERE username = ?", ('admin',)).fetchone()
+   with open_db() as db:
+       db.execute(
+           "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
+           (playlist_id, 1)
+       ).fetchone()
+       db.execute(
+           "SELECT * FROM channels WHERE playlist_id = ? ORDER BY position LIMIT 50",
+           (playlist_id,)
+       ).fetchall()
+
+def measure(label, open_db, playlist_id, requests):
+   for _ in range(50):
+       request(open_db, playlist_id)
+   timings = []
+   for _ in range(requests):
+       start = time.perf_counter()
+       request(open_db, playlist_id)
+       timings.append(time.perf_counter() - start)
+   timings.sort()
+   mean = statistics.mean(timings)
+   p95 = timings[int(len(timings) * 0.95)]
+   print(f'{label:<20} media {mean * 1e6:8.1f} µs   p50 {timings[len(timings) // 2] * 1e6:8.1f} µs   p95 {p95 * 1e6:8.1f} µs')
+   return mean
+
+def main():
+   requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   with get_db() as db:
+       cursor = db.cursor()
+       cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'bench')")
+       playlist_id = cursor.lastrowid
+       cursor.executemany(
+           """INSERT INTO channels (playlist_id, name, url, position)
+              VALUES (?, ?, ?, ?)""",
+           [(playlist_id, f'Channel {i}', f'http://stream/{i}', i) for i in range(200)]
+       )
+
+   legacy = measure('connessione nuova', legacy_get_db, playlist_id, requests)
+   pooled = measure('pool', get_db, playlist_id, requests)
+   print(f'speedup {legacy / pooled:.1f}x')
+   print(database.db_pool.stats())
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,125 @@
+# Sync EPG su guide XMLTV sintetiche (compresse con gzip) servite da un
+# server locale: tempo e memoria residente al crescere della guida, poi
+# una resync in cui cambia un programma ogni cento canali, che deve
+# riscrivere solo quelle finestre. Con --memory misura anche il picco di
+# memoria Python con tracemalloc (che rallenta la sync di alcune volte).
+#
+#   cd backend && python -m benchmarks.epg_bench [canali] [ore] [--memory]
+import asyncio
+import gzip
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('BACKUP_ENABLED', '0')
+
+from aiohttp import web
+
+import main as server
+from database import get_db, init_db
+
+EPG_PORT = 18768
+START = 1_700_000_000 - 1_700_000_000 % 86400
+
+def xmltv_time(timestamp):
+   return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m%d%H%M%S +0000')
+
+def write_xmltv(path, channels, hours, revision=0, seed=0):
+   # Scritta a righe direttamente nel file gzip: anche il generatore
+   # non tiene la guida in memoria
+   rng = random.Random(seed)
+   with gzip.open(path, 'wt', encoding='utf-8', compresslevel=1) as f:
+       f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="bench">\n')
+       for c in range(channels):
+           f.write(f'<channel id="ch{c}.it"><display-name>Canale {c}</display-name>'
+                   f'<icon src="http://logo.example/{c}.png"/></channel>\n')
+       for c in range(channels):
+           start = START
+           for h in range(hours):
+               stop = start + rng.choice((1800, 3600, 5400))
+               title = f'Programma {c}-{h}'
+               if revision and c % 100 == 0 and h == hours // 2:
+                   title += f' (r{revision})'
+               f.write(
+                   f'<programme start="{xmltv_time(start)}" stop="{xmltv_time(stop)}" channel="ch{c}.it">'
+                   f'<title lang="it">{title}</title>'
+                   f'<desc lang="it">Descrizione del programma {h} sul canale {c}, con qualche dettaglio.</desc>'
+                   f'<category lang="it">Categoria {rng.randrange(20)}</category>'
+                   f'<episode-num system="onscreen">S{h % 9 + 1:02d}E{c % 20 + 1:02d}</episode-num>'
+                   f'</programme>\n'
+               )
+               start = stop
+       f.write('</tv>\n')
+
+async def start_upstream(state):
+   async def handler(request):
+       return web.FileResponse(state['path'])
+   app = web.Application()
+   app.router.add_get('/guide.xml.gz', handler)
+   runner = web.AppRunner(app)
+   await runner.setup()
+   await web.TCPSite(runner, '127.0.0.1', EPG_PORT).start()
+   return runner
+
+def create_playlist(name):
+   with get_db() as db:
+       return db.execute(
+           "INSERT INTO playlists (user_id, name, epg_url) VALUES (1, ?, ?)",
+           (name, f'http://127.0.0.1:{EPG_PORT}/guide.xml.gz?{name}')
+       ).lastrowid
+
+def max_rss_mb():
+   return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def timed_sync(playlist_id):
+   tracemalloc.reset_peak()
+   start = time.perf_counter()
+   result = await server.run_epg_sync(playlist_id, 1, True)
+   elapsed = time.perf_counter() - start
+   if not tracemalloc.is_tracing():
+       return result, elapsed, ''
+   return result, elapsed, f'  picco Python {tracemalloc.get_traced_memory()[1] / 2**20:6.1f} MB'
+
+async def main():
+   args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+   channels = int(args[0]) if args else 2000
+   hours = int(args[1]) if len(args) > 1 else 72
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   state = {}
+   upstream = await start_upstream(state)
+   if '--memory' in sys.argv:
+       tracemalloc.start()
+   try:
+       for scale in (0.125, 0.25, 0.5, 1.0):
+           count = max(1, int(channels * scale))
+           state['path'] = f'guide-{count}.xml.gz'
+           write_xmltv(state['path'], count, hours)
+           size = os.path.getsize(state['path']) / 2**20
+           playlist_id = create_playlist(f'epg-{count}')
+           result, elapsed, peak = await timed_sync(playlist_id)
+           print(f"{count:>7,} canali {result['programmes']:>10,} programmi  {size:7.1f} MB gz  "
+                 f"{elapsed:7.2f} s  {result['programmes'] / elapsed:>9,.0f} prog/s  "
+                 f"RSS max {max_rss_mb():6.0f} MB{peak}")
+
+       # Resync della guida più grande: prima identica, poi con un
+       # programma cambiato ogni cento canali
+       for revision in (0, 1):
+           state['path'] = f'guide-r{revision}.xml.gz'
+           write_xmltv(state['path'], count, hours, revision=revision)
+           result, elapsed, peak = await timed_sync(playlist_id)
+           print(f"resync r{revision}: {elapsed:7.2f} s  finestre cambiate {result['windows_changed']:,} "
+                 f"su {result['windows_changed'] + result['windows_unchanged']:,}, "
+                 f"programmi riscritti {result['programmes_inserted']:,}{peak}")
+   finally:
+       tracemalloc.stop()
+       await upstream.cleanup()
+
+if __name__ == '__main__':
+   asyncio.run(main())
@@ -0,0 +1,106 @@
+# Controllo degli stream contro un server locale che simula i provider:
+# otto host (127.0.0.1-8), 50 ms di latenza per risposta, manifest HLS,
+# stream TS che rifiutano la HEAD, un 10% di canali morti. Misura
+# canali/s al variare dei limiti di concorrenza e verifica che nessun
+# host riceva più richieste contemporanee del limite per host. Uno alla
+# volta servirebbero canali * 50 ms.
+#
+#   cd backend && python -m benchmarks.health_bench [canali]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from database import get_db, init_db, run_db
+from stream_health import StreamHealthChecker, health_targets, record_health
+
+HEALTH_PORT = 18769
+HOSTS = [f'127.0.0.{n}' for n in range(1, 9)]
+LATENCY = 0.05
+
+async def start_upstream(state):
+   async def handler(request):
+       host = request.host.split(':')[0]
+       state['active'][host] = state['active'].get(host, 0) + 1
+       state['max'][host] = max(state['max'].get(host, 0), state['active'][host])
+       try:
+           await asyncio.sleep(LATENCY)
+           number = int(request.match_info['number'])
+           if number % 10 == 0:
+               return web.Response(status=404)
+           if request.match_info['kind'] == 'hls':
+               return web.Response(
+                   text='#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXTINF:6,\nsegment.ts\n',
+                   content_type='application/vnd.apple.mpegurl'
+               )
+           if request.method == 'HEAD':
+               return web.Response(status=405)
+           return web.Response(body=b'\x47' * 4096, content_type='video/mp2t')
+       finally:
+           state['active'][host] -= 1
+   app = web.Application()
+   app.router.add_route('*', '/{kind}/{number}.m3u8', handler)
+   app.router.add_route('*', '/{kind}/{number}', handler)
+   runner = web.AppRunner(app)
+   await runner.setup()
+   for host in HOSTS:
+       await web.TCPSite(runner, host, HEALTH_PORT).start()
+   return runner
+
+def stream_url(number):
+   host = HOSTS[number % len(HOSTS)]
+   if number % 2:
+       return f'http://{host}:{HEALTH_PORT}/hls/{number}.m3u8'
+   return f'http://{host}:{HEALTH_PORT}/ts/{number}'
+
+def create_playlist(channels):
+   with get_db() as db:
+       playlist_id = db.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'bench')").lastrowid
+       db.executemany(
+           "INSERT INTO channels (playlist_id, name, url, position) VALUES (?, ?, ?, ?)",
+           ((playlist_id, f'Canale {n}', stream_url(n), n) for n in range(channels))
+       )
+       return playlist_id
+
+def load_targets(playlist_id):
+   with get_db() as db:
+       cursor = db.cursor()
+       return health_targets(cursor, cursor.execute(
+           "SELECT id, is_custom FROM playlists WHERE id = ?", (playlist_id,)
+       ).fetchone())
+
+async def record(rows):
+   def work():
+       with get_db() as db:
+           record_health(db.cursor(), rows)
+   await run_db(work)
+
+async def main():
+   channels = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   state = {'active': {}, 'max': {}}
+   upstream = await start_upstream(state)
+   playlist_id = create_playlist(channels)
+   targets = load_targets(playlist_id)
+   print(f'{channels:,} canali su {len(HOSTS)} host, uno alla volta: {channels * LATENCY:,.0f} s o più')
+   try:
+       for concurrency, per_host in ((8, 1), (32, 4), (50, 4), (100, 16)):
+           state['max'].clear()
+           checker = StreamHealthChecker(concurrency, per_host)
+           start = time.perf_counter()
+           result = await checker.check(playlist_id, targets, record)
+           elapsed = time.perf_counter() - start
+           await checker.close()
+           print(f"concorrenza {concurrency:>3} per host {per_host:>2}: {elapsed:6.2f} s "
+                 f"{channels / elapsed:>7,.0f} canali/s  max per host {max(state['max'].values()):>2}  "
+                 f"{dict(sorted(result['statuses'].items()))}")
+           targets = load_targets(playlist_id)
+   finally:
+       await upstream.cleanup()
+
+if __name__ == '__main__':
+   asyncio.run(main())
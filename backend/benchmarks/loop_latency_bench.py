@@ -0,0 +1,130 @@
+# Latenza delle richieste pubbliche M3U mentre gira una sync grande, con le
+# query sull'event loop (come prima di run_db) e sui thread del DB.
+# Sync e richieste condividono lo stesso event loop, come in un worker
+# uvicorn: se il DB blocca il loop, le richieste pubbliche aspettano.
+#
+#   cd backend && python -m benchmarks.loop_latency_bench [canali sync] [canali pubblici]
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+import auth
+import main as server
+from database import get_db, init_db, run_db
+from benchmarks.parse_m3u_bench import synthetic_playlist
+
+UPSTREAM_PORT = 18766
+client_pool = ThreadPoolExecutor(max_workers=1)
+
+async def inline_db(func, *args, **kwargs):
+   # Comportamento precedente: la query gira direttamente nel loop
+   return func(*args, **kwargs)
+
+def use_db_runner(runner):
+   server.run_db = runner
+   auth.run_db = runner
+
+async def start_upstream(state):
+   async def handler(request):
+       return web.Response(body=state['body'], content_type='audio/x-mpegurl')
+   app = web.Application()
+   app.router.add_get('/list.m3u', handler)
+   runner = web.AppRunner(app)
+   await runner.setup()
+   await web.TCPSite(runner, '127.0.0.1', UPSTREAM_PORT).start()
+   return runner
+
+async def fetch_public(endpoint, token):
+   request = Request({
+       'type': 'http', 'method': 'GET', 'path': f'/public/playlist/{token}/m3u',
+       'headers': [], 'query_string': b''
+   })
+   response = await endpoint(token, request)
+   if isinstance(response, StreamingResponse):
+       async for _ in response.body_iterator:
+           pass
+
+async def measure(endpoint, token, until):
+   # Il client gira in un thread separato, come un client esterno: le
+   # richieste arrivano anche mentre il loop è occupato e l'attesa conta
+   loop = asyncio.get_running_loop()
+   stop = threading.Event()
+   until.add_done_callback(lambda _: stop.set())
+
+   def client():
+       timings = []
+       while not stop.is_set():
+           start = time.perf_counter()
+           asyncio.run_coroutine_threadsafe(fetch_public(endpoint, token), loop).result()
+           timings.append(time.perf_counter() - start)
+           time.sleep(0.01)
+       return timings
+
+   return await asyncio.wrap_future(client_pool.submit(client))
+
+def report(label, timings):
+   timings = sorted(timings)
+   p = lambda q: timings[min(len(timings) - 1, int(len(timings) * q))] * 1000
+   print(f'{label:<36} n={len(timings):<5} p50 {p(0.5):7.1f} ms  p99 {p(0.99):8.1f} ms  max {timings[-1] * 1000:8.1f} ms')
+
+async def run(sync_count, public_count):
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   # Nessuna cache: ogni richiesta legge davvero dal DB
+   server.rendered_playlists.max_entry_bytes = 0
+   endpoint = server.get_public_playlist
+
+   state = {}
+   upstream = await start_upstream(state)
+   url = f'http://127.0.0.1:{UPSTREAM_PORT}/list.m3u'
+
+   with get_db() as db:
+       cursor = db.cursor()
+       cursor.execute(
+           "INSERT INTO playlists (user_id, name, public_token) VALUES (1, 'public', 'bench')"
+       )
+       cursor.executemany(
+           "INSERT INTO channels (playlist_id, name, url, position) VALUES (?, ?, ?, ?)",
+           [(cursor.lastrowid, f'Channel {i}', f'http://stream/{i}', i) for i in range(public_count)]
+       )
+
+   idle_done = asyncio.get_running_loop().create_future()
+   asyncio.get_running_loop().call_later(2, idle_done.set_result, None)
+   report('a riposo', await measure(endpoint, 'bench', idle_done))
+
+   for label, runner in (('DB sul loop', inline_db), ('DB sui thread (run_db)', run_db)):
+       use_db_runner(runner)
+       with get_db() as db:
+           playlist_id = db.execute(
+               "INSERT INTO playlists (user_id, name, url) VALUES (1, ?, ?)", (label, url)
+           ).lastrowid
+
+       # Primo caricamento e poi una resync con il 10% dei canali rinominati
+       state['body'] = synthetic_playlist(sync_count).encode('utf-8')
+       for step in ('primo sync', 'resync'):
+           if step == 'resync':
+               state['body'] = state['body'].replace(b',Canale 1', b',Rinominato 1')
+           start = time.perf_counter()
+           sync = asyncio.ensure_future(server.run_playlist_sync(playlist_id, 1, True))
+           timings = await measure(endpoint, 'bench', sync)
+           sync.result()
+           report(f'{label}, {step}', timings)
+           print(f'{"":<36} sync {time.perf_counter() - start:.1f} s')
+   use_db_runner(run_db)
+   await upstream.cleanup()
+
+def main():
+   sync_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+   public_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+   asyncio.run(run(sync_count, public_count))
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,67 @@
+# Playlist M3U sintetiche e riproducibili per i benchmark: stesso seed,
+# stessi parametri, stesso contenuto byte per byte.
+#
+#   density     frazione degli attributi opzionali presenti (tvg-id,
+#               tvg-name, tvg-logo, group-title)
+#   extra_tags  frazione dei canali preceduti da righe #EXTVLCOPT,
+#               #KODIPROP o #EXTGRP
+#   unicode     frazione dei nomi con accenti, CJK, RTL o emoji
+#   revision    rinomina un canale su dieci (revision > 0): simula una
+#               nuova versione della stessa playlist per le resync
+#
+#   cd backend && python -m benchmarks.m3u_generator canali [density] [extra_tags] [unicode] > lista.m3u
+import random
+import sys
+
+EPG_URL = 'http://epg.example/guide.xml.gz'
+
+EXTRA_TAGS = [
+   ('#EXTVLCOPT:http-user-agent=Mozilla/5.0 (SmartTV)',),
+   ('#EXTVLCOPT:http-referrer=http://portal.example/',),
+   ('#KODIPROP:inputstream=inputstream.adaptive', '#KODIPROP:inputstream.adaptive.manifest_type=hls'),
+   ('#EXTVLCOPT:http-user-agent=VLC/3.0', '#EXTVLCOPT:network-caching=1000'),
+]
+UNICODE_NAMES = [
+   'Télé Française', 'Canale Più Sport', 'Ελληνική Τηλεόραση', 'Первый канал',
+   'テレビ東京', '中央电视台', 'قناة الجزيرة', 'ערוץ חדשות', 'Çocuk TV', 'Música 🎵', 'Kino 📺',
+]
+GROUPS = 40
+LOGOS = 500
+
+def generate_m3u_playlist(count: int, density: float = 1.0, extra_tags: float = 0.25,
+                          unicode: float = 0.1, seed: int = 0, revision: int = 0) -> str:
+   rng = random.Random(seed)
+   lines = [f'#EXTM3U x-tvg-url="{EPG_URL}"']
+   for i in range(count):
+       if rng.random() < extra_tags:
+           lines.extend(rng.choice(EXTRA_TAGS))
+
+       if rng.random() < unicode:
+           name = f'{rng.choice(UNICODE_NAMES)} {i}'
+       else:
+           name = f'Canale {i} HD'
+       if revision and i % 10 == 0:
+           name = f'{name} (r{revision})'
+
+       attributes = []
+       if rng.random() < density:
+           attributes.append(f'tvg-id="ch{i}.it"')
+       if rng.random() < density:
+           attributes.append(f'tvg-name="{name}"')
+       if rng.random() < density:
+           attributes.append(f'tvg-logo="http://logo.example/{rng.randrange(LOGOS)}.png"')
+       if rng.random() < density:
+           attributes.append(f'group-title="Gruppo {rng.randrange(GROUPS)}"')
+
+       attrs = ' ' + ' '.join(attributes) if attributes else ''
+       lines.append(f'#EXTINF:-1{attrs},{name}')
+       lines.append(f'http://stream.example/live/{i}.m3u8')
+   return '\n'.join(lines) + '\n'
+
+def main():
+   count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+   options = [float(value) for value in sys.argv[2:5]]
+   sys.stdout.write(generate_m3u_playlist(count, *options))
+
+if __name__ == '__main__':
+   main()
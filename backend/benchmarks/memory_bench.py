@@ -0,0 +1,38 @@
+# Memoria occupata dai canali parsati: classe originale contro M3UChannel
+# con __slots__, stringhe condivise e tag extra condivisi.
+#
+#   cd backend && python -m benchmarks.memory_bench [numero_canali]
+import gc
+import sys
+import tracemalloc
+
+from m3u_utils import parse_m3u
+from benchmarks.legacy_m3u import legacy_parse_m3u
+from benchmarks.parse_m3u_bench import synthetic_playlist
+
+def measure(parse, content: str):
+   gc.collect()
+   tracemalloc.start()
+   channels = parse(content)
+   retained, peak = tracemalloc.get_traced_memory()
+   tracemalloc.stop()
+   return len(channels), retained, peak
+
+def main():
+   count = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+   content = synthetic_playlist(count)
+
+   print(f'{"":<12} {"canali":>10} {"trattenuta":>12} {"picco":>12} {"byte/canale":>12}')
+   results = {}
+   for label, parse in (('originale', legacy_parse_m3u), ('compatta', parse_m3u)):
+       channels, retained, peak = measure(parse, content)
+       results[label] = retained
+       print(
+           f'{label:<12} {channels:>10,} {retained / 2**20:>10.1f}MB '
+           f'{peak / 2**20:>10.1f}MB {retained / max(channels, 1):>12,.0f}'
+       )
+   saved = 1 - results['compatta'] / results['originale']
+   print(f'Risparmio sulla memoria trattenuta: {saved:.0%}')
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,96 @@
+# Costo delle metriche: un aggiornamento di contatore e istogramma, le
+# richieste al secondo (GET /users/me attraverso tutta l'app ASGI) senza e
+# con MetricsMiddleware, e il tempo per generare /metrics. Controlla anche
+# che l'output rispetti il formato testo di Prometheus.
+#
+#   cd backend && python -m benchmarks.metrics_bench [richieste] [concorrenza]
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+
+# L'app viene importata senza middleware: lo si aggiunge a mano sotto
+os.environ['METRICS_ENABLED'] = '0'
+
+import httpx
+
+import auth
+import main as server
+import metrics
+from database import init_db
+
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{[a-zA-Z_]+="(?:[^"\\]|\\.)*"(,[a-zA-Z_]+="(?:[^"\\]|\\.)*")*\})? \S+$')
+
+def per_update(func, count=200_000):
+   start = time.perf_counter()
+   for _ in range(count):
+       func()
+   return (time.perf_counter() - start) / count * 1e6
+
+async def requests_per_second(app, token, total, concurrency):
+   headers = {'Authorization': f'Bearer {token}'}
+   remaining = [total]
+   transport = httpx.ASGITransport(app=app)
+   async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+       async def worker():
+           while remaining[0] > 0:
+               remaining[0] -= 1
+               response = await client.get('/users/me', headers=headers)
+               assert response.status_code == 200, response.text
+
+       start = time.perf_counter()
+       await asyncio.gather(*(worker() for _ in range(concurrency)))
+       return total / (time.perf_counter() - start)
+
+def check_format(text):
+   # Ogni riga è un commento HELP/TYPE o un campione valido; i bucket degli
+   # istogrammi sono cumulativi e _count coincide con il bucket +Inf
+   buckets = {}
+   for line in text.splitlines():
+       if line.startswith('# HELP ') or line.startswith('# TYPE '):
+           continue
+       assert SAMPLE.match(line), f'riga non valida: {line!r}'
+       name, value = line.rsplit(' ', 1)
+       float(value.replace('+Inf', 'inf'))
+       if '_bucket{' in name:
+           series = re.sub(r',?le="[^"]*"', '', name).replace('_bucket', '')
+           previous = buckets.get(series, 0)
+           assert float(value) >= previous, f'bucket non cumulativo: {line!r}'
+           buckets[series] = float(value)
+       elif '_count' in name:
+           series = name.replace('_count', '').replace('{}', '')
+           if series in buckets or series + '{}' in buckets:
+               assert float(value) == buckets.get(series, buckets.get(series + '{}')), line
+   return len(buckets)
+
+async def main():
+   total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+   concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   token = auth.create_access_token({'sub': 'admin'})
+
+   counter = metrics.HTTP_REQUESTS.labels('GET', '/bench', '200')
+   histogram = metrics.HTTP_DURATION.labels('GET', '/bench')
+   print(f'contatore  {per_update(counter.inc):6.2f} µs per aggiornamento')
+   print(f'istogramma {per_update(lambda: histogram.observe(0.003)):6.2f} µs per aggiornamento')
+   print(f'etichette  {per_update(lambda: metrics.HTTP_DURATION.labels("GET", "/bench").observe(0.003)):6.2f} µs per aggiornamento')
+
+   await requests_per_second(server.app, token, 200, concurrency)
+   rates = {}
+   for label, app in (('senza metriche', server.app), ('con metriche', metrics.MetricsMiddleware(server.app))):
+       rates[label] = await requests_per_second(app, token, total, concurrency)
+       print(f'{label:<15} {rates[label]:8.0f} richieste/s')
+   overhead = 1 / rates['con metriche'] - 1 / rates['senza metriche']
+   print(f'costo per richiesta: {overhead * 1e6:.0f} µs')
+
+   start = time.perf_counter()
+   text = metrics.registry.render()
+   elapsed = time.perf_counter() - start
+   series = check_format(text)
+   print(f'/metrics: {len(text.splitlines())} righe, {series} istogrammi, generato in {elapsed * 1000:.2f} ms, formato valido')
+
+if __name__ == '__main__':
+   asyncio.run(main())
@@ -0,0 +1,125 @@
+# Spostamento di canali: move_channels (posizioni distanziate, si scrivono
+# solo i canali spostati) contro il riordino completo di
+# PUT /channels/reorder (una UPDATE per canale). Prima dei tempi confronta
+# una serie di spostamenti casuali, singoli e in blocco, con lo stesso
+# ordine calcolato in memoria, anche quando lo spazio finisce e la
+# playlist viene rinumerata.
+#
+#   cd backend && python -m benchmarks.move_channels_bench [canali]
+import os
+import random
+import sys
+import tempfile
+import time
+
+from database import get_db, init_db
+from channel_order import move_channels
+from playlist_sync import POSITION_STEP
+
+REPEAT = 20
+
+def load(cursor, count, custom):
+   cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'bench')")
+   source = {"id": cursor.lastrowid, "is_custom": False}
+   cursor.executemany(
+       """INSERT INTO channels (playlist_id, name, url, position)
+          VALUES (?, ?, ?, ?)""",
+       ((source['id'], f'Canale {i}', f'http://stream/{i}', (i + 1) * POSITION_STEP) for i in range(count))
+   )
+   if not custom:
+       return source
+   cursor.execute("INSERT INTO playlists (user_id, name, is_custom) VALUES (1, 'custom', 1)")
+   playlist = {"id": cursor.lastrowid, "is_custom": True}
+   # Posizioni consecutive come quelle salvate dal vecchio riordino
+   cursor.execute(
+       """INSERT INTO custom_playlist_channels (playlist_id, channel_id, position)
+          SELECT ?, id, ROW_NUMBER() OVER (ORDER BY id) FROM channels WHERE playlist_id = ?""",
+       (playlist['id'], source['id'])
+   )
+   return playlist
+
+def current_order(cursor, playlist):
+   if playlist['is_custom']:
+       rows = cursor.execute(
+           "SELECT channel_id AS id FROM custom_playlist_channels WHERE playlist_id = ? ORDER BY position, channel_id",
+           (playlist['id'],)
+       )
+   else:
+       rows = cursor.execute(
+           "SELECT id FROM channels WHERE playlist_id = ? ORDER BY position, id",
+           (playlist['id'],)
+       )
+   return [row['id'] for row in rows]
+
+def check_moves(cursor, playlist, moves, seed):
+   rnd = random.Random(seed)
+   expected = current_order(cursor, playlist)
+   rebalances = 0
+   for n in range(moves):
+       size = 1 if n % 3 else rnd.randint(2, 40)
+       start = rnd.randrange(len(expected) - size)
+       block = expected[start:start + size] if n % 2 else rnd.sample(expected, size)
+       rest = [channel_id for channel_id in expected if channel_id not in set(block)]
+       # Metà degli spostamenti nello stesso punto, per esaurire lo spazio
+       anchor_index = len(rest) // 2 if n % 2 else rnd.randrange(len(rest))
+       after = rnd.random() < 0.5
+       anchor = rest[anchor_index]
+       result = move_channels(
+           cursor, playlist, block,
+           **({'after_id': anchor} if after else {'before_id': anchor})
+       )
+       rebalances += result['rebalanced']
+       insert_at = anchor_index + 1 if after else anchor_index
+       expected = rest[:insert_at] + block + rest[insert_at:]
+   assert current_order(cursor, playlist) == expected, 'ordine diverso da quello atteso'
+   return rebalances
+
+def main():
+   count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+
+   with get_db() as db:
+       cursor = db.cursor()
+       for custom in (False, True):
+           playlist = load(cursor, 2000, custom)
+           rebalances = check_moves(cursor, playlist, 400, seed=3)
+           label = 'custom' if custom else 'normale'
+           print(f'spostamenti ok: playlist {label}, 400 spostamenti, {rebalances} rinumerazioni')
+
+   with get_db() as db:
+       cursor = db.cursor()
+       playlist = load(cursor, count, False)
+       db.commit()
+       order = current_order(cursor, playlist)
+
+       def single_move():
+           before = db.total_changes
+           start = time.perf_counter()
+           move_channels(cursor, playlist, [order[-1]], after_id=order[0])
+           db.commit()
+           return time.perf_counter() - start, db.total_changes - before
+
+       def full_reorder():
+           # Come il frontend prima: tutte le posizioni, una UPDATE per canale
+           reordered = order[:1] + order[-1:] + order[1:-1]
+           before = db.total_changes
+           start = time.perf_counter()
+           for position, channel_id in enumerate(reordered, 1):
+               cursor.execute(
+                   "UPDATE channels SET position = ? WHERE id = ? AND playlist_id = ?",
+                   (position, channel_id, playlist['id'])
+               )
+           db.commit()
+           return time.perf_counter() - start, db.total_changes - before
+
+       for label, func, repeat in (('move', single_move, REPEAT), ('reorder', full_reorder, 3)):
+           timings = []
+           for _ in range(repeat):
+               elapsed, rows = func()
+               timings.append(elapsed)
+           timings.sort()
+           print(f'{label:<10} {timings[len(timings) // 2] * 1000:10.2f} ms   righe scritte {rows:>8,}')
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,101 @@
+# Parità e throughput di parse_m3u rispetto all'implementazione originale.
+#
+#   cd backend && python -m benchmarks.parse_m3u_bench [numero_canali]
+import sys
+import time
+
+from m3u_utils import parse_m3u, iter_m3u
+from benchmarks.legacy_m3u import legacy_parse_m3u
+
+# Casi limite che il nuovo tokenizer deve trattare come il parser originale
+PARITY_CORPUS = [
+   '',
+   '#EXTM3U',
+   '#EXTM3U x-tvg-url="http://epg.example/guide.xml"\n#EXTINF:-1,Uno\nhttp://a/1',
+   '#EXTINF:-1 tvg-id="a.it" tvg-logo="http://l/a.png" group-title="News",Canale A\nhttp://a/a',
+   '#EXTINF:0 group-title="Sport" tvg-id="" ,  Spazi attorno  \nhttp://a/b',
+   '#EXTINF:-1,Nome con virgole, finale,,\nhttp://a/c',
+   '#EXTINF:10,,Doppia virgola\nhttp://a/d',
+   '#EXTINF:,Senza durata\nhttp://a/e',
+   '#EXTINF: tvg-id="x" ,Spazio iniziale\nhttp://a/f',
+   '#EXTINF:-1 catchup="default" tvg-id="c",Attributi non tvg\nhttp://a/g',
+   '#EXTINF:-1 catchup="default",Solo attributi sconosciuti\nhttp://a/h',
+   '#EXTINF:-1 tvg-name="Dup" tvg-name="Dup2",Attributo duplicato\nhttp://a/i',
+   '#EXTINF:-1 tvg-id="n",Nome tvg-x="dentro" al titolo\nhttp://a/j',
+   '#EXTINF:-1 group-title="Vecchio",Gruppo\n#EXTGRP: Nuovo \nhttp://a/k',
+   '#EXTGRP:Orfano\nhttp://a/l',
+   '#EXTVLCOPT:http-user-agent=Mozilla/5.0\n#KODIPROP:inputstream=adaptive\n'
+   '#EXTINF:-1,Opzioni\nhttp://a/m',
+   '#EXTVLCOPT:\n#:vuoto\n#EXTX:a:b:c\n#EXTINF:-1,Tag strani\nhttp://a/n',
+   '#EXTVLCOPT:prima=1\nhttp://senza/extinf\n#EXTINF:-1,Dopo url orfano\nhttp://a/o',
+   '#EXTINF:-1,Senza url\n#EXTINF:-1,Sovrascritto\nhttp://a/p',
+   '#EXTINF:-1 tvg-id="ü",Unicode è 日本語 \U0001F4FA\nhttp://a/q',
+   '#EXTINF:-1 tvg-id="r",Windows\r\nhttp://a/r\r\n\r\n',
+   '  #EXTINF:-1 tvg-id="s" ,Indentato  \n   http://a/s   ',
+   '#EXTINF:-1 tvg-id="t" group-title="G",T\nhttp://a/t\n#EXTINF:-1 tvg-id="u",Ultimo',
+   '#EXTM3U x-tvg-url="http://e/1.xml"\n#EXTM3U x-tvg-url="http://e/2.xml"\n'
+   '#EXTINF:-1,Doppio header\nhttp://a/u',
+   '#EXTINF:-1 tvg-id="v"group-title="attaccato",Attaccati\nhttp://a/v',
+   '#EXTINF:-1 tvg-id="w" tvg-logo="sen za chiusura,Aperto\nhttp://a/w',
+]
+
+def synthetic_playlist(count: int) -> str:
+   lines = ['#EXTM3U x-tvg-url="http://epg.example/guide.xml.gz"']
+   for i in range(count):
+       if i % 4 == 0:
+           lines.append('#EXTVLCOPT:http-user-agent=Mozilla/5.0')
+       lines.append(
+           f'#EXTINF:-1 tvg-id="ch{i}.it" tvg-name="Canale {i}" '
+           f'tvg-logo="http://logo.example/{i % 500}.png" '
+           f'group-title="Gruppo {i % 40}",Canale {i} HD'
+       )
+       lines.append(f'http://stream.example/live/{i}.m3u8')
+   return '\n'.join(lines)
+
+def as_dicts(channels):
+   return [channel.to_dict() for channel in channels]
+
+def check_parity(samples) -> int:
+   failures = 0
+   for content in samples:
+       expected = as_dicts(legacy_parse_m3u(content))
+       data = content.encode('utf-8')
+       results = {
+           'str': as_dicts(parse_m3u(content)),
+           'bytes': as_dicts(parse_m3u(data)),
+           'stream': as_dicts(iter_m3u(data[i:i + 7] for i in range(0, len(data), 7))),
+       }
+       for mode, result in results.items():
+           if result != expected:
+               failures += 1
+               print(f'PARITY MISMATCH ({mode}): {content[:60]!r}')
+   return failures
+
+def throughput(label: str, func, arg, count: int, repeat: int = 3):
+   best = float('inf')
+   for _ in range(repeat):
+       start = time.perf_counter()
+       func(arg)
+       best = min(best, time.perf_counter() - start)
+   print(f'{label:<28} {count / best:>12,.0f} canali/s  ({best * 1000:.1f} ms)')
+
+def main():
+   count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+   content = synthetic_playlist(count)
+   data = content.encode('utf-8')
+
+   failures = check_parity(PARITY_CORPUS + [synthetic_playlist(2_000)])
+   print(f'Parità: {len(PARITY_CORPUS) + 1} campioni, {failures} differenze')
+
+   throughput('legacy parse_m3u(str)', legacy_parse_m3u, content, count)
+   throughput('parse_m3u(str)', parse_m3u, content, count)
+   throughput('parse_m3u(bytes)', parse_m3u, data, count)
+   throughput(
+       'iter_m3u(chunk da 64 KiB)',
+       lambda d: list(iter_m3u(d[i:i + 65536] for i in range(0, len(d), 65536))),
+       data, count
+   )
+   return 1 if failures else 0
+
+if __name__ == '__main__':
+   sys.exit(main())
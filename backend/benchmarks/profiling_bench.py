@@ -0,0 +1,87 @@
+# Costo della profilazione: da spenta (nessun header, PROFILE_REQUESTS
+# vuoto) il percorso pubblico fa solo un controllo sugli header; da accesa
+# misura quanto rallentano sync e download con il solo campionatore
+# ("X-Profile: cpu") e con anche tracemalloc, e quanto tempo richiede
+# scrivere il rapporto.
+#
+#   cd backend && python -m benchmarks.profiling_bench [canali]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import httpx
+
+import auth
+import main as server
+import profiling
+from database import init_db
+from benchmarks.m3u_generator import generate_m3u_playlist
+from benchmarks.suite import start_upstream, create_playlist
+
+def per_call(func, count=200_000):
+   start = time.perf_counter()
+   for _ in range(count):
+       func()
+   return (time.perf_counter() - start) / count * 1e9
+
+async def wait_for_reports(count):
+   while len(profiling.list_profiles()) < count or profiling._active.locked():
+       await asyncio.sleep(0.05)
+
+async def main():
+   channels = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   admin = {'Authorization': f"Bearer {auth.create_access_token({'sub': 'admin'})}"}
+
+   print(f'start_if_requested senza richiesta: {per_call(lambda: profiling.start_if_requested("public", 1)):.0f} ns')
+
+   upstream = await start_upstream({'body': generate_m3u_playlist(channels).encode('utf-8')})
+   playlist_id = create_playlist('profiling')
+   server.rendered_playlists.max_entry_bytes = 0
+   transport = httpx.ASGITransport(app=server.app)
+   async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+       async def sync(headers):
+           response = await client.post(f'/playlists/{playlist_id}/sync?force=true', headers=headers)
+           assert response.status_code == 200, response.text
+           return response
+
+       async def download(headers):
+           response = await client.get('/public/playlist/profiling/m3u', headers=headers)
+           assert response.status_code == 200, response.text
+           return response
+
+       await sync(admin)
+       reports = 0
+       for label, request in (('sync', sync), ('download', download)):
+           baseline = None
+           for mode, headers in (('spento', admin), ('cpu', {**admin, 'X-Profile': 'cpu'}),
+                                 ('cpu+memoria', {**admin, 'X-Profile': '1'})):
+               start = time.perf_counter()
+               response = await request(headers)
+               elapsed = time.perf_counter() - start
+               baseline = baseline or elapsed
+               line = f'{label:<9} {mode:<12} {elapsed * 1000:8.0f} ms ({elapsed / baseline:.1f}x)'
+               if 'x-profile-id' in response.headers:
+                   reports += 1
+                   written = time.perf_counter()
+                   await wait_for_reports(reports)
+                   line += f'   rapporto scritto in {(time.perf_counter() - written) * 1000:.0f} ms'
+               else:
+                   assert mode == 'spento', 'profilo non creato'
+               print(line)
+
+   for entry in profiling.list_profiles():
+       report = profiling.load_profile(entry['id'])
+       memory = report['memory']
+       peak = f"picco tracemalloc {memory['traced_peak'] / 2**20:.1f} MB" if memory else 'senza tracemalloc'
+       print(f"{entry['kind']:<9} {report['samples']:>5} campioni, {peak}, "
+             f"funzione più calda {report['self'][0]['function']} ({report['self'][0]['percent']}%)")
+   await upstream.cleanup()
+
+if __name__ == '__main__':
+   asyncio.run(main())
@@ -0,0 +1,92 @@
+# Rate limiting: vecchio schema (un contatore per processo e time.sleep
+# quando il limite è superato, come ratelimit.sleep_and_retry) contro
+# TokenBucketLimiter (bucket per chiave, 429 immediato). Misura il blocco
+# dell'event loop quando un client supera il limite, il costo di una
+# verifica e la memoria dei bucket con molte chiavi.
+#
+#   cd backend && python -m benchmarks.rate_limit_bench [chiavi]
+import asyncio
+import sys
+import time
+import tracemalloc
+
+from rate_limit import TokenBucketLimiter
+
+CALLS = 30
+PERIOD = 1.0
+
+class LegacyLimiter:
+   # Un solo contatore per tutti i client; oltre il limite dorme fino alla
+   # fine del periodo, bloccando il thread (e quindi l'event loop)
+   def __init__(self, calls, period):
+       self.calls = calls
+       self.period = period
+       self.count = 0
+       self.reset_at = time.monotonic() + period
+
+   def hit(self, key):
+       now = time.monotonic()
+       if now >= self.reset_at:
+           self.count = 0
+           self.reset_at = now + self.period
+       self.count += 1
+       if self.count > self.calls:
+           time.sleep(self.reset_at - now)
+           return self.hit(key)
+       return 0.0
+
+async def flood(limiter):
+   # Un client abusa (100 richieste), un altro fa una richiesta ogni ms:
+   # conta quanto aspetta al massimo il secondo client
+   worst = 0.0
+   rejected = 0
+   done = asyncio.Event()
+
+   async def other_client():
+       nonlocal worst
+       last = time.perf_counter()
+       while not done.is_set():
+           await asyncio.sleep(0.001)
+           now = time.perf_counter()
+           worst = max(worst, now - last - 0.001)
+           last = now
+
+   task = asyncio.create_task(other_client())
+   await asyncio.sleep(0.01)
+   for _ in range(100):
+       if limiter.hit('abuser'):
+           rejected += 1
+       await asyncio.sleep(0)
+   done.set()
+   await task
+   return worst, rejected
+
+def main():
+   keys = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+   for label, limiter in (('contatore+sleep', LegacyLimiter(CALLS, PERIOD)),
+                          ('token bucket', TokenBucketLimiter(CALLS, PERIOD))):
+       worst, rejected = asyncio.run(flood(limiter))
+       print(f'{label:<16} attesa massima degli altri client {worst * 1000:8.1f} ms   rifiutate {rejected}')
+
+   limiter = TokenBucketLimiter(CALLS, 60, max_keys=keys)
+   names = [f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(keys * 2)]
+   tracemalloc.start()
+   start = time.perf_counter()
+   for name in names:
+       limiter.hit(name)
+   elapsed = time.perf_counter() - start
+   current, _ = tracemalloc.get_traced_memory()
+   tracemalloc.stop()
+   stats = limiter.stats()
+   print(f'{len(names):,} chiavi diverse: {elapsed / len(names) * 1e6:.2f} µs per verifica, '
+         f'{stats["keys"]:,} bucket tenuti ({current / stats["keys"]:.0f} byte ciascuno)')
+
+   start = time.perf_counter()
+   for _ in range(5):
+       for name in names[-1000:]:
+           limiter.hit(name)
+   print(f'chiavi già presenti: {(time.perf_counter() - start) / 5000 * 1e6:.2f} µs per verifica')
+
+if __name__ == '__main__':
+   main()
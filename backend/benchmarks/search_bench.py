@@ -0,0 +1,132 @@
+# Ricerca full-text sui canali (channels_fts) e costo della manutenzione
+# dell'indice durante i caricamenti della sync.
+#
+#   cd backend && python -m benchmarks.search_bench [canali ricerca] [canali sync]
+import os
+import random
+import sys
+import tempfile
+import time
+
+from database import (
+   get_db, init_db, bulk_load_pragmas, disk_temp_store, rebuild_indexes,
+   suspend_search_indexing, index_channels_for_search, CHANNELS_FTS_TRIGGERS
+)
+from channel_query import search_channels
+from m3u_utils import parse_m3u
+from playlist_sync import PlaylistDiffSync
+from benchmarks.parse_m3u_bench import synthetic_playlist
+
+QUERIES = ('rai', 'ra', 'sport hd', 'kinotu', 'news 24', 'mediaset', 'ch12', 'zz')
+REPEAT = 20
+
+def fresh_db():
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+
+def channel_names(count, seed=7):
+   # Nomi vari come nelle liste reali: marchi, tema, numero, qualità
+   rnd = random.Random(seed)
+   syllables = ['ra', 'i', 'me', 'dia', 'set', 'ki', 'no', 'tu', 'sky', 'spo', 'rt',
+                'ne', 'ws', 'cine', 'ma', 'fox', 'li', 'fe', 'dis', 'co', 'ver', 'y']
+   brands = sorted({''.join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4))) for _ in range(3000)})
+   themes = ['Sport', 'News', 'Cinema', 'Kids', 'Music', 'Docs', 'Series', 'Live']
+   quality = ['', ' HD', ' FHD', ' 4K']
+   for i in range(count):
+       brand = rnd.choice(brands).capitalize()
+       yield (
+           f'{brand} {rnd.choice(themes)} {rnd.randint(1, 30)}{rnd.choice(quality)}',
+           f'Gruppo {rnd.choice(themes)} {i % 300}',
+           f'ch{i}.{brand.lower()}'
+       )
+
+def timed(func, repeat=REPEAT):
+   timings = []
+   for _ in range(repeat):
+       start = time.perf_counter()
+       result = func()
+       timings.append(time.perf_counter() - start)
+   timings.sort()
+   return timings[len(timings) // 2] * 1000, result
+
+def search_latency(count):
+   fresh_db()
+   with get_db() as db:
+       cursor = db.cursor()
+       cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'bench')")
+       playlist_id = cursor.lastrowid
+       start = time.perf_counter()
+       triggers = suspend_search_indexing(cursor)
+       cursor.executemany(
+           """INSERT INTO channels (playlist_id, name, url, group_title, tvg_id, position)
+              VALUES (?, ?, ?, ?, ?, ?)""",
+           (
+               (playlist_id, name, f'http://stream/{i}', group, tvg_id, i)
+               for i, (name, group, tvg_id) in enumerate(channel_names(count))
+           )
+       )
+       index_channels_for_search(cursor, "playlist_id = ?", (playlist_id,))
+       rebuild_indexes(cursor, triggers)
+   print(f'--- ricerca su {count:,} canali (caricati in {time.perf_counter() - start:.1f} s)')
+
+   with get_db() as db:
+       cursor = db.cursor()
+       for query in QUERIES:
+           ms, rows = timed(lambda: search_channels(cursor, 1, query, 50))
+           matches = cursor.execute(
+               "SELECT COUNT(*) AS n FROM channels_fts WHERE channels_fts MATCH ?",
+               (' '.join(f'"{term}"*' for term in query.split()),)
+           ).fetchone()['n']
+           print(f'{query!r:<14} {ms:8.2f} ms   corrispondenze {matches:>9,}   primo: {rows[0]["name"] if rows else "-"}')
+
+def drop_fts_triggers(cursor):
+   for name in ('channels_fts_insert', 'channels_fts_delete', 'channels_fts_update'):
+       cursor.execute(f"DROP TRIGGER {name}")
+
+def sync_load(label, channels, without_fts=False):
+   fresh_db()
+   with get_db() as db:
+       cursor = db.cursor()
+       if without_fts:
+           drop_fts_triggers(cursor)
+       cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, ?)", (label,))
+       playlist_id = cursor.lastrowid
+       db.commit()
+
+       timings = []
+       for step in ('primo sync', 'resync 10%'):
+           if step != 'primo sync':
+               for channel in channels[::10]:
+                   channel.name = channel.name + ' +1'
+           with disk_temp_store(db), bulk_load_pragmas(db):
+               start = time.perf_counter()
+               diff = PlaylistDiffSync(cursor, playlist_id)
+               diff.begin()
+               for offset in range(0, len(channels), 1000):
+                   diff.add(channels[offset:offset + 1000])
+               diff.apply()
+               cursor.execute("COMMIT")
+               timings.append(time.perf_counter() - start)
+       if without_fts:
+           for statement in CHANNELS_FTS_TRIGGERS:
+               cursor.execute(statement)
+       else:
+           # L'indice deve corrispondere esattamente alla tabella channels
+           cursor.execute("INSERT INTO channels_fts(channels_fts, rank) VALUES('integrity-check', 1)")
+   print(f'{label:<24} primo sync {timings[0]:6.2f} s   resync 10% {timings[1]:6.2f} s')
+   return timings
+
+def main():
+   search_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+   sync_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+
+   search_latency(search_count)
+
+   print(f'--- manutenzione indice durante la sync, {sync_count:,} canali')
+   body = synthetic_playlist(sync_count)
+   base = sync_load('senza FTS', parse_m3u(body), without_fts=True)
+   fts = sync_load('con FTS', parse_m3u(body))
+   print(f'{"costo FTS":<24} primo sync {fts[0] / base[0] - 1:+6.0%}     resync 10% {fts[1] / base[1] - 1:+6.0%}')
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,279 @@
+# Suite riproducibile per i percorsi caldi: parsing, generazione, sync
+# completa contro un server HTTP locale e servizio delle playlist
+# pubbliche. I risultati vanno in JSON; compare confronta due file e
+# termina con codice 1 se qualcosa è più lento oltre la soglia, così un
+# peggioramento salta fuori prima di un rilascio.
+#
+#   cd backend && python -m benchmarks.suite run --channels 1000,10000,100000 --out base.json
+#   cd backend && python -m benchmarks.suite compare base.json nuovo.json [--threshold 0.1]
+#
+# Per confronti sensati i due run devono usare gli stessi parametri del
+# generatore e la stessa macchina; si confronta il tempo migliore.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Il limite sulle playlist pubbliche scatterebbe dopo 30 richieste
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('BACKUP_ENABLED', '0')
+
+import httpx
+from aiohttp import web
+
+import main as server
+from database import get_db, init_db
+from m3u_utils import parse_m3u, iter_m3u, generate_m3u
+from benchmarks.m3u_generator import generate_m3u_playlist, EPG_URL
+
+UPSTREAM_PORT = 18767
+CHUNK = 64 * 1024
+MEMORY_CASES = ('parse', 'parse_stream', 'generate')
+SERVER_CASES = ('sync_initial', 'resync', 'public_render', 'public_gzip', 'public_cached')
+CASES = MEMORY_CASES + SERVER_CASES
+
+def timed(func, repeat):
+   timings = []
+   for _ in range(repeat):
+       start = time.perf_counter()
+       func()
+       timings.append(time.perf_counter() - start)
+   return timings
+
+async def timed_async(func, repeat, setup=None):
+   timings = []
+   for _ in range(repeat):
+       arg = setup() if setup else None
+       start = time.perf_counter()
+       await func(arg)
+       timings.append(time.perf_counter() - start)
+   return timings
+
+def result(case, channels, timings, **extra):
+   best = min(timings)
+   return {
+       'case': case,
+       'channels': channels,
+       'best': best,
+       'median': statistics.median(timings),
+       'repeat': len(timings),
+       'channels_per_second': channels / best if best else None,
+       **extra
+   }
+
+def in_memory_cases(count, body, repeat):
+   channels = parse_m3u(body)
+   assert len(channels) == count, f'{len(channels)} canali parsati, attesi {count}'
+   yield result('parse', count, timed(lambda: parse_m3u(body), repeat), bytes=len(body))
+   yield result(
+       'parse_stream', count,
+       timed(lambda: list(iter_m3u(body[i:i + CHUNK] for i in range(0, len(body), CHUNK))), repeat),
+       bytes=len(body)
+   )
+   yield result('generate', count, timed(lambda: generate_m3u(channels, EPG_URL), repeat))
+
+async def start_upstream(state):
+   async def handler(request):
+       return web.Response(body=state['body'], content_type='audio/x-mpegurl')
+   app = web.Application()
+   app.router.add_get('/list.m3u', handler)
+   runner = web.AppRunner(app)
+   await runner.setup()
+   await web.TCPSite(runner, '127.0.0.1', UPSTREAM_PORT).start()
+   return runner
+
+def create_playlist(name):
+   with get_db() as db:
+       return db.execute(
+           "INSERT INTO playlists (user_id, name, url, public_token) VALUES (1, ?, ?, ?)",
+           (name, f'http://127.0.0.1:{UPSTREAM_PORT}/list.m3u', name)
+       ).lastrowid
+
+def drop_playlist(playlist_id):
+   with get_db() as db:
+       db.execute("DELETE FROM channels WHERE playlist_id = ?", (playlist_id,))
+       db.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+
+async def server_cases(count, body, revised, repeat):
+   state = {'body': body}
+   upstream = await start_upstream(state)
+   playlists = []
+   try:
+       # Prima sync su una playlist vuota, ogni volta nuova
+       def new_playlist():
+           playlists.append(create_playlist(f'bench-{count}-{len(playlists)}'))
+           return playlists[-1]
+
+       async def sync(playlist_id):
+           outcome = await server.run_playlist_sync(playlist_id, 1, True)
+           assert outcome['channels_count'] == count, outcome
+
+       yield result('sync_initial', count, await timed_async(sync, repeat, new_playlist), bytes=len(body))
+
+       # Resync con un canale su dieci rinominato, alternando le due versioni
+       playlist_id = playlists[-1]
+       versions = [revised, body]
+       def next_version():
+           state['body'] = versions[0]
+           versions.reverse()
+           return playlist_id
+       yield result('resync', count, await timed_async(sync, repeat, next_version), bytes=len(body))
+
+       # Servizio pubblico attraverso tutta l'app ASGI (middleware inclusi)
+       token = f'bench-{count}-{len(playlists) - 1}'
+       transport = httpx.ASGITransport(app=server.app)
+       async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+           async def fetch(headers):
+               response = await client.get(f'/public/playlist/{token}/m3u', headers=headers)
+               assert response.status_code == 200, response.text
+               return response
+
+           max_entry = server.rendered_playlists.max_entry_bytes
+           server.rendered_playlists.max_entry_bytes = 0
+           try:
+               size = len((await fetch({'Accept-Encoding': 'identity'})).content)
+               yield result(
+                   'public_render', count,
+                   await timed_async(lambda _: fetch({'Accept-Encoding': 'identity'}), repeat), bytes=size
+               )
+               yield result(
+                   'public_gzip', count,
+                   await timed_async(lambda _: fetch({'Accept-Encoding': 'gzip'}), repeat)
+               )
+           finally:
+               server.rendered_playlists.max_entry_bytes = max_entry
+
+           await fetch({'Accept-Encoding': 'identity'})
+           yield result(
+               'public_cached', count,
+               await timed_async(lambda _: fetch({'Accept-Encoding': 'identity'}), repeat)
+           )
+   finally:
+       for playlist_id in playlists:
+           drop_playlist(playlist_id)
+       await upstream.cleanup()
+
+def git_revision():
+   try:
+       return subprocess.run(
+           ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+           cwd=os.path.dirname(os.path.abspath(__file__))
+       ).stdout.strip()
+   except (OSError, subprocess.CalledProcessError):
+       return None
+
+async def run(args):
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   generator = {
+       'density': args.density, 'extra_tags': args.extra_tags,
+       'unicode': args.unicode, 'seed': args.seed
+   }
+   wanted = set(args.cases or CASES)
+   results = []
+   for count in args.channels:
+       body = generate_m3u_playlist(count, **generator).encode('utf-8')
+       revised = generate_m3u_playlist(count, revision=1, **generator).encode('utf-8')
+       cases = []
+       if wanted & set(MEMORY_CASES):
+           cases += list(in_memory_cases(count, body, args.repeat))
+       if wanted & set(SERVER_CASES) and not args.skip_server:
+           cases += [case async for case in server_cases(count, body, revised, args.repeat)]
+       for case in cases:
+           if case['case'] not in wanted:
+               continue
+           results.append(case)
+           print(
+               f"{case['case']:<14} {count:>9,} canali  migliore {case['best'] * 1000:9.1f} ms  "
+               f"mediana {case['median'] * 1000:9.1f} ms  {case['channels_per_second']:>12,.0f} canali/s",
+               file=sys.stderr
+           )
+   return {
+       'meta': {
+           'created': datetime.now(timezone.utc).isoformat(),
+           'revision': git_revision(),
+           'python': platform.python_version(),
+           'sqlite': sqlite3.sqlite_version,
+           'platform': platform.platform(),
+           'cpus': os.cpu_count(),
+           'repeat': args.repeat,
+           'generator': generator,
+       },
+       'results': results,
+   }
+
+def compare(base, current, threshold):
+   # Codice di uscita 1 se almeno un caso è più lento oltre la soglia
+   if base['meta']['generator'] != current['meta']['generator']:
+       print('attenzione: parametri del generatore diversi, il confronto non è affidabile')
+   baseline = {(r['case'], r['channels']): r for r in base['results']}
+   regressions = 0
+   print(f"{'caso':<14} {'canali':>9} {'prima':>10} {'dopo':>10} {'diff':>8}")
+   for entry in current['results']:
+       key = (entry['case'], entry['channels'])
+       previous = baseline.get(key)
+       if previous is None:
+           continue
+       change = entry['best'] / previous['best'] - 1
+       flag = ''
+       if change > threshold:
+           flag = '  PEGGIORATO'
+           regressions += 1
+       elif change < -threshold:
+           flag = '  migliorato'
+       print(
+           f"{entry['case']:<14} {entry['channels']:>9,} {previous['best'] * 1000:8.1f}ms "
+           f"{entry['best'] * 1000:8.1f}ms {change:>+7.1%}{flag}"
+       )
+   print(f"{regressions} peggioramenti oltre il {threshold:.0%} ({base['meta']['revision']} -> {current['meta']['revision']})")
+   return 1 if regressions else 0
+
+def main():
+   parser = argparse.ArgumentParser(prog='python -m benchmarks.suite')
+   commands = parser.add_subparsers(dest='command', required=True)
+
+   run_parser = commands.add_parser('run', help='esegue i benchmark e scrive il JSON')
+   run_parser.add_argument('--channels', default='1000,10000,100000',
+                           type=lambda value: [int(n) for n in value.split(',')],
+                           help='numero di canali, separati da virgola (fino a 1000000)')
+   run_parser.add_argument('--repeat', type=int, default=3)
+   run_parser.add_argument('--density', type=float, default=1.0)
+   run_parser.add_argument('--extra-tags', type=float, default=0.25)
+   run_parser.add_argument('--unicode', type=float, default=0.1)
+   run_parser.add_argument('--seed', type=int, default=0)
+   run_parser.add_argument('--cases', type=lambda value: value.split(','), default=None,
+                           help=f"sottoinsieme di {','.join(CASES)}")
+   run_parser.add_argument('--skip-server', action='store_true',
+                           help='solo parse e generate, senza DB e server locale')
+   run_parser.add_argument('--out', help='file JSON (default: stdout)')
+
+   compare_parser = commands.add_parser('compare', help='confronta due risultati')
+   compare_parser.add_argument('base')
+   compare_parser.add_argument('current')
+   compare_parser.add_argument('--threshold', type=float, default=0.10)
+
+   args = parser.parse_args()
+   if args.command == 'compare':
+       with open(args.base) as base, open(args.current) as current:
+           return compare(json.load(base), json.load(current), args.threshold)
+
+   out = os.path.abspath(args.out) if args.out else None
+   report = asyncio.run(run(args))
+   data = json.dumps(report, indent=2)
+   if out:
+       with open(out, 'w') as f:
+           f.write(data + '\n')
+   else:
+       print(data)
+   return 0
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -0,0 +1,125 @@
+# Abbinamento automatico dei tvg_id: guida sintetica con 40k canali e
+# playlist con 10k canali dai nomi "sporchi" (prefissi di paese,
+# suffissi di qualità, maiuscole, punteggiatura, qualche refuso, un 5% di
+# canali assenti dalla guida). Misura costruzione dell'indice, proposte
+# per tutti i canali e precisione del primo candidato; con il confronto
+# di ogni coppia servirebbero 400 milioni di calcoli di similarità.
+# Infine lo stesso giro attraverso il DB: indice letto da epg_channels,
+# proposte dai canali della playlist e applicazione in una transazione.
+#
+#   cd backend && python -m benchmarks.tvg_mapping_bench [canali guida] [canali playlist]
+import os
+import random
+import sys
+import tempfile
+import time
+
+from database import get_db, init_db
+from tvg_matcher import TvgIndex, TVG_MATCH_MIN_SCORE, load_index, propose_mappings, apply_mappings
+
+SYLLABLES = [consonant + vowel for consonant in 'bcdfghjklmnprstvwz' for vowel in 'aeiou']
+# Parole comuni a molti nomi: le loro liste nell'indice sono lunghe
+GENRES = ['', '', 'TV', 'Channel', 'Sport', 'News', 'Cinema', 'Kids', 'Music', 'Doc', 'Serie', 'Life']
+COUNTRIES = ['it', 'uk', 'fr', 'de', 'es', 'us']
+PREFIXES = ['{c}: ', '|{c}| ', '[{c}] ', '{c} - ', '']
+SUFFIXES = [' HD', ' FHD', ' 4K', ' (backup)', ' HEVC', ' ᴴᴰ', '']
+
+def guide_channels(count, rng):
+   seen = set()
+   channels = []
+   while len(channels) < count:
+       brand = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+       name = ' '.join(part for part in (brand, rng.choice(GENRES), rng.choice(['', '', str(rng.randint(1, 9))])) if part)
+       country = rng.choice(COUNTRIES)
+       channel_id = f"{name.replace(' ', '')}.{country}"
+       if channel_id in seen:
+           continue
+       seen.add(channel_id)
+       channels.append((channel_id, name, country))
+   return channels
+
+def typo(name, rng):
+   i = rng.randrange(1, len(name) - 1)
+   if rng.random() < 0.5:
+       return name[:i] + name[i + 1:]
+   return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+def playlist_channels(guide, count, rng):
+   channels = []
+   for i in range(count):
+       if rng.random() < 0.05:
+           channels.append((f"Assente {i}", None))
+           continue
+       channel_id, name, country = rng.choice(guide)
+       if rng.random() < 0.1:
+           name = typo(name, rng)
+       if rng.random() < 0.3:
+           name = name.upper()
+       name = rng.choice(PREFIXES).format(c=country.upper()) + name + rng.choice(SUFFIXES)
+       channels.append((name, channel_id))
+   return channels
+
+def main():
+   guide_count = int(sys.argv[1]) if len(sys.argv) > 1 else 40_000
+   playlist_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+   rng = random.Random(0)
+   guide = guide_channels(guide_count, rng)
+   playlist = playlist_channels(guide, playlist_count, rng)
+
+   start = time.perf_counter()
+   index = TvgIndex((channel_id, name) for channel_id, name, _ in guide)
+   built = time.perf_counter() - start
+
+   start = time.perf_counter()
+   proposals = [index.match(name) for name, _ in playlist]
+   matched = time.perf_counter() - start
+
+   print(f'indice: {len(index):,} canali guida in {built:.2f} s')
+   print(f'proposte: {playlist_count:,} canali in {matched:.2f} s '
+         f'({playlist_count / matched:,.0f} canali/s, soglia {TVG_MATCH_MIN_SCORE})')
+   for threshold in (0.9, 0.75, TVG_MATCH_MIN_SCORE):
+       applied = correct = 0
+       for (name, expected), candidates in zip(playlist, proposals):
+           if candidates and candidates[0]['score'] >= threshold:
+               applied += 1
+               correct += candidates[0]['tvg_id'] == expected
+       print(f'primo candidato con punteggio >= {threshold}: {applied:,} canali, '
+             f'{correct / applied if applied else 0:.1%} corretti')
+   present = [(expected, candidates) for (_, expected), candidates in zip(playlist, proposals) if expected]
+   found = sum(any(c['tvg_id'] == expected for c in candidates) for expected, candidates in present)
+   print(f'tvg_id corretto tra i candidati: {found / len(present):.1%} dei canali presenti nella guida')
+
+   os.chdir(tempfile.mkdtemp())
+   init_db()
+   with get_db() as db:
+       source_id = db.execute(
+           "INSERT INTO epg_sources (url, last_sync) VALUES ('bench', CURRENT_TIMESTAMP)"
+       ).lastrowid
+       db.executemany(
+           "INSERT INTO epg_channels (source_id, channel_id, display_name) VALUES (?, ?, ?)",
+           ((source_id, channel_id, name) for channel_id, name, _ in guide)
+       )
+       playlist_id = db.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'bench')").lastrowid
+       db.executemany(
+           "INSERT INTO channels (playlist_id, name, url, position) VALUES (?, ?, ?, ?)",
+           ((playlist_id, name, f'http://stream.example/{i}', i) for i, (name, _) in enumerate(playlist))
+       )
+   with get_db() as db:
+       cursor = db.cursor()
+       source = cursor.execute("SELECT * FROM epg_sources WHERE id = ?", (source_id,)).fetchone()
+       start = time.perf_counter()
+       index = load_index(cursor, source)
+       proposals = propose_mappings(cursor, index, playlist_id)
+       proposed = time.perf_counter() - start
+       start = time.perf_counter()
+       updated = apply_mappings(cursor, playlist_id, (
+           (proposal['channel_id'], proposal['candidates'][0]['tvg_id'])
+           for proposal in proposals
+           if proposal['candidates'] and proposal['candidates'][0]['score'] >= 0.9
+       ))
+       db.commit()
+       applied = time.perf_counter() - start
+   print(f'dal DB: indice e proposte in {proposed:.2f} s, {updated:,} tvg_id applicati in {applied:.2f} s')
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,123 @@
+from typing import Dict, List, Optional
+
+from playlist_sync import POSITION_STEP
+
+# Spostamento di canali con posizioni distanziate: chi viene spostato
+# prende posizioni libere tra i due vicini di destinazione, gli altri
+# canali restano dove sono. Solo quando tra i vicini non c'è più spazio
+# la playlist viene rinumerata (una sola UPDATE), poi lo spostamento
+# riprende normalmente
+class MoveError(ValueError):
+    pass
+
+class ChannelNotFound(LookupError):
+    pass
+
+def order_table(playlist: Dict):
+    # Tabella e colonna chiave dell'ordinamento: per le playlist custom le
+    # posizioni stanno in custom_playlist_channels
+    if playlist['is_custom']:
+        return "custom_playlist_channels", "channel_id"
+    return "channels", "id"
+
+def next_position(cursor, playlist: Dict) -> int:
+    # Posizione per un canale aggiunto in fondo, lasciando spazio dopo
+    table, _ = order_table(playlist)
+    row = cursor.execute(
+        f"SELECT MAX(position) AS max_pos FROM {table} WHERE playlist_id = ?",
+        (playlist['id'],)
+    ).fetchone()
+    return (row['max_pos'] or 0) + POSITION_STEP
+
+def rebalance_positions(cursor, playlist: Dict, step: int = POSITION_STEP) -> int:
+    table, key = order_table(playlist)
+    cursor.execute(f"""
+        UPDATE {table} SET position = ranked.rank * ?
+        FROM (
+            SELECT {key} AS row_key,
+                   ROW_NUMBER() OVER (ORDER BY position, {key}) AS rank
+            FROM {table}
+            WHERE playlist_id = ?
+        ) AS ranked
+        WHERE {table}.playlist_id = ? AND {table}.{key} = ranked.row_key
+    """, (step, playlist['id'], playlist['id']))
+    return cursor.rowcount
+
+def _neighbours(cursor, playlist: Dict, anchor: Dict, channel_ids: List[int], after: bool):
+    # Il vicino dell'ancora dal lato dove vanno inseriti i canali, saltando
+    # quelli che si stanno spostando
+    table, key = order_table(playlist)
+    excluded = ','.join('?' * len(channel_ids))
+    op, direction = ('>', 'ASC') if after else ('<', 'DESC')
+    row = cursor.execute(f"""
+        SELECT {key} AS id, position FROM {table}
+        WHERE playlist_id = ? AND (position, {key}) {op} (?, ?)
+          AND {key} NOT IN ({excluded})
+        ORDER BY position {direction}, {key} {direction}
+        LIMIT 1
+    """, (playlist['id'], anchor['position'], anchor['id'], *channel_ids)).fetchone()
+    if after:
+        return anchor, row
+    return row, anchor
+
+def _free_positions(lower: Optional[Dict], upper: Optional[Dict], count: int) -> Optional[List[int]]:
+    if (lower and lower['position'] is None) or (upper and upper['position'] is None):
+        return None
+    if lower is None:
+        low = upper['position'] - (count + 1) * POSITION_STEP
+    else:
+        low = lower['position']
+    if upper is None:
+        high = low + (count + 1) * POSITION_STEP
+    else:
+        high = upper['position']
+    step = (high - low) // (count + 1)
+    if step < 1:
+        return None
+    return [low + step * n for n in range(1, count + 1)]
+
+def move_channels(cursor, playlist: Dict, channel_ids: List[int],
+                  before_id: Optional[int] = None, after_id: Optional[int] = None) -> Dict:
+    if (before_id is None) == (after_id is None):
+        raise MoveError("Specify exactly one of before_id or after_id")
+    if len(set(channel_ids)) != len(channel_ids):
+        raise MoveError("Duplicate channel ids")
+    anchor_id = after_id if after_id is not None else before_id
+    if anchor_id in channel_ids:
+        raise MoveError("Cannot move a channel relative to itself")
+
+    table, key = order_table(playlist)
+    wanted = [*channel_ids, anchor_id]
+    found = {
+        row['id']: row
+        for row in cursor.execute(f"""
+            SELECT {key} AS id, position FROM {table}
+            WHERE playlist_id = ? AND {key} IN ({','.join('?' * len(wanted))})
+        """, (playlist['id'], *wanted))
+    }
+    if len(found) != len(wanted):
+        raise ChannelNotFound("Channel not found")
+
+    rebalanced = False
+    while True:
+        anchor = found[anchor_id]
+        lower, upper = _neighbours(cursor, playlist, anchor, channel_ids, after_id is not None)
+        positions = _free_positions(lower, upper, len(channel_ids))
+        if positions is not None:
+            break
+        if rebalanced:
+            raise MoveError("Unable to find room for the moved channels")
+        # Spazio esaurito: rinumera con un passo che lasci posto al blocco
+        rebalance_positions(cursor, playlist, max(POSITION_STEP, 2 * (len(channel_ids) + 1)))
+        rebalanced = True
+        anchor_row = cursor.execute(
+            f"SELECT {key} AS id, position FROM {table} WHERE playlist_id = ? AND {key} = ?",
+            (playlist['id'], anchor_id)
+        ).fetchone()
+        found[anchor_id] = anchor_row
+
+    cursor.executemany(
+        f"UPDATE {table} SET position = ? WHERE playlist_id = ? AND {key} = ?",
+        [(position, playlist['id'], channel_id) for position, channel_id in zip(positions, channel_ids)]
+    )
+    return {"moved": len(channel_ids), "rebalanced": rebalanced}
@@ -0,0 +1,247 @@
+from typing import Any, Dict, List, Optional, Tuple
+import base64
+import json
+import re
+
+from stream_health import health_condition
+
+# Paginazione keyset dei canali: il cursore contiene la chiave di
+# ordinamento dell'ultima riga restituita, quindi ogni pagina parte con una
+# ricerca sull'indice invece di scorrere le righe precedenti come OFFSET
+CHANNELS_PAGE_DEFAULT = 100
+CHANNELS_PAGE_MAX = 1000
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(*values: Any) -> str:
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor("Invalid cursor")
+    return values
+
+def like_prefix(prefix: str) -> str:
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+def channel_filters(alias: str, group_title: Optional[str] = None,
+                    name_prefix: Optional[str] = None,
+                    has_tvg_id: Optional[bool] = None,
+                    health: Optional[str] = None) -> Tuple[List[str], List[Any]]:
+    clauses = []
+    params = []
+    if group_title is not None:
+        clauses.append(f"{alias}.group_title = ?")
+        params.append(group_title)
+    if name_prefix:
+        clauses.append(f"{alias}.name LIKE ? ESCAPE '\\'")
+        params.append(like_prefix(name_prefix))
+    if has_tvg_id is not None:
+        op = "!=" if has_tvg_id else "="
+        clauses.append(f"COALESCE({alias}.tvg_id, '') {op} ''")
+    if health is not None:
+        clause, clause_params = health_condition(alias, health)
+        clauses.append(clause)
+        params.extend(clause_params)
+    return clauses, params
+
+def fetch_channel_page(cursor, playlist: Dict, limit: int,
+                       after: Optional[str] = None, **filters) -> Dict:
+    # Playlist normali ordinate per (position, id) su channels, custom per
+    # (position, channel_id) su custom_playlist_channels
+    if playlist['is_custom']:
+        source = """
+            SELECT c.id, c.playlist_id, c.name, c.url, c.group_title, c.logo_url,
+                   c.tvg_id, cpc.position AS position, c.extra_tags, c.created_at
+            FROM custom_playlist_channels cpc
+            JOIN channels c ON c.id = cpc.channel_id
+            WHERE cpc.playlist_id = ?
+        """
+        key = ("cpc.position", "cpc.channel_id")
+    else:
+        source = """
+            SELECT c.*
+            FROM channels c
+            WHERE c.playlist_id = ?
+        """
+        key = ("c.position", "c.id")
+
+    clauses, params = channel_filters('c', **filters)
+    if after is not None:
+        clauses.append(f"({key[0]}, {key[1]}) > (?, ?)")
+        params.extend(decode_cursor(after, 2))
+
+    query = source + ''.join(f" AND {clause}" for clause in clauses)
+    query += f" ORDER BY {key[0]}, {key[1]} LIMIT ?"
+    rows = cursor.execute(query, (playlist['id'], *params, limit + 1)).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last['position'], last['id'])
+    return {"channels": rows, "next_cursor": next_cursor, "limit": limit}
+
+# Ricerca full-text (channels_fts): ogni parola cercata è un prefisso e
+# tutte devono comparire in nome, gruppo o tvg_id. FTS5 restituisce tutte
+# le corrispondenze già ordinate per rank (bm25), senza ordinamenti dopo
+# il join: i canali si leggono in quell'ordine e ci si ferma al limite,
+# saltando quelli di altri utenti o di altre playlist
+SEARCH_DEFAULT = 50
+SEARCH_MAX = 200
+SEARCH_MAX_TERMS = 8
+_SEARCH_TERM_RE = re.compile(r'\w+')
+
+def fts_match_query(text: str) -> Optional[str]:
+    terms = _SEARCH_TERM_RE.findall(text)[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def search_channels_query(user_id: int, match: str, limit: int,
+                          playlist_id: Optional[int] = None) -> Tuple[str, List[Any]]:
+    params = [match, user_id]
+    playlist_filter = ""
+    if playlist_id is not None:
+        playlist_filter = "AND c.playlist_id = ?"
+        params.append(playlist_id)
+    params.append(limit)
+    return f"""
+        SELECT c.*, p.name AS source_playlist_name
+        FROM (
+            SELECT rowid AS id, rank FROM channels_fts
+            WHERE channels_fts MATCH ?
+            ORDER BY rank
+        ) AS matches
+        JOIN channels c ON c.id = matches.id
+        JOIN playlists p ON p.id = c.playlist_id
+        WHERE p.user_id = ? {playlist_filter}
+        ORDER BY matches.rank
+        LIMIT ?
+    """, params
+
+def search_channels(cursor, user_id: int, text: str, limit: int,
+                    playlist_id: Optional[int] = None) -> List[Dict]:
+    match = fts_match_query(text)
+    if match is None:
+        return []
+    return cursor.execute(*search_channels_query(user_id, match, limit, playlist_id)).fetchall()
+
+# Canali aggiungibili a una playlist custom: tutti i canali delle playlist
+# dell'utente che non ci sono già, ordinati per (nome playlist, id playlist,
+# position, id). Ogni pagina è al massimo due letture in ordine d'indice:
+# il resto della playlist sorgente dell'ultima riga, poi le playlist
+# successive. L'esclusione è un NOT EXISTS sulla chiave primaria di
+# custom_playlist_channels, una ricerca puntuale per canale
+AVAILABLE_EXCLUDED = """
+    NOT EXISTS (
+        SELECT 1 FROM custom_playlist_channels cpc
+        WHERE cpc.playlist_id = ? AND cpc.channel_id = c.id
+    )
+"""
+AVAILABLE_ORDER = " ORDER BY p.name, p.id, c.position, c.id LIMIT ?"
+
+# Con una ricerca si parte dall'indice full-text se le corrispondenze sono
+# poche (si ordinano solo quelle); se sono molte conviene scorrere i canali
+# in ordine, la pagina si riempie presto
+AVAILABLE_SEARCH_SORT_MAX = 5000
+
+def available_channels_query(user_id: int, custom_playlist_id: int,
+                             source_playlist_id: Optional[int] = None,
+                             group_title: Optional[str] = None,
+                             health: Optional[str] = None,
+                             match: Optional[str] = None,
+                             search_first: bool = False) -> Tuple[str, List[Any]]:
+    clauses, params = channel_filters('c', group_title=group_title, health=health)
+    if source_playlist_id is not None:
+        clauses.append("p.id = ?")
+        params.append(source_playlist_id)
+
+    if match is not None and search_first:
+        query = f"""
+            SELECT c.*, p.name AS source_playlist_name
+            FROM channels_fts
+            JOIN channels c ON c.id = channels_fts.rowid
+            JOIN playlists p ON p.id = c.playlist_id
+            WHERE channels_fts MATCH ? AND p.user_id = ? AND {AVAILABLE_EXCLUDED}
+        """
+        params = [match, user_id, custom_playlist_id, *params]
+    else:
+        query = f"""
+            SELECT c.*, p.name AS source_playlist_name
+            FROM playlists p
+            JOIN channels c ON c.playlist_id = p.id
+            WHERE p.user_id = ? AND {AVAILABLE_EXCLUDED}
+        """
+        params = [user_id, custom_playlist_id, *params]
+        if match is not None:
+            clauses.append("c.id IN (SELECT rowid FROM channels_fts WHERE channels_fts MATCH ?)")
+            params.append(match)
+    return query + ''.join(f" AND {clause}" for clause in clauses), params
+
+def count_search_matches(cursor, match: str, cap: int) -> int:
+    return cursor.execute(
+        """SELECT COUNT(*) AS count FROM (
+               SELECT rowid FROM channels_fts WHERE channels_fts MATCH ? LIMIT ?
+           )""",
+        (match, cap)
+    ).fetchone()['count']
+
+def fetch_available_page(cursor, user_id: int, custom_playlist_id: int, limit: int,
+                         after: Optional[str] = None, search: Optional[str] = None,
+                         **filters) -> Dict:
+    key = decode_cursor(after, 4) if after is not None else None
+    match = None
+    search_first = False
+    if search is not None:
+        match = fts_match_query(search)
+        if match is None:
+            return {"channels": [], "next_cursor": None, "limit": limit}
+        search_first = count_search_matches(
+            cursor, match, AVAILABLE_SEARCH_SORT_MAX
+        ) < AVAILABLE_SEARCH_SORT_MAX
+    query, params = available_channels_query(
+        user_id, custom_playlist_id, match=match, search_first=search_first, **filters
+    )
+
+    if search_first:
+        keyset = ""
+        if key is not None:
+            keyset = " AND (p.name, p.id, c.position, c.id) > (?, ?, ?, ?)"
+            params.extend(key)
+        rows = cursor.execute(query + keyset + AVAILABLE_ORDER, (*params, limit + 1)).fetchall()
+    else:
+        rows = []
+        later = ""
+        later_params = []
+        if key is not None:
+            playlist_name, playlist_id, position, channel_id = key
+            rows = cursor.execute(
+                query + " AND p.id = ? AND (c.position, c.id) > (?, ?)"
+                        " ORDER BY c.position, c.id LIMIT ?",
+                (*params, playlist_id, position, channel_id, limit + 1)
+            ).fetchall()
+            later = " AND (p.name, p.id) > (?, ?)"
+            later_params = [playlist_name, playlist_id]
+        if len(rows) <= limit:
+            rows += cursor.execute(
+                query + later + AVAILABLE_ORDER,
+                (*params, *later_params, limit + 1 - len(rows))
+            ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            last['source_playlist_name'], last['playlist_id'], last['position'], last['id']
+        )
+    return {"channels": rows, "next_cursor": next_cursor, "limit": limit}
@@ -1,12 +1,22 @@
 import sqlite3
 from sqlite3 import Connection
 import json
+import gzip
 import shutil
-from typing import Optional
+from typing import Optional, List, Dict, Tuple, Iterable, Sequence, Callable, TypeVar
 from pathlib import Path
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 from passlib.hash import bcrypt
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import asyncio
+import time
+import sys
+import os
+
+import metrics
 
 DATABASE_PATH = Path("data/playlists.db")
 BACKUP_PATH = Path("data/backups")
@@ -18,40 +28,436 @@ def dict_factory(cursor, row):
 sqlite3.register_adapter(dict, json.dumps)
 sqlite3.register_converter("JSON", json.loads)
 
-def create_backup():
-    BACKUP_PATH.mkdir(exist_ok=True)
+# Backup con l'API di backup di SQLite: la connessione sorgente tiene
+# aperta una transazione di lettura, così la copia è una fotografia
+# coerente (WAL compreso) e non riparte quando altri scrivono. Le pagine
+# vengono copiate a blocchi con una pausa tra l'uno e l'altro per non
+# saturare il disco; le scritture concorrenti proseguono intanto nel WAL
+BACKUP_KEEP = 5
+BACKUP_STEP_PAGES = 1024
+BACKUP_STEP_PAUSE = 0.002
+
+class BackupError(Exception):
+    pass
+
+def list_backups() -> List[Path]:
+    return sorted(
+        path for path in BACKUP_PATH.glob("playlist_backup_*")
+        if path.name.endswith(('.db', '.db.gz'))
+    )
+
+def verify_backup(path: Path):
+    # Verifica di ripristino: la copia deve aprirsi ed essere integra
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        conn.execute("SELECT COUNT(*) FROM playlists").fetchone()
+    except sqlite3.Error as e:
+        raise BackupError(f"Backup verification failed: {e}")
+    finally:
+        conn.close()
+    if result != 'ok':
+        raise BackupError(f"Backup verification failed: {result}")
+
+def create_backup(compress: bool = False, verify: bool = True) -> Path:
+    BACKUP_PATH.mkdir(parents=True, exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_file = BACKUP_PATH / f"playlist_backup_{timestamp}.db"
-    shutil.copy2(DATABASE_PATH, backup_file)
+    partial = backup_file.with_name(backup_file.name + ".partial")
 
-    # Mantieni solo gli ultimi 5 backup
-    backups = sorted(BACKUP_PATH.glob("playlist_backup_*.db"))
-    if len(backups) > 5:
-        for backup in backups[:-5]:
-            backup.unlink()
+    source = sqlite3.connect(DATABASE_PATH, timeout=10, isolation_level=None)
+    target = sqlite3.connect(partial)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        source.backup(
+            target, pages=BACKUP_STEP_PAGES,
+            progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_PAUSE)
+        )
+        source.execute("COMMIT")
+        # La copia è un file singolo, senza -wal accanto
+        target.execute("PRAGMA journal_mode = DELETE")
+    except BaseException:
+        target.close()
+        partial.unlink(missing_ok=True)
+        raise
+    finally:
+        source.close()
+    target.close()
 
-@contextmanager
-def get_db() -> Connection:
+    try:
+        if verify:
+            verify_backup(partial)
+        if compress:
+            backup_file = backup_file.with_name(backup_file.name + ".gz")
+            with open(partial, 'rb') as raw, gzip.open(backup_file, 'wb', compresslevel=6) as packed:
+                shutil.copyfileobj(raw, packed, 1024 * 1024)
+            partial.unlink()
+        else:
+            partial.replace(backup_file)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+    # Mantieni solo gli ultimi BACKUP_KEEP backup
+    backups = list_backups()
+    for backup in backups[:-BACKUP_KEEP]:
+        backup.unlink()
+    return backup_file
+
+# Pool di connessioni: ogni connessione viene aperta e configurata una
+# volta sola e poi riutilizzata dalle richieste successive
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_CACHE_SIZE_KB = 16 * 1024
+DB_MMAP_SIZE = 256 * 2**20
+DB_HEALTH_CHECK_IDLE = 30
+
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
+
+def connect() -> Connection:
     DATABASE_PATH.parent.mkdir(exist_ok=True)
     conn = sqlite3.connect(
         str(DATABASE_PATH),
         detect_types=sqlite3.PARSE_DECLTYPES,
         timeout=10.0,
-        isolation_level='IMMEDIATE'
+        isolation_level='IMMEDIATE',
+        # Una connessione è usata da un solo thread alla volta
+        check_same_thread=False
     )
     conn.row_factory = dict_factory
-    
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    def __init__(self, max_idle: int = DB_POOL_SIZE,
+                 health_check_idle: float = DB_HEALTH_CHECK_IDLE):
+        self.max_idle = max_idle
+        self.health_check_idle = health_check_idle
+        self._idle: List[Tuple[Connection, float]] = []
+        self._lock = threading.Lock()
+        self._path: Optional[str] = None
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.health_check_failures = 0
+
+    def acquire(self) -> Connection:
+        path = os.path.abspath(DATABASE_PATH)
+        with self._lock:
+            stale = []
+            if path != self._path:
+                # Database spostato (test, benchmark): le connessioni vecchie non servono più
+                stale, self._idle, self._path = self._idle, [], path
+            idle = self._idle.pop() if self._idle else None
+            self.in_use += 1
+        for conn, _ in stale:
+            self._close(conn)
+
+        try:
+            if idle is not None:
+                conn, released_at = idle
+                if time.monotonic() - released_at < self.health_check_idle or self._healthy(conn):
+                    with self._lock:
+                        self.reused += 1
+                    return conn
+            conn = connect()
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+            raise
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def release(self, conn: Connection, broken: bool = False):
+        if not broken and conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+        conn.row_factory = dict_factory
+
+        with self._lock:
+            self.in_use -= 1
+            if not broken and len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._close(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "max_idle": self.max_idle,
+                "created": self.created,
+                "reused": self.reused,
+                "discarded": self.discarded,
+                "health_check_failures": self.health_check_failures,
+            }
+
+    def _healthy(self, conn: Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            with self._lock:
+                self.health_check_failures += 1
+            self._close(conn)
+            return False
+
+    def _close(self, conn: Connection):
+        with self._lock:
+            self.discarded += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+db_pool = ConnectionPool()
+
+@contextmanager
+def get_db() -> Connection:
+    conn = db_pool.acquire()
+    broken = False
+    checked_out = time.perf_counter()
     try:
         yield conn
     except Exception as e:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            broken = True
         raise e
     else:
+        # Solo il commit: il lock di scrittura è già stato preso al BEGIN
+        # IMMEDIATE implicito della prima scrittura
+        commit_start = time.perf_counter()
         conn.commit()
+        metrics.DB_COMMIT_SECONDS.observe(time.perf_counter() - commit_start)
     finally:
-        conn.close()
+        db_pool.release(conn, broken)
+        metrics.DB_SESSION_SECONDS.observe(time.perf_counter() - checked_out)
+
+def begin_immediate(cursor):
+    # Transazione esplicita che prende subito il lock di scrittura,
+    # misurando l'attesa (al massimo il timeout della connessione)
+    start = time.perf_counter()
+    cursor.execute("BEGIN IMMEDIATE")
+    metrics.DB_WRITE_LOCK_SECONDS.observe(time.perf_counter() - start)
+
+# Le query girano su un pool di thread dedicato, mai sull'event loop:
+# un lock in attesa (fino a timeout=10s) o una query lenta bloccano solo
+# il proprio thread e non le altre richieste
+DB_THREADS = int(os.getenv('DB_THREADS', str(DB_POOL_SIZE)))
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+
+T = TypeVar('T')
+
+def _timed_db_call(submitted: float, func: Callable[..., T], *args, **kwargs) -> T:
+    start = time.perf_counter()
+    metrics.DB_QUEUE_SECONDS.observe(start - submitted)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.DB_CALL_SECONDS.observe(time.perf_counter() - start)
+
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        db_executor, functools.partial(_timed_db_call, time.perf_counter(), func, *args, **kwargs)
+    )
+
+class DBSession:
+    # get_db per il codice asincrono che tiene la connessione tra più await
+    # (sync da provider): acquisizione, commit e rilascio girano sui thread
+    # del DB come le query. Le chiamate sono protette dalla cancellazione:
+    # se il task viene annullato mentre un thread usa la connessione, il
+    # rilascio aspetta che il thread abbia finito
+    def __init__(self):
+        self._stack = ExitStack()
+        self._pending: Optional[asyncio.Future] = None
+        self.conn: Optional[Connection] = None
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        self._pending = asyncio.ensure_future(run_db(func, *args, **kwargs))
+        return await asyncio.shield(self._pending)
+
+    async def enter_context(self, cm):
+        # Context manager sulla connessione (pragma), chiuso prima del commit
+        return await self.run(self._stack.enter_context, cm)
+
+    async def __aenter__(self) -> 'DBSession':
+        try:
+            self.conn = await self.run(self._stack.enter_context, get_db())
+        except asyncio.CancelledError:
+            await self.__aexit__(*sys.exc_info())
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        pending = self._pending
+        if pending is not None and not pending.done():
+            pending.add_done_callback(
+                lambda _: db_executor.submit(self._stack.__exit__, exc_type, exc, tb)
+            )
+            return False
+        await self.run(self._stack.__exit__, exc_type, exc, tb)
+        return False
+
+# Caricamenti massivi (sync di playlist grandi)
+BULK_CACHE_SIZE_KB = 64 * 1024
+
+@contextmanager
+def bulk_load_pragmas(conn: Connection):
+    # Cache più grande per la durata del caricamento, poi si ripristina
+    # quella del pool. synchronous resta NORMAL come su ogni connessione:
+    # in WAL l'fsync avviene solo al checkpoint
+    previous = conn.execute("PRAGMA cache_size").fetchone()['cache_size']
+    conn.execute(f"PRAGMA cache_size = -{BULK_CACHE_SIZE_KB}")
+    try:
+        yield conn
+    finally:
+        conn.execute(f"PRAGMA cache_size = {previous}")
+
+@contextmanager
+def disk_temp_store(conn: Connection):
+    # Tabelle temporanee su file invece che in memoria, per appoggiare
+    # dati più grandi della RAM (guide EPG). Da applicare fuori da una
+    # transazione; tornando a MEMORY SQLite elimina le tabelle temporanee
+    conn.execute("PRAGMA temp_store = FILE")
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+def bulk_insert(cursor, sql: str, rows: Iterable[Sequence]) -> int:
+    # executemany consuma direttamente il generatore: nessuna lista intermedia
+    cursor.executemany(sql, rows)
+    return max(cursor.rowcount, 0)
 
-def init_db():
+CHANNELS_FTS_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS channels_fts_insert AFTER INSERT ON channels BEGIN
+        INSERT INTO channels_fts(rowid, name, group_title, tvg_id)
+        VALUES (new.id, new.name, new.group_title, new.tvg_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS channels_fts_delete AFTER DELETE ON channels BEGIN
+        INSERT INTO channels_fts(channels_fts, rowid, name, group_title, tvg_id)
+        VALUES ('delete', old.id, old.name, old.group_title, old.tvg_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS channels_fts_update
+    AFTER UPDATE OF name, group_title, tvg_id ON channels
+    WHEN old.name IS NOT new.name OR old.group_title IS NOT new.group_title
+        OR old.tvg_id IS NOT new.tvg_id
+    BEGIN
+        INSERT INTO channels_fts(channels_fts, rowid, name, group_title, tvg_id)
+        VALUES ('delete', old.id, old.name, old.group_title, old.tvg_id);
+        INSERT INTO channels_fts(rowid, name, group_title, tvg_id)
+        VALUES (new.id, new.name, new.group_title, new.tvg_id);
+    END""",
+)
+
+def suspend_search_indexing(cursor) -> List[str]:
+    # FTS5 scarica le scritture in sospeso a ogni istruzione, quindi un
+    # trigger per riga dentro executemany crea un segmento per canale. Nei
+    # caricamenti della sync si sospendono i trigger di INSERT e UPDATE e
+    # l'indice si aggiorna con index_channels_for_search/
+    # unindex_channels_for_search, un'istruzione per blocco di righe.
+    # Come per drop_indexes, se la transazione viene annullata i trigger tornano
+    cursor.execute("DROP TRIGGER IF EXISTS channels_fts_insert")
+    cursor.execute("DROP TRIGGER IF EXISTS channels_fts_update")
+    return [CHANNELS_FTS_TRIGGERS[0], CHANNELS_FTS_TRIGGERS[2]]
+
+@contextmanager
+def search_indexing_suspended(cursor):
+    # Trigger sospesi solo per la durata della scrittura massiva, dentro la
+    # sua transazione (DROP TRIGGER prende il lock di scrittura). Se la
+    # scrittura fallisce non si ricreano: li riporta il rollback
+    triggers = suspend_search_indexing(cursor)
+    yield
+    rebuild_indexes(cursor, triggers)
+
+def index_channels_for_search(cursor, condition: str, params: Sequence = ()):
+    cursor.execute(
+        f"""INSERT INTO channels_fts(rowid, name, group_title, tvg_id)
+            SELECT id, name, group_title, tvg_id FROM channels WHERE {condition}""",
+        params
+    )
+
+def unindex_channels_for_search(cursor, condition: str, params: Sequence = ()):
+    # Va chiamata prima di modificare le righe: l'indice a contenuto
+    # esterno rimuove i termini a partire dai valori attuali
+    cursor.execute(
+        f"""INSERT INTO channels_fts(channels_fts, rowid, name, group_title, tvg_id)
+            SELECT 'delete', id, name, group_title, tvg_id FROM channels WHERE {condition}""",
+        params
+    )
+
+def drop_indexes(cursor, table: str) -> List[str]:
+    # Sospende la manutenzione degli indici durante un caricamento molto
+    # grande; restituisce le istruzioni per ricrearli con rebuild_indexes.
+    # Se la transazione viene annullata gli indici tornano da soli
+    indexes = cursor.execute(
+        """SELECT name, sql FROM sqlite_master
+           WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL""",
+        (table,)
+    ).fetchall()
+    for index in indexes:
+        cursor.execute(f'DROP INDEX "{index["name"]}"')
+    return [index['sql'] for index in indexes]
+
+def rebuild_indexes(cursor, statements: Iterable[str]):
+    for statement in statements:
+        cursor.execute(statement)
+
+def ensure_column(cursor, table: str, column: str, definition: str) -> bool:
+    # Migrazione minima per i database creati con versioni precedenti;
+    # True se la colonna è stata appena aggiunta
+    columns = {row['name'] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+    return False
+
+def touch_playlists(cursor, playlist_id: int) -> List[int]:
+    # Nuova versione del contenuto per la playlist e per le playlist custom
+    # che ne usano i canali: invalida output renderizzati ed ETag
+    playlist_ids = [playlist_id]
+    for row in cursor.execute("""
+        SELECT DISTINCT cpc.playlist_id
+        FROM custom_playlist_channels cpc
+        JOIN channels c ON c.id = cpc.channel_id
+        WHERE c.playlist_id = ? AND cpc.playlist_id != ?
+    """, (playlist_id, playlist_id)).fetchall():
+        playlist_ids.append(row['playlist_id'])
+
+    cursor.executemany(
+        """UPDATE playlists
+           SET content_version = content_version + 1,
+               content_updated_at = CURRENT_TIMESTAMP
+           WHERE id = ?""",
+        [(pid,) for pid in playlist_ids]
+    )
+    return playlist_ids
+
+def init_db(admin_password_hash: Optional[str] = None):
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('PRAGMA journal_mode=WAL')
@@ -76,15 +482,46 @@ def init_db():
                 public_token TEXT UNIQUE,
                 epg_url TEXT,
                 last_sync TIMESTAMP,
+                sync_identity TEXT NOT NULL DEFAULT 'url',
+                sync_interval INTEGER,
+                content_version INTEGER NOT NULL DEFAULT 0,
+                content_updated_at TIMESTAMP,
+                upstream_etag TEXT,
+                upstream_last_modified TEXT,
+                upstream_digest TEXT,
+                upstream_epg_url TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
         """)
 
+        ensure_column(cursor, "playlists", "content_version", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(cursor, "playlists", "content_updated_at", "TIMESTAMP")
+        ensure_column(cursor, "playlists", "sync_identity", "TEXT NOT NULL DEFAULT 'url'")
+        ensure_column(cursor, "playlists", "sync_interval", "INTEGER")
+        ensure_column(cursor, "playlists", "upstream_etag", "TEXT")
+        ensure_column(cursor, "playlists", "upstream_last_modified", "TEXT")
+        ensure_column(cursor, "playlists", "upstream_digest", "TEXT")
+        if ensure_column(cursor, "playlists", "upstream_epg_url", "TEXT"):
+            # x-tvg-url dell'header M3U: prima era solo negli extra_tags di
+            # un canale, che dopo spostamenti e riordini può non essere il
+            # primo
+            cursor.execute("""
+                UPDATE playlists SET upstream_epg_url = (
+                    SELECT json_extract(extra_tags, '$.epg_url') FROM channels
+                    WHERE playlist_id = playlists.id
+                      AND json_extract(extra_tags, '$.epg_url') IS NOT NULL
+                    LIMIT 1
+                )
+            """)
+
+        # Playlist dell'utente in ordine di nome (elenco dei canali
+        # aggiungibili); copre anche le ricerche per solo user_id
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_playlists_user_id 
-            ON playlists(user_id)
+            CREATE INDEX IF NOT EXISTS idx_playlists_user_name
+            ON playlists(user_id, name)
         """)
+        cursor.execute("DROP INDEX IF EXISTS idx_playlists_user_id")
 
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS channels (
@@ -103,10 +540,22 @@ def init_db():
             )
         """)
 
+        # Ordine di lettura dei canali (position, id): l'id è il rowid, che
+        # SQLite aggiunge già in coda a ogni indice. Rende superfluo il
+        # vecchio indice sul solo playlist_id
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_channels_playlist_position
+            ON channels(playlist_id, position)
+        """)
+        cursor.execute("DROP INDEX IF EXISTS idx_channels_playlist_id")
+
+        # Filtro per gruppo nella paginazione e conteggi per playlist
+        # (canali e gruppi) senza leggere le righe
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_channels_playlist_id 
-            ON channels(playlist_id)
+            CREATE INDEX IF NOT EXISTS idx_channels_playlist_group_position
+            ON channels(playlist_id, group_title, position)
         """)
+        cursor.execute("DROP INDEX IF EXISTS idx_channels_playlist_group")
 
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS custom_playlist_channels (
@@ -122,6 +571,122 @@ def init_db():
             )
         """)
 
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_custom_playlist_channels_channel_id 
+            ON custom_playlist_channels(channel_id)
+        """)
+
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_custom_playlist_channels_position
+            ON custom_playlist_channels(playlist_id, position, channel_id)
+        """)
+
+        # Ricerca full-text sui canali: tabella FTS5 a contenuto esterno
+        # (i testi restano solo in channels) tenuta allineata dai trigger.
+        # Gli aggiornamenti di posizione, logo o url non toccano l'indice
+        fts_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'channels_fts'"
+        ).fetchone()
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5(
+                name, group_title, tvg_id,
+                content='channels', content_rowid='id',
+                tokenize="unicode61 remove_diacritics 2",
+                prefix='2 3'
+            )
+        """)
+        for statement in CHANNELS_FTS_TRIGGERS:
+            cursor.execute(statement)
+        if not fts_exists:
+            # Pesi bm25: nome, gruppo, tvg_id
+            cursor.execute(
+                "INSERT INTO channels_fts(channels_fts, rank) VALUES('rank', 'bm25(10.0, 2.0, 5.0)')"
+            )
+            cursor.execute("INSERT INTO channels_fts(channels_fts) VALUES('rebuild')")
+
+        # Guide EPG (XMLTV), condivise tra le playlist con lo stesso URL.
+        # Orari in secondi Unix UTC; epg_windows tiene il digest di ogni
+        # finestra per canale, così le resync riscrivono solo quelle cambiate
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS epg_sources (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL UNIQUE,
+                upstream_etag TEXT,
+                upstream_last_modified TEXT,
+                last_sync TIMESTAMP,
+                channels_count INTEGER NOT NULL DEFAULT 0,
+                programmes_count INTEGER NOT NULL DEFAULT 0,
+                max_programme_seconds INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS epg_channels (
+                source_id INTEGER NOT NULL,
+                channel_id TEXT NOT NULL,
+                display_name TEXT,
+                icon TEXT,
+                PRIMARY KEY (source_id, channel_id),
+                FOREIGN KEY (source_id) REFERENCES epg_sources (id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS epg_programmes (
+                id INTEGER PRIMARY KEY,
+                source_id INTEGER NOT NULL,
+                channel_id TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                stop INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                subtitle TEXT,
+                description TEXT,
+                category TEXT,
+                icon TEXT,
+                episode TEXT,
+                FOREIGN KEY (source_id) REFERENCES epg_sources (id) ON DELETE CASCADE
+            )
+        """)
+        # now/next e intervalli: ricerca per canale e orario di inizio
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_epg_programmes_channel_start
+            ON epg_programmes(source_id, channel_id, start)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS epg_windows (
+                source_id INTEGER NOT NULL,
+                channel_id TEXT NOT NULL,
+                window_start INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                programmes INTEGER NOT NULL,
+                PRIMARY KEY (source_id, channel_id, window_start),
+                FOREIGN KEY (source_id) REFERENCES epg_sources (id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        """)
+
+        # Esito dell'ultimo controllo di ogni stream: una riga per canale,
+        # orari in secondi Unix. failures conta i controlli falliti di
+        # seguito; un nuovo URL riparte da "non controllato"
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS channel_health (
+                channel_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                http_status INTEGER,
+                latency_ms INTEGER,
+                checked_at INTEGER NOT NULL,
+                last_ok INTEGER,
+                failures INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (channel_id) REFERENCES channels (id) ON DELETE CASCADE
+            )
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS channel_health_url_update
+            AFTER UPDATE OF url ON channels
+            WHEN old.url IS NOT new.url
+            BEGIN
+                DELETE FROM channel_health WHERE channel_id = new.id;
+            END
+        """)
+
         # Verifica admin user
         admin_exists = cursor.execute(
             "SELECT 1 FROM users WHERE username = ?", 
@@ -129,25 +694,12 @@ def init_db():
         ).fetchone()
 
         if not admin_exists:
-            password_hash = bcrypt.hash("admin")
+            # L'app passa lo hash calcolato con auth.hash_password, fuori
+            # dall'event loop; gli script senza loop lo calcolano qui
             cursor.execute(
                 "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                ("admin", password_hash)
+                ("admin", admin_password_hash or bcrypt.hash("admin"))
             )
 
-def verify_password(username: str, password: str) -> bool:
-    try:
-        with get_db() as conn:
-            user = conn.execute(
-                "SELECT password_hash FROM users WHERE username = ?",
-                (username,)
-            ).fetchone()
-            
-            if user and bcrypt.verify(password, user['password_hash']):
-                return True
-    except Exception as e:
-        print(f"Password verification error: {str(e)}")
-    return False
-
 if __name__ == "__main__":
     init_db()
\ No newline at end of file
@@ -0,0 +1,497 @@
+from typing import Dict, List, Optional, Tuple
+import xml.etree.ElementTree as ET
+import functools
+import calendar
+import hashlib
+import sqlite3
+import zlib
+import re
+import os
+
+from database import begin_immediate, bulk_insert
+
+# Guide XMLTV: i file dei provider vanno da 100 MB a 1 GB, quindi vengono
+# letti in streaming (anche se compressi con gzip) e ogni elemento viene
+# scartato appena letto. I programmi passano da una tabella temporanea
+# su disco e vengono confrontati con quelli salvati per finestre di
+# EPG_WINDOW_SECONDS per canale: si riscrivono solo le finestre cambiate.
+# Gli orari sono secondi Unix in UTC
+EPG_WINDOW_SECONDS = 6 * 3600
+# Programmi senza stop: durano fino al successivo, o al massimo questo
+EPG_DEFAULT_PROGRAMME_SECONDS = 3600
+# Finestre riscritte per transazione: il lock di scrittura resta breve
+EPG_APPLY_WINDOWS = 500
+# Limite sui byte decompressi, contro file anomali o gzip bomb
+EPG_MAX_BYTES = int(os.getenv('EPG_MAX_BYTES', str(4 * 2**30)))
+
+PROGRAMME_COLUMNS = "channel_id, start, stop, title, subtitle, description, category, icon, episode"
+
+class EPGError(ValueError):
+    pass
+
+# Decompressione gzip riconosciuta dai primi byte (i file .xml.gz spesso
+# arrivano senza Content-Encoding); anche gzip a più membri
+class GzipAwareDecoder:
+    def __init__(self, max_bytes: int = EPG_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.decoded = 0
+        self._head = b''
+        self._gzip: Optional[bool] = None
+        self._decompressor = None
+
+    def decode(self, data: bytes) -> bytes:
+        self.received += len(data)
+        if self._gzip is None:
+            self._head += data
+            if len(self._head) < 2:
+                return b''
+            data, self._head = self._head, b''
+            self._gzip = data[:2] == b'\x1f\x8b'
+            if self._gzip:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if self._gzip:
+            output = []
+            while data:
+                output.append(self._decompressor.decompress(data))
+                data = b''
+                if self._decompressor.eof:
+                    data = self._decompressor.unused_data
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = b''.join(output)
+
+        self.decoded += len(data)
+        if self.decoded > self.max_bytes:
+            raise EPGError(f"EPG larger than {self.max_bytes} bytes")
+        return data
+
+    def close(self) -> bytes:
+        data, self._head = self._head, b''
+        if self._gzip is None and data:
+            return data
+        return b''
+
+_TIME_RE = re.compile(r'(\d{4})(\d\d)(\d\d)(\d\d)?(\d\d)?(\d\d)?\s*(?:([+-])(\d\d):?(\d\d))?')
+
+# Gli stessi orari si ripetono (lo stop di un programma è lo start del
+# successivo, i palinsesti iniziano alle stesse ore): conviene la cache
+@functools.lru_cache(maxsize=16384)
+def parse_xmltv_time(value: Optional[str]) -> Optional[int]:
+    # "20240131203000 +0100"; senza fuso si assume UTC
+    if not value:
+        return None
+    match = _TIME_RE.match(value.strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+    timestamp = calendar.timegm((
+        int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0)
+    ))
+    if sign:
+        offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        timestamp += -offset if sign == '+' else offset
+    return timestamp
+
+def _text(element) -> Optional[str]:
+    text = element.text
+    if text:
+        text = text.strip()
+    return text or None
+
+class XMLTVStreamParser:
+    # Parser incrementale (XMLPullParser): ogni <channel> e <programme>
+    # viene convertito in tupla e poi rimosso dalla radice, così la
+    # memoria non cresce con il file
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._root = None
+        self.skipped = 0
+
+    def feed(self, data: bytes) -> Tuple[List[Tuple], List[Tuple]]:
+        try:
+            self._parser.feed(data)
+        except ET.ParseError as e:
+            raise EPGError(f"Invalid XMLTV: {e}")
+        return self._read_events()
+
+    def close(self) -> Tuple[List[Tuple], List[Tuple]]:
+        try:
+            self._parser.close()
+        except ET.ParseError as e:
+            raise EPGError(f"Invalid XMLTV: {e}")
+        return self._read_events()
+
+    def _read_events(self):
+        channels = []
+        programmes = []
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = element
+                continue
+
+            tag = element.tag
+            if tag == 'programme':
+                programme = self._programme(element)
+                if programme is None:
+                    self.skipped += 1
+                else:
+                    programmes.append(programme)
+            elif tag == 'channel':
+                channel_id = element.get('id')
+                if channel_id:
+                    display_name = icon = None
+                    for child in element:
+                        if child.tag == 'display-name' and display_name is None:
+                            display_name = _text(child)
+                        elif child.tag == 'icon' and icon is None:
+                            icon = child.get('src')
+                    channels.append((channel_id, display_name, icon))
+            else:
+                continue
+            self._root.clear()
+        return channels, programmes
+
+    @staticmethod
+    def _programme(element) -> Optional[Tuple]:
+        channel_id = element.get('channel')
+        start = parse_xmltv_time(element.get('start'))
+        if not channel_id or start is None:
+            return None
+        stop = parse_xmltv_time(element.get('stop'))
+        if stop is not None and stop < start:
+            stop = None
+
+        title = subtitle = description = category = icon = episode = None
+        for child in element:
+            tag = child.tag
+            if tag == 'title':
+                if title is None:
+                    title = _text(child)
+            elif tag == 'sub-title':
+                if subtitle is None:
+                    subtitle = _text(child)
+            elif tag == 'desc':
+                if description is None:
+                    description = _text(child)
+            elif tag == 'category':
+                if category is None:
+                    category = _text(child)
+            elif tag == 'icon':
+                if icon is None:
+                    icon = child.get('src')
+            elif tag == 'episode-num':
+                # Numerazione leggibile ("S01E02") se presente
+                if episode is None or child.get('system') == 'onscreen':
+                    episode = _text(child) or episode
+        if not title:
+            return None
+        return (channel_id, start, stop, title, subtitle, description, category, icon, episode)
+
+# Confronto per finestre: i programmi arrivati vengono appoggiati in
+# tabelle temporanee (su disco, vedi disk_temp_store) dentro una
+# transazione differita, che non prende il lock di scrittura del DB.
+# apply() calcola un digest per (canale, finestra) e riscrive a blocchi
+# solo le finestre nuove o cambiate, poi cancella quelle sparite
+class EPGDiffSync:
+    def __init__(self, cursor: sqlite3.Cursor, source_id: int,
+                 window: int = EPG_WINDOW_SECONDS, apply_windows: int = EPG_APPLY_WINDOWS):
+        self.cursor = cursor
+        self.source_id = source_id
+        self.window = window
+        self.apply_windows = apply_windows
+        self.channels = 0
+        self.programmes = 0
+        self._missing_stop = False
+
+    def begin(self):
+        cursor = self.cursor
+        cursor.execute("BEGIN")
+        cursor.execute("DROP TABLE IF EXISTS temp.epg_incoming")
+        cursor.execute("""
+            CREATE TEMP TABLE epg_incoming (
+                channel_id TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                stop INTEGER,
+                title TEXT NOT NULL,
+                subtitle TEXT,
+                description TEXT,
+                category TEXT,
+                icon TEXT,
+                episode TEXT
+            )
+        """)
+        cursor.execute("DROP TABLE IF EXISTS temp.epg_incoming_channels")
+        cursor.execute("""
+            CREATE TEMP TABLE epg_incoming_channels (
+                channel_id TEXT PRIMARY KEY,
+                display_name TEXT,
+                icon TEXT
+            )
+        """)
+
+    def add(self, channels: List[Tuple], programmes: List[Tuple]):
+        if channels:
+            bulk_insert(
+                self.cursor,
+                """INSERT OR REPLACE INTO temp.epg_incoming_channels
+                   (channel_id, display_name, icon) VALUES (?, ?, ?)""",
+                channels
+            )
+        if programmes:
+            self.programmes += bulk_insert(
+                self.cursor,
+                f"INSERT INTO temp.epg_incoming ({PROGRAMME_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                programmes
+            )
+            if not self._missing_stop:
+                self._missing_stop = any(programme[2] is None for programme in programmes)
+
+    def rollback(self):
+        if self.cursor.connection.in_transaction:
+            self.cursor.connection.rollback()
+
+    def _prepare(self):
+        cursor = self.cursor
+        window = self.window
+        cursor.execute("CREATE INDEX temp.epg_incoming_window ON epg_incoming(channel_id, start)")
+        if self._missing_stop:
+            cursor.execute("""
+                UPDATE temp.epg_incoming
+                SET stop = COALESCE(
+                    (SELECT MIN(next.start) FROM temp.epg_incoming AS next
+                     WHERE next.channel_id = epg_incoming.channel_id
+                       AND next.start > epg_incoming.start),
+                    start + ?
+                )
+                WHERE stop IS NULL
+            """, (EPG_DEFAULT_PROGRAMME_SECONDS,))
+
+        # Digest per finestra, in una passata ordinata: memoria costante
+        cursor.execute("DROP TABLE IF EXISTS temp.epg_new_windows")
+        cursor.execute("""
+            CREATE TEMP TABLE epg_new_windows (
+                channel_id TEXT NOT NULL,
+                window_start INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                programmes INTEGER NOT NULL,
+                PRIMARY KEY (channel_id, window_start)
+            )
+        """)
+        reader = cursor.connection.execute(
+            f"SELECT {PROGRAMME_COLUMNS} FROM temp.epg_incoming ORDER BY channel_id, start, rowid"
+        )
+        reader.row_factory = None
+        batch = []
+        current = None
+        digest = None
+        count = 0
+        for row in reader:
+            key = (row[0], row[1] - row[1] % window)
+            if key != current:
+                if current is not None:
+                    batch.append((*current, digest.hexdigest(), count))
+                    if len(batch) >= 1000:
+                        bulk_insert(cursor, "INSERT INTO temp.epg_new_windows VALUES (?, ?, ?, ?)", batch)
+                        batch = []
+                current = key
+                digest = hashlib.blake2b(digest_size=16)
+                count = 0
+            digest.update('\x1f'.join('' if value is None else str(value) for value in row[1:]).encode())
+            digest.update(b'\x1e')
+            count += 1
+        if current is not None:
+            batch.append((*current, digest.hexdigest(), count))
+        bulk_insert(cursor, "INSERT INTO temp.epg_new_windows VALUES (?, ?, ?, ?)", batch)
+
+        cursor.execute("DROP TABLE IF EXISTS temp.epg_changed")
+        cursor.execute("""
+            CREATE TEMP TABLE epg_changed AS
+            SELECT new.channel_id, new.window_start
+            FROM temp.epg_new_windows AS new
+            LEFT JOIN epg_windows AS old
+              ON old.source_id = ? AND old.channel_id = new.channel_id
+             AND old.window_start = new.window_start
+            WHERE old.digest IS NOT new.digest
+            ORDER BY new.channel_id, new.window_start
+        """, (self.source_id,))
+        cursor.execute("DROP TABLE IF EXISTS temp.epg_removed")
+        cursor.execute("""
+            CREATE TEMP TABLE epg_removed AS
+            SELECT old.channel_id, old.window_start
+            FROM epg_windows AS old
+            WHERE old.source_id = ? AND NOT EXISTS (
+                SELECT 1 FROM temp.epg_new_windows AS new
+                WHERE new.channel_id = old.channel_id AND new.window_start = old.window_start
+            )
+        """, (self.source_id,))
+        cursor.execute("DROP TABLE IF EXISTS temp.epg_batch")
+        cursor.execute("""
+            CREATE TEMP TABLE epg_batch (
+                channel_id TEXT NOT NULL,
+                window_start INTEGER NOT NULL,
+                PRIMARY KEY (channel_id, window_start)
+            )
+        """)
+
+    def _replace_windows(self, windows: List[Tuple], insert: bool) -> Tuple[int, int]:
+        cursor = self.cursor
+        source_id = self.source_id
+        cursor.execute("DELETE FROM temp.epg_batch")
+        bulk_insert(cursor, "INSERT INTO temp.epg_batch VALUES (?, ?)", windows)
+        deleted = cursor.execute("""
+            DELETE FROM epg_programmes WHERE id IN (
+                SELECT p.id FROM temp.epg_batch AS w
+                JOIN epg_programmes AS p
+                  ON p.source_id = ? AND p.channel_id = w.channel_id
+                 AND p.start >= w.window_start AND p.start < w.window_start + ?
+            )
+        """, (source_id, self.window)).rowcount
+        if not insert:
+            cursor.execute("""
+                DELETE FROM epg_windows WHERE source_id = ?
+                  AND (channel_id, window_start) IN (SELECT channel_id, window_start FROM temp.epg_batch)
+            """, (source_id,))
+            return 0, deleted
+
+        inserted = cursor.execute(f"""
+            INSERT INTO epg_programmes (source_id, {PROGRAMME_COLUMNS})
+            SELECT ?, i.channel_id, i.start, i.stop, i.title, i.subtitle, i.description,
+                   i.category, i.icon, i.episode
+            FROM temp.epg_batch AS w
+            JOIN temp.epg_incoming AS i
+              ON i.channel_id = w.channel_id
+             AND i.start >= w.window_start AND i.start < w.window_start + ?
+            ORDER BY i.channel_id, i.start
+        """, (source_id, self.window)).rowcount
+        cursor.execute("""
+            INSERT OR REPLACE INTO epg_windows (source_id, channel_id, window_start, digest, programmes)
+            SELECT ?, new.channel_id, new.window_start, new.digest, new.programmes
+            FROM temp.epg_batch AS w
+            JOIN temp.epg_new_windows AS new USING (channel_id, window_start)
+        """, (source_id,))
+        return inserted, deleted
+
+    def _in_batches(self, table: str, insert: bool) -> Tuple[int, int, int]:
+        # Una transazione per blocco di finestre: ogni finestra viene
+        # sostituita per intero insieme al suo digest, quindi un errore a
+        # metà lascia finestre coerenti e la sync successiva completa il resto
+        cursor = self.cursor
+        windows = inserted = deleted = 0
+        last = 0
+        while True:
+            rows = cursor.execute(
+                f"SELECT rowid, channel_id, window_start FROM temp.{table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last, self.apply_windows)
+            ).fetchall()
+            if not rows:
+                return windows, inserted, deleted
+            last = rows[-1]['rowid']
+            begin_immediate(cursor)
+            try:
+                added, removed = self._replace_windows(
+                    [(row['channel_id'], row['window_start']) for row in rows], insert
+                )
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.connection.rollback()
+                raise
+            windows += len(rows)
+            inserted += added
+            deleted += removed
+
+    def apply(self, etag: Optional[str], last_modified: Optional[str]) -> Dict:
+        cursor = self.cursor
+        source_id = self.source_id
+        try:
+            self._prepare()
+            new_windows = cursor.execute(
+                "SELECT COUNT(*) AS count FROM temp.epg_new_windows"
+            ).fetchone()['count']
+            max_duration = cursor.execute(
+                "SELECT MAX(stop - start) AS duration FROM temp.epg_incoming"
+            ).fetchone()['duration'] or 0
+            cursor.connection.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+        changed, inserted, deleted = self._in_batches('epg_changed', insert=True)
+        removed, _, removed_programmes = self._in_batches('epg_removed', insert=False)
+
+        begin_immediate(cursor)
+        try:
+            cursor.execute("DELETE FROM epg_channels WHERE source_id = ?", (source_id,))
+            cursor.execute("""
+                INSERT INTO epg_channels (source_id, channel_id, display_name, icon)
+                SELECT ?, channel_id, display_name, icon FROM temp.epg_incoming_channels
+            """, (source_id,))
+            channels = cursor.rowcount
+            programmes = cursor.execute(
+                "SELECT COALESCE(SUM(programmes), 0) AS count FROM epg_windows WHERE source_id = ?",
+                (source_id,)
+            ).fetchone()['count']
+            cursor.execute(
+                """UPDATE epg_sources
+                   SET last_sync = CURRENT_TIMESTAMP,
+                       upstream_etag = ?,
+                       upstream_last_modified = ?,
+                       channels_count = ?,
+                       programmes_count = ?,
+                       max_programme_seconds = MAX(max_programme_seconds, ?)
+                   WHERE id = ?""",
+                (etag, last_modified, channels, programmes, max_duration, source_id)
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.connection.rollback()
+            raise
+
+        for table in ('epg_incoming', 'epg_incoming_channels', 'epg_new_windows',
+                      'epg_changed', 'epg_removed', 'epg_batch'):
+            cursor.execute(f"DROP TABLE IF EXISTS temp.{table}")
+        return {
+            "not_modified": False,
+            "channels": channels,
+            "programmes": programmes,
+            "received": self.programmes,
+            "windows_changed": changed,
+            "windows_removed": removed,
+            "windows_unchanged": new_windows - changed,
+            "programmes_inserted": inserted,
+            "programmes_deleted": deleted + removed_programmes,
+        }
+
+# Query
+PROGRAMME_FIELDS = "channel_id, start, stop, title, subtitle, description, category, icon, episode"
+
+def now_next(cursor, source_id: int, channel_id: str, now: int) -> Dict:
+    # Due ricerche sull'indice (source_id, channel_id, start)
+    current = cursor.execute(
+        f"""SELECT {PROGRAMME_FIELDS} FROM epg_programmes
+            WHERE source_id = ? AND channel_id = ? AND start <= ?
+            ORDER BY start DESC LIMIT 1""",
+        (source_id, channel_id, now)
+    ).fetchone()
+    if current is not None and current['stop'] <= now:
+        current = None
+    following = cursor.execute(
+        f"""SELECT {PROGRAMME_FIELDS} FROM epg_programmes
+            WHERE source_id = ? AND channel_id = ? AND start > ?
+            ORDER BY start LIMIT 1""",
+        (source_id, channel_id, now)
+    ).fetchone()
+    return {"tvg_id": channel_id, "now": current, "next": following}
+
+def programmes_between(cursor, source: Dict, channel_id: str, start: int, end: int,
+                       limit: int) -> List[Dict]:
+    # Programmi che si sovrappongono a [start, end): chi è iniziato prima
+    # di start può durare al massimo max_programme_seconds
+    return cursor.execute(
+        f"""SELECT {PROGRAMME_FIELDS} FROM epg_programmes
+            WHERE source_id = ? AND channel_id = ?
+              AND start >= ? AND start < ? AND stop > ?
+            ORDER BY start LIMIT ?""",
+        (source['id'], channel_id, start - (source['max_programme_seconds'] or 0), end, start, limit)
+    ).fetchall()
@@ -1,17 +1,64 @@
-from typing import List, Dict, Optional, Union
+from typing import List, Dict, Optional, Union, Iterable, Iterator
 import re
 import json
+import codecs
+from sys import intern
+from weakref import WeakValueDictionary
+
+# Tag extra in sola lettura: i canali con gli stessi tag (spesso nessuno)
+# condividono la stessa istanza invece di averne una copia ciascuno.
+# Chi deve modificarli lavora su una copia (.copy() restituisce un dict)
+class FrozenTags(dict):
+   __slots__ = ('__weakref__',)
+
+   def _readonly(self, *args, **kwargs):
+       raise TypeError("extra_tags is read-only, use .copy() to modify it")
+
+   __setitem__ = __delitem__ = _readonly
+   clear = pop = popitem = setdefault = update = _readonly
+   __ior__ = _readonly
+
+   def copy(self) -> Dict[str, str]:
+       return dict(self)
+
+   def __reduce__(self):
+       return (FrozenTags, (dict(self),))
+
+EMPTY_TAGS = FrozenTags()
+
+# Le istanze condivise restano in tabella finché qualche canale le usa
+_shared_tags = WeakValueDictionary()
+
+def share_tags(tags: Optional[Dict[str, str]]) -> FrozenTags:
+   if not tags:
+       return EMPTY_TAGS
+   if type(tags) is FrozenTags:
+       return tags
+   key = tuple(tags.items())
+   shared = _shared_tags.get(key)
+   if shared is None:
+       shared = FrozenTags((intern(k), intern(v) if isinstance(v, str) else v) for k, v in key)
+       _shared_tags[key] = shared
+   return shared
+
+def intern_optional(value: Optional[str]) -> Optional[str]:
+   return intern(value) if value else value
 
 class M3UChannel:
+   # Niente __dict__ per istanza: su playlist da centinaia di migliaia di
+   # canali la differenza è di centinaia di MB
+   __slots__ = ('name', 'url', 'group', 'logo', 'tvg_id', 'extra_tags')
+
    def __init__(self, name: str, url: str, group: Optional[str] = None, 
                 logo: Optional[str] = None, tvg_id: Optional[str] = None,
                 extra_tags: Optional[Dict[str, str]] = None):
        self.name = name
        self.url = url
-       self.group = group
-       self.logo = logo
+       # Gruppi e loghi si ripetono su molti canali: una sola copia in memoria
+       self.group = intern_optional(group)
+       self.logo = intern_optional(logo)
        self.tvg_id = tvg_id
-       self.extra_tags = extra_tags or {}
+       self.extra_tags = share_tags(extra_tags)
 
    def to_dict(self) -> Dict:
        return {
@@ -23,106 +70,237 @@ class M3UChannel:
            "extra_tags": self.extra_tags
        }
 
-def parse_m3u(content: str) -> List[M3UChannel]:
-   channels = []
-   current_channel = None
-   extra_tags = {}
-   position = 0
+# Pattern precompilati: ogni riga #EXTINF viene scansionata una sola volta
+_DURATION_RE = re.compile(r'-?\d+')
+_ATTR_KEY_RE = re.compile(r'[\w-]+')
+_EPG_URL_RE = re.compile(r'x-tvg-url="([^"]+)"')
+
+# Chiavi già validate (tvg-id, group-title, ...): si ripetono su ogni riga
+_known_keys = set()
+
+def _attribute_key_start(head: str) -> int:
+   start = head.rfind(' ') + 1
+   key = head[start:]
+   if key and _ATTR_KEY_RE.fullmatch(key):
+       if len(_known_keys) < 1024:
+           _known_keys.add(key)
+       return start
+   start = len(head)
+   while start > 0:
+       char = head[start - 1]
+       if not (char.isalnum() or char == '_' or char == '-'):
+           break
+       start -= 1
+   return start
+
+def _scan_attributes(info: str):
+   # Equivalente a re.finditer(r'([\w-]+)="([^"]*)"') seguito da re.sub
+   # sullo stesso pattern, ma in un solo passaggio: la riga viene divisa
+   # sulle virgolette e ogni segmento che termina con 'chiave=' apre un valore
+   parts = info.split('"')
+   count = len(parts)
+   attributes = {}
+   pieces = []
+   append = pieces.append
+   known_keys = _known_keys
+   i = 0
    
-   for line in content.splitlines():
-       line = line.strip()
+   while i < count:
+       segment = parts[i]
+       if i + 2 < count and segment[-1:] == '=':
+           head = segment[:-1]
+           start = head.rfind(' ') + 1
+           if head[start:] not in known_keys:
+               start = _attribute_key_start(head)
+           if start < len(head):
+               append(head[:start])
+               attributes[head[start:]] = parts[i + 1]
+               i += 2
+               continue
+       append(segment)
+       if i + 1 < count:
+           append('"')
+       i += 1
+   
+   if attributes:
+       info = ''.join(pieces).strip()
+   return info, attributes
+
+def _parse_extinf(info: str):
+   duration_match = _DURATION_RE.match(info)
+   if duration_match:
+       info = info[duration_match.end():].strip(',').strip()
+   
+   attributes = None
+   if 'tvg-' in info or 'group-' in info:
+       info, attributes = _scan_attributes(info)
+   
+   name = info.strip()
+   if name.startswith(','):
+       name = name[1:].strip()
+   
+   return name, attributes or {}
+
+# Caratteri che str.splitlines considera fine riga
+_LINE_BREAKS = frozenset('\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029')
+
+# Parser incrementale: riceve il contenuto a blocchi e restituisce i canali
+# man mano che sono completi, senza tenere in memoria l'intera playlist.
+# Con input bytes la decodifica avviene direttamente (utf-8 di default,
+# BOM compreso), senza indovinare il charset come fa aiohttp con .text()
+class M3UStreamParser:
+   def __init__(self, encoding: str = 'utf-8'):
+       if codecs.lookup(encoding).name == 'utf-8':
+           encoding = 'utf-8-sig'
+       self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+       # Pezzi dell'ultima riga non ancora terminata: uniti una volta sola,
+       # anche se la riga arriva in molti blocchi
+       self._pending: List[str] = []
+       self._current_channel = None
+       self._extra_tags = {}
+       self._position = 0
+       # x-tvg-url dell'header #EXTM3U, se presente
+       self.epg_url: Optional[str] = None
+
+   def feed(self, data: Union[bytes, str]) -> List[M3UChannel]:
+       if isinstance(data, bytes):
+           data = self._decoder.decode(data)
+       if not data:
+           return []
+       # Righe divise come in parse_m3u (splitlines: anche \r e \r\n).
+       # Il primo pezzo continua la riga in sospeso; un \r\n diviso tra due
+       # blocchi produce solo una riga vuota in più, che viene ignorata
+       lines = data.splitlines()
+       complete = data[-1] in _LINE_BREAKS
+       if len(lines) == 1 and not complete:
+           self._pending.append(data)
+           return []
+       if self._pending:
+           self._pending.append(lines[0])
+           lines[0] = ''.join(self._pending)
+           self._pending = []
+       if not complete:
+           self._pending.append(lines.pop())
+       return self.feed_lines(lines)
+
+   def close(self) -> List[M3UChannel]:
+       tail = ''.join(self._pending) + self._decoder.decode(b'', final=True)
+       self._pending = []
+       return self.feed_lines(tail.splitlines())
+
+   def feed_lines(self, lines: Iterable[str]) -> List[M3UChannel]:
+       channels = []
+       current_channel = self._current_channel
+       extra_tags = self._extra_tags
+       position = self._position
        
-       if not line:
-           continue
-
-       if line.startswith('#EXTM3U'):
-           epg_match = re.search(r'x-tvg-url="([^"]+)"', line)
-           if epg_match:
-               extra_tags['epg_url'] = epg_match.group(1)
-           continue
+       for line in lines:
+           line = line.strip()
            
-       if line.startswith('#EXTINF:'):
-           position += 1
-           info = line[8:]
+           if not line:
+               continue
            
-           duration_match = re.match(r'-?\d+', info)
-           if duration_match:
-               info = info[len(duration_match.group(0)):].strip(',').strip()
+           if line[0] != '#':
+               if current_channel is not None:
+                   current_channel.url = line
+                   channels.append(current_channel)
+               current_channel = None
+               if extra_tags:
+                   extra_tags = {}
            
-           attributes = {}
-           if 'tvg-' in info or 'group-' in info:
-               attrs_pattern = r'([\w-]+)="([^"]*)"'
-               for match in re.finditer(attrs_pattern, info):
-                   key, value = match.groups()
-                   attributes[key] = value
-               
-               info = re.sub(r'[\w-]+="[^"]*"', '', info).strip()
+           elif line.startswith('#EXTINF:'):
+               position += 1
+               name, attributes = _parse_extinf(line[8:])
+               current_channel = M3UChannel(
+                   name=name,
+                   url=None,
+                   group=attributes.get('group-title'),
+                   logo=attributes.get('tvg-logo'),
+                   tvg_id=attributes.get('tvg-id'),
+                   extra_tags=extra_tags
+               )
+               if extra_tags:
+                   extra_tags = {}
            
-           name = info.strip()
-           if name.startswith(','):
-               name = name[1:].strip()
+           elif line.startswith('#EXTGRP:'):
+               if current_channel is not None:
+                   current_channel.group = intern(line[8:].strip())
            
-           current_channel = {
-               'name': name,
-               'group': attributes.get('group-title'),
-               'logo': attributes.get('tvg-logo'),
-               'tvg_id': attributes.get('tvg-id'),
-               'position': position,
-               'extra_tags': extra_tags.copy()
-           }
-           extra_tags = {}
+           elif line.startswith('#EXTM3U'):
+               epg_match = _EPG_URL_RE.search(line)
+               if epg_match:
+                   self.epg_url = epg_match.group(1)
+                   extra_tags['epg_url'] = self.epg_url
            
-       elif line.startswith('#EXTGRP:'):
-           if current_channel:
-               current_channel['group'] = line[8:].strip()
+           else:
+               # Equivale a re.match(r'#([^:]+):(.+)', line)
+               sep = line.find(':')
+               if 1 < sep < len(line) - 1:
+                   extra_tags[line[1:sep]] = line[sep + 1:].strip()
        
-       elif line.startswith('#'):
-           tag_match = re.match(r'#([^:]+):(.+)', line)
-           if tag_match:
-               tag_name, tag_value = tag_match.groups()
-               extra_tags[tag_name] = tag_value.strip()
-               
-       elif not line.startswith('#') and line:
-           if current_channel:
-               channels.append(M3UChannel(
-                   name=current_channel['name'],
-                   url=line,
-                   group=current_channel['group'],
-                   logo=current_channel['logo'],
-                   tvg_id=current_channel['tvg_id'],
-                   extra_tags=current_channel['extra_tags']
-               ))
-           current_channel = None
-           extra_tags = {}
-
-   return channels
-
-def generate_m3u(channels: List[M3UChannel], epg_url: Optional[str] = None) -> str:
+       self._current_channel = current_channel
+       self._extra_tags = extra_tags
+       self._position = position
+       return channels
+
+def parse_m3u(content: Union[str, bytes]) -> List[M3UChannel]:
+   if isinstance(content, bytes):
+       content = content.decode('utf-8-sig', errors='replace')
+   return M3UStreamParser().feed_lines(content.splitlines())
+
+def iter_m3u(chunks: Iterable[Union[bytes, str]], encoding: str = 'utf-8') -> Iterator[M3UChannel]:
+   parser = M3UStreamParser(encoding)
+   for chunk in chunks:
+       yield from parser.feed(chunk)
+   yield from parser.close()
+
+# Dimensione indicativa dei blocchi prodotti da iter_generate_m3u
+M3U_CHUNK_SIZE = 64 * 1024
+
+def render_m3u_header(epg_url: Optional[str] = None) -> str:
+   if epg_url:
+       return f'#EXTM3U x-tvg-url="{epg_url}"'
+   return '#EXTM3U'
+
+def render_m3u_entry(channel: M3UChannel) -> str:
+   # Ogni voce inizia con '\n': header + voci concatenate = playlist completa
    content = []
    
-   if epg_url:
-       content.append(f'#EXTM3U x-tvg-url="{epg_url}"')
-   else:
-       content.append('#EXTM3U')
+   for tag_name, tag_value in channel.extra_tags.items():
+       if tag_name != 'epg_url':
+           content.append(f'\n#{tag_name}:{tag_value}')
+       
+   attributes = []
+   if channel.tvg_id:
+       attributes.append(f'tvg-id="{channel.tvg_id}"')
+   if channel.group:
+       attributes.append(f'group-title="{channel.group}"')
+   if channel.logo:
+       attributes.append(f'tvg-logo="{channel.logo}"')
+       
+   attrs_str = ' '.join(attributes)
+   if attrs_str:
+       attrs_str = ' ' + attrs_str
+       
+   content.append(f'\n#EXTINF:-1{attrs_str},{channel.name}\n{channel.url}')
+   return ''.join(content)
+
+def iter_generate_m3u(channels: Iterable[M3UChannel], epg_url: Optional[str] = None,
+                      chunk_size: int = M3U_CHUNK_SIZE) -> Iterator[str]:
+   buffer = [render_m3u_header(epg_url)]
+   size = 0
    
    for channel in channels:
-       for tag_name, tag_value in channel.extra_tags.items():
-           if tag_name != 'epg_url':
-               content.append(f'#{tag_name}:{tag_value}')
-           
-       attributes = []
-       if channel.tvg_id:
-           attributes.append(f'tvg-id="{channel.tvg_id}"')
-       if channel.group:
-           attributes.append(f'group-title="{channel.group}"')
-       if channel.logo:
-           attributes.append(f'tvg-logo="{channel.logo}"')
-           
-       attrs_str = ' '.join(attributes)
-       if attrs_str:
-           attrs_str = ' ' + attrs_str
-           
-       content.append(f'#EXTINF:-1{attrs_str},{channel.name}')
-       content.append(channel.url)
+       entry = render_m3u_entry(channel)
+       buffer.append(entry)
+       size += len(entry)
+       if size >= chunk_size:
+           yield ''.join(buffer)
+           buffer = []
+           size = 0
    
-   return '\n'.join(content)
\ No newline at end of file
+   if buffer:
+       yield ''.join(buffer)
+
+def generate_m3u(channels: Iterable[M3UChannel], epg_url: Optional[str] = None) -> str:
+   return ''.join(iter_generate_m3u(channels, epg_url))
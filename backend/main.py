@@ -1,23 +1,53 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.gzip import GZipMiddleware
 from typing import List, Dict, Optional
 import aiohttp
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
+import hashlib
 import json
 import sqlite3
-from ratelimit import limits, sleep_and_retry
+import time
 
-from database import get_db, init_db, create_backup
+from database import (
+   get_db, run_db, DBSession, init_db, touch_playlists, bulk_load_pragmas, disk_temp_store, db_pool
+)
 from models import *
-from m3u_utils import parse_m3u, generate_m3u, M3UChannel
+from m3u_utils import M3UStreamParser, M3UChannel, render_m3u_header, render_m3u_entry
+from playlist_cache import rendered_playlists, make_etag, http_date, is_not_modified, accepts_gzip
+from playlist_sync import PlaylistDiffSync
+from epg import (
+   GzipAwareDecoder, XMLTVStreamParser, EPGDiffSync, EPGError, now_next, programmes_between
+)
+from tvg_matcher import (
+   load_index as load_tvg_index, propose_mappings, apply_mappings,
+   TVG_MATCH_MIN_SCORE, TVG_MATCH_LIMIT
+)
+from stream_health import (
+   StreamHealthChecker, HealthCheckRunning, health_targets, record_health,
+   health_condition, health_summary, channel_health_list
+)
+from channel_query import (
+   fetch_channel_page, fetch_available_page, search_channels as run_channel_search,
+   InvalidCursor,
+   CHANNELS_PAGE_DEFAULT, CHANNELS_PAGE_MAX, SEARCH_DEFAULT, SEARCH_MAX
+)
+from channel_order import move_channels, next_position, MoveError, ChannelNotFound
+from sync_scheduler import SyncScheduler, SyncAlreadyRunning, SYNC_SCHEDULER_ENABLED
+from backup_scheduler import BackupScheduler, BACKUP_ENABLED
+from rate_limit import TokenBucketLimiter, rate_limit, enforce_rate_limit, client_ip
+from metrics import MetricsMiddleware, METRICS_ENABLED, METRICS_TOKEN
+import metrics
+from profiling import PROFILING_ENABLED, PROFILE_HEADER, ProfilerBusy
+import profiling
 from auth import (
    authenticate_user, create_access_token, create_refresh_token,
-   get_current_user, get_current_user_id, verify_refresh_token
+   get_current_user, get_current_user_id, verify_refresh_token,
+   user_cache, warm_up_password_check, hash_password, is_admin, get_current_admin
 )
 
 app = FastAPI(title="OMG Playlist Manager")
@@ -31,29 +61,136 @@ app.add_middleware(
    allow_credentials=True,
    allow_methods=["*"],
    allow_headers=["*"],
-   expose_headers=["Content-Disposition"]
+   expose_headers=["Content-Disposition", "X-Profile-Id"]
 )
 
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
-# Rate limiting
+# Aggiunto per ultimo, quindi esterno: misura anche la compressione
+if METRICS_ENABLED:
+   app.add_middleware(MetricsMiddleware)
+
+# Rate limiting: login per IP, sync manuale per utente, playlist pubbliche
+# per IP e token (più decoder dietro lo stesso token non si bloccano a
+# vicenda)
 CALLS_LIMIT = 100
 CALLS_PERIOD = 60
+login_limiter = TokenBucketLimiter(CALLS_LIMIT, CALLS_PERIOD)
+sync_limiter = TokenBucketLimiter(10, 60)
+public_limiter = TokenBucketLimiter(30, 60)
+
+def user_limit_key(user_id: int = Depends(get_current_user_id)) -> str:
+   return f"user:{user_id}"
+
+def public_limit_key(request: Request, token: Optional[str] = None) -> str:
+   # Senza token: richieste per token inesistenti, contate per IP
+   if token is None:
+       return f"ip:{client_ip(request)}"
+   return f"ip:{client_ip(request)}:token:{token}"
+
+# Profilo della singola richiesta: header X-Profile con il token di un
+# amministratore ("cpu" per il solo campionamento, senza tracemalloc)
+async def admin_profile_request(request: Request) -> Optional[profiling.ProfileRequest]:
+   if not PROFILING_ENABLED or PROFILE_HEADER not in request.headers:
+       return None
+   scheme, _, token = request.headers.get('authorization', '').partition(' ')
+   if scheme.lower() != 'bearer' or not token:
+       return None
+   try:
+       user = await get_current_user(token)
+   except HTTPException:
+       return None
+   if not is_admin(user):
+       return None
+   return profiling.request_profile(memory=request.headers[PROFILE_HEADER].lower() != 'cpu')
+
+# Sync: dimensione dei blocchi letti dal provider e dei batch scritti su DB
+SYNC_CHUNK_SIZE = 64 * 1024
+SYNC_BATCH_SIZE = 1000
+# EPG: programmi appoggiati per batch, limiti delle query per intervallo
+EPG_BATCH_SIZE = 5000
+EPG_RANGE_DEFAULT = 24 * 3600
+EPG_PROGRAMMES_DEFAULT = 200
+EPG_PROGRAMMES_MAX = 2000
+
+# Playlist pubbliche: righe lette dal DB per ogni blocco inviato al client
+PUBLIC_FETCH_SIZE = 1000
 
 @app.on_event("startup")
 async def startup_event():
-   init_db()
+   init_db(await hash_password("admin"))
+   warm_up_password_check()
+   if SYNC_SCHEDULER_ENABLED:
+       sync_scheduler.start()
+   if BACKUP_ENABLED:
+       backup_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+   await sync_scheduler.stop()
+   await backup_scheduler.stop(flush=BACKUP_ENABLED)
+   await health_checker.close()
+   db_pool.close_all()
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "database": db_pool.stats(),
+        "users": user_cache.stats(),
+        "rate_limit": {
+            "login": login_limiter.stats(),
+            "sync": sync_limiter.stats(),
+            "public": public_limiter.stats()
+        },
+        "backup": backup_scheduler.stats()
+    }
+
+# Profili salvati e snapshot della memoria, solo per amministratori
+@app.get("/admin/profiles")
+async def list_profiles(admin: User = Depends(get_current_admin)):
+   return profiling.list_profiles()
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, admin: User = Depends(get_current_admin)):
+   report = profiling.load_profile(profile_id)
+   if report is None:
+       raise HTTPException(status_code=404, detail="Profile not found")
+   return report
+
+@app.get("/admin/memory")
+async def get_memory_snapshot(
+   seconds: float = Query(5, gt=0, le=60),
+   top: int = Query(30, ge=1, le=200),
+   admin: User = Depends(get_current_admin)
+):
+   try:
+       return await profiling.memory_snapshot(seconds, top)
+   except ProfilerBusy as e:
+       raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(request: Request):
+   if not METRICS_ENABLED:
+       raise HTTPException(status_code=404, detail="Metrics disabled")
+   if METRICS_TOKEN and request.headers.get('authorization') != f"Bearer {METRICS_TOKEN}":
+       raise HTTPException(
+           status_code=status.HTTP_401_UNAUTHORIZED,
+           detail="Invalid metrics token",
+           headers={"WWW-Authenticate": "Bearer"},
+       )
+   return PlainTextResponse(
+       metrics.registry.render(),
+       media_type="text/plain; version=0.0.4"
+   )
 
 # Auth endpoints
-@sleep_and_retry
-@limits(calls=CALLS_LIMIT, period=CALLS_PERIOD)
-@app.post("/token", response_model=TokenResponse)
+@app.post(
+   "/token", response_model=TokenResponse,
+   dependencies=[Depends(rate_limit(login_limiter, client_ip))]
+)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-   user = authenticate_user(form_data.username, form_data.password)
+   user = await authenticate_user(form_data.username, form_data.password)
    if not user:
        raise HTTPException(
            status_code=status.HTTP_401_UNAUTHORIZED,
@@ -93,313 +230,1006 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
    return current_user
 
 # Playlist endpoints
-@app.get("/playlists", response_model=List[Playlist])
-async def get_playlists(user_id: int = Depends(get_current_user_id)):
-   with get_db() as db:
-       cursor = db.cursor()
-       playlists = []
-       
-       for playlist in cursor.execute(
-           """SELECT * FROM playlists 
-              WHERE user_id = ? 
-              ORDER BY created_at""",
-           (user_id,)
-       ).fetchall():
-           channels = cursor.execute("""
-               SELECT * FROM channels 
-               WHERE playlist_id = ? 
-               ORDER BY position, created_at
-           """, (playlist['id'],)).fetchall()
-           
-           playlist_dict = dict(playlist)
-           playlist_dict['channels'] = [dict(ch) for ch in channels]
-           playlists.append(playlist_dict)
-       
-       return playlists
+@app.get("/playlists", response_model=List[PlaylistSummary])
+async def get_playlists(
+   include_channels: bool = False,
+   user_id: int = Depends(get_current_user_id)
+):
+   # Numero di query costante: conteggi aggregati per tutte le playlist e,
+   # solo se richiesti, i canali in un'unica lettura
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
+          playlists = cursor.execute(
+              """SELECT p.*,
+                        CASE WHEN p.is_custom THEN COALESCE(cc.channels_count, 0)
+                             ELSE COALESCE(c.channels_count, 0) END AS channels_count,
+                        CASE WHEN p.is_custom THEN COALESCE(cc.groups_count, 0)
+                             ELSE COALESCE(c.groups_count, 0) END AS groups_count
+                 FROM playlists p
+                 LEFT JOIN (
+                     SELECT playlist_id,
+                            COUNT(*) AS channels_count,
+                            COUNT(DISTINCT group_title) AS groups_count
+                     FROM channels
+                     WHERE playlist_id IN (SELECT id FROM playlists WHERE user_id = ?)
+                     GROUP BY playlist_id
+                 ) c ON c.playlist_id = p.id
+                 LEFT JOIN (
+                     SELECT cpc.playlist_id,
+                            COUNT(*) AS channels_count,
+                            COUNT(DISTINCT ch.group_title) AS groups_count
+                     FROM custom_playlist_channels cpc
+                     JOIN channels ch ON ch.id = cpc.channel_id
+                     WHERE cpc.playlist_id IN (
+                         SELECT id FROM playlists WHERE user_id = ? AND is_custom = 1
+                     )
+                     GROUP BY cpc.playlist_id
+                 ) cc ON cc.playlist_id = p.id
+                 WHERE p.user_id = ?
+                 ORDER BY p.created_at""",
+              (user_id, user_id, user_id)
+          ).fetchall()
+          
+          if include_channels:
+              channels_by_playlist = {playlist['id']: [] for playlist in playlists}
+              for channel in cursor.execute("""
+                  SELECT c.* 
+                  FROM channels c
+                  JOIN playlists p ON p.id = c.playlist_id
+                  WHERE p.user_id = ?
+                  ORDER BY c.playlist_id, c.position, c.created_at
+              """, (user_id,)):
+                  channels_by_playlist[channel['playlist_id']].append(channel)
+              for playlist in playlists:
+                  playlist['channels'] = channels_by_playlist[playlist['id']]
+          
+          return playlists
+   return await run_db(work)
 
 @app.post("/playlists", response_model=Playlist)
 async def create_playlist(
    playlist: PlaylistCreate,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
-       try:
-           cursor.execute(
-               """INSERT INTO playlists 
-                  (user_id, name, url, is_custom, public_token, epg_url)
-                  VALUES (?, ?, ?, ?, ?, ?)""",
-               (
-                   user_id,
-                   playlist.name,
-                   playlist.url,
-                   playlist.is_custom,
-                   str(uuid.uuid4()) if playlist.is_custom else None,
-                   playlist.epg_url
-               )
-           )
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
+          try:
+              cursor.execute(
+                  """INSERT INTO playlists 
+                     (user_id, name, url, is_custom, public_token, epg_url,
+                      sync_identity, sync_interval)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                  (
+                      user_id,
+                      playlist.name,
+                      playlist.url,
+                      playlist.is_custom,
+                      str(uuid.uuid4()) if playlist.is_custom else None,
+                      playlist.epg_url,
+                      playlist.sync_identity,
+                      playlist.sync_interval
+                  )
+              )
            
-           new_playlist = cursor.execute(
-               "SELECT * FROM playlists WHERE id = ?",
-               (cursor.lastrowid,)
-           ).fetchone()
+              new_playlist = cursor.execute(
+                  "SELECT * FROM playlists WHERE id = ?",
+                  (cursor.lastrowid,)
+              ).fetchone()
            
-           return dict(new_playlist)
-       except sqlite3.Error as e:
-           raise HTTPException(
-               status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-               detail=f"Database error: {str(e)}"
-           )
+              return dict(new_playlist)
+          except sqlite3.Error as e:
+              raise HTTPException(
+                  status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                  detail=f"Database error: {str(e)}"
+              )
+   new_playlist = await run_db(work)
+   # Lo scheduler rilegge il DB: va avvisato dopo il commit
+   sync_scheduler.reload()
+   return new_playlist
 
 @app.get("/playlists/{playlist_id}", response_model=Playlist)
 async def get_playlist(
    playlist_id: int,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       playlist = db.execute(
-           """SELECT * FROM playlists 
-              WHERE id = ? AND user_id = ?""",
-           (playlist_id, user_id)
-       ).fetchone()
-       
-       if not playlist:
-           raise HTTPException(
-               status_code=status.HTTP_404_NOT_FOUND,
-               detail="Playlist not found"
-           )
+   def work():
+      with get_db() as db:
+          playlist = db.execute(
+              """SELECT * FROM playlists 
+                 WHERE id = ? AND user_id = ?""",
+              (playlist_id, user_id)
+          ).fetchone()
        
-       channels = db.execute("""
-           SELECT * FROM channels 
-           WHERE playlist_id = ?
-           ORDER BY position, created_at
-       """, (playlist_id,)).fetchall()
+          if not playlist:
+              raise HTTPException(
+                  status_code=status.HTTP_404_NOT_FOUND,
+                  detail="Playlist not found"
+              )
        
-       playlist_dict = dict(playlist)
-       playlist_dict['channels'] = [dict(ch) for ch in channels]
-       return playlist_dict
+          channels = db.execute("""
+              SELECT * FROM channels 
+              WHERE playlist_id = ?
+              ORDER BY position, created_at
+          """, (playlist_id,)).fetchall()
        
+          playlist_dict = dict(playlist)
+          playlist_dict['channels'] = [dict(ch) for ch in channels]
+          return playlist_dict
+   return await run_db(work)
+
+@app.get("/playlists/{playlist_id}/channels", response_model=ChannelPage)
+async def list_channels(
+   playlist_id: int,
+   cursor: Optional[str] = None,
+   limit: int = Query(CHANNELS_PAGE_DEFAULT, ge=1, le=CHANNELS_PAGE_MAX),
+   group_title: Optional[str] = None,
+   name_prefix: Optional[str] = None,
+   has_tvg_id: Optional[bool] = None,
+   health: Optional[HealthFilter] = None,
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+      with get_db() as db:
+          playlist = db.execute(
+              "SELECT id, is_custom FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          ).fetchone()
+          
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Playlist not found")
+          
+          try:
+              return fetch_channel_page(
+                  db.cursor(), playlist, limit, cursor,
+                  group_title=group_title,
+                  name_prefix=name_prefix,
+                  has_tvg_id=has_tvg_id,
+                  health=health
+              )
+          except InvalidCursor as e:
+              raise HTTPException(status_code=400, detail=str(e))
+   return await run_db(work)
+
 @app.put("/playlists/{playlist_id}", response_model=Playlist)
 async def update_playlist(
    playlist_id: int,
    playlist: PlaylistUpdate,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
-       
-       existing = cursor.execute(
-           "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-           (playlist_id, user_id)
-       ).fetchone()
-       
-       if not existing:
-           raise HTTPException(status_code=404, detail="Playlist not found")
-       
-       update_fields = []
-       values = []
-       if playlist.name is not None:
-           update_fields.append("name = ?")
-           values.append(playlist.name)
-       if playlist.url is not None:
-           update_fields.append("url = ?")
-           values.append(playlist.url)
-       if playlist.epg_url is not None:
-           update_fields.append("epg_url = ?")
-           values.append(playlist.epg_url)
-       
-       if update_fields:
-           values.extend([playlist_id, user_id])
-           cursor.execute(
-               f"""UPDATE playlists 
-                   SET {', '.join(update_fields)}
-                   WHERE id = ? AND user_id = ?""",
-               tuple(values)
-           )
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
+       
+          existing = cursor.execute(
+              "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          ).fetchone()
+       
+          if not existing:
+              raise HTTPException(status_code=404, detail="Playlist not found")
        
-       return await get_playlist(playlist_id, user_id)
+          update_fields = []
+          values = []
+          if playlist.name is not None:
+              update_fields.append("name = ?")
+              values.append(playlist.name)
+          if playlist.url is not None:
+              update_fields.append("url = ?")
+              values.append(playlist.url)
+              # Nuova sorgente: i validatori salvati non valgono più
+              update_fields.append(
+                  "upstream_etag = NULL, upstream_last_modified = NULL, upstream_digest = NULL, "
+                  "upstream_epg_url = NULL"
+              )
+          if playlist.epg_url is not None:
+              update_fields.append("epg_url = ?")
+              values.append(playlist.epg_url)
+          if playlist.sync_identity is not None:
+              update_fields.append("sync_identity = ?")
+              values.append(playlist.sync_identity)
+          if playlist.sync_interval is not None:
+              update_fields.append("sync_interval = ?")
+              values.append(playlist.sync_interval)
+       
+          if update_fields:
+              values.extend([playlist_id, user_id])
+              cursor.execute(
+                  f"""UPDATE playlists 
+                      SET {', '.join(update_fields)}
+                      WHERE id = ? AND user_id = ?""",
+                  tuple(values)
+              )
+              rendered_playlists.invalidate(touch_playlists(cursor, playlist_id))
+          return bool(update_fields)
+   # Lo scheduler rilegge il DB: va avvisato dopo il commit
+   if await run_db(work):
+       sync_scheduler.reload()
+   
+   return await get_playlist(playlist_id, user_id)
 
 @app.delete("/playlists/{playlist_id}")
 async def delete_playlist(
    playlist_id: int,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
        
-       playlist = cursor.execute(
-           "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-           (playlist_id, user_id)
-       ).fetchone()
+          playlist = cursor.execute(
+              "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          ).fetchone()
        
-       if not playlist:
-           raise HTTPException(status_code=404, detail="Playlist not found")
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Playlist not found")
        
-       cursor.execute(
-           "DELETE FROM playlists WHERE id = ? AND user_id = ?",
-           (playlist_id, user_id)
-       )
-       return {"message": "Playlist deleted"}
+          rendered_playlists.invalidate(touch_playlists(cursor, playlist_id))
+          cursor.execute(
+              "DELETE FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          )
+          return {"message": "Playlist deleted"}
+   result = await run_db(work)
+   sync_scheduler.reload()
+   return result
 
-@app.post("/playlists/{playlist_id}/sync")
-@sleep_and_retry
-@limits(calls=10, period=60)
+@app.post(
+   "/playlists/{playlist_id}/sync",
+   dependencies=[Depends(rate_limit(sync_limiter, user_limit_key))]
+)
 async def sync_playlist(
    playlist_id: int,
+   request: Request,
+   response: Response,
+   force: bool = False,
    user_id: int = Depends(get_current_user_id)
 ):
-   timeout = aiohttp.ClientTimeout(total=30)
+   profile_request = await admin_profile_request(request)
+   try:
+       result = await sync_scheduler.run_now(playlist_id, user_id, force)
+   except SyncAlreadyRunning:
+       raise HTTPException(status_code=409, detail="Sync already in progress")
+   if profile_request is not None and profile_request.ids:
+       response.headers["X-Profile-Id"] = profile_request.ids[0]
+   return result
+
+@app.get("/sync/schedule", response_model=List[SyncJobState])
+async def get_sync_schedule(user_id: int = Depends(get_current_user_id)):
+   return sync_scheduler.state(user_id)
+
+@app.get("/playlists/{playlist_id}/sync/schedule", response_model=SyncJobState)
+async def get_playlist_sync_schedule(
+   playlist_id: int,
+   user_id: int = Depends(get_current_user_id)
+):
+   state = sync_scheduler.state(user_id, playlist_id)
+   if not state:
+       raise HTTPException(status_code=404, detail="Playlist not scheduled for sync")
+   return state[0]
+
+# Usata sia dall'endpoint sia dallo scheduler in background
+async def run_playlist_sync(playlist_id: int, user_id: int, force: bool = False) -> Dict:
+   start = time.perf_counter()
+   outcome = 'error'
+   try:
+       with profiling.profile('sync', playlist_id):
+           result = await sync_playlist_from_source(playlist_id, user_id, force)
+       outcome = 'not_modified' if result['not_modified'] else 'updated'
+       return result
+   finally:
+       metrics.SYNC_DURATION.labels(outcome).observe(time.perf_counter() - start)
+
+async def sync_playlist_from_source(playlist_id: int, user_id: int, force: bool) -> Dict:
+   # Nessun limite totale: le playlist grandi vengono lette in streaming,
+   # si interrompe solo se il provider resta muto troppo a lungo
+   timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
    async with aiohttp.ClientSession(timeout=timeout) as session:
        try:
-           with get_db() as db:
-               cursor = db.cursor()
-               playlist = cursor.execute(
-                   "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-                   (playlist_id, user_id)
-               ).fetchone()
+           # Connessione aperta e chiusa sui thread del DB, anche se il task
+           # viene annullato durante il download
+           async with DBSession() as db:
+               cursor = db.conn.cursor()
+               playlist, conditional = await db.run(
+                   load_sync_source, cursor, playlist_id, user_id, force
+               )
                
-               if not playlist:
-                   raise HTTPException(status_code=404, detail="Playlist not found")
-               if not playlist['url']:
-                   raise HTTPException(status_code=400, detail="Playlist has no URL")
+               request_headers = {}
+               if conditional:
+                   if playlist['upstream_etag']:
+                       request_headers['If-None-Match'] = playlist['upstream_etag']
+                   if playlist['upstream_last_modified']:
+                       request_headers['If-Modified-Since'] = playlist['upstream_last_modified']
                
-               async with session.get(playlist['url']) as response:
+               async with session.get(playlist['url'], headers=request_headers) as response:
+                   if response.status == 304 and request_headers:
+                       return await db.run(
+                           finish_unchanged_sync, db.conn, playlist_id,
+                           response.headers.get('ETag') or playlist['upstream_etag'],
+                           response.headers.get('Last-Modified') or playlist['upstream_last_modified'],
+                           playlist['upstream_digest']
+                       )
+                   
                    if response.status != 200:
                        raise HTTPException(
                            status_code=400,
                            detail=f"Failed to fetch playlist: HTTP {response.status}"
                        )
-                   content = await response.text()
                    
-               try:
-                   channels = parse_m3u(content)
-               except Exception as e:
-                   raise HTTPException(
-                       status_code=400,
-                       detail=f"Failed to parse M3U content: {str(e)}"
-                   )
-               
-               cursor.execute("BEGIN TRANSACTION")
-               try:
-                   # Mantieni i tvg_id e extra_tags esistenti
-                   existing_channels = {
-                       ch['url']: {
-                           'tvg_id': ch['tvg_id'],
-                           'extra_tags': ch['extra_tags']
-                       }
-                       for ch in cursor.execute(
-                           "SELECT url, tvg_id, extra_tags FROM channels WHERE playlist_id = ?",
-                           (playlist_id,)
-                       ).fetchall()
-                       if ch['tvg_id'] or ch['extra_tags']
-                   }
+                   try:
+                       parser = M3UStreamParser(response.charset or 'utf-8')
+                   except LookupError:
+                       parser = M3UStreamParser()
+                   digest = hashlib.sha256()
+                   unchanged = False
+                   # Tempo di parsing e di scrittura, al netto del download
+                   parse_seconds = 0.0
+                   write_seconds = 0.0
                    
-                   cursor.execute(
-                       "DELETE FROM channels WHERE playlist_id = ?",
-                       (playlist_id,)
+                   # I canali vengono appoggiati a blocchi nelle tabelle
+                   # temporanee mentre il download procede, così la memoria
+                   # resta limitata e il lock di scrittura resta libero per
+                   # le altre richieste: si prende solo in apply_sync, a
+                   # download finito. Le scritture vanno sui thread del DB.
+                   # Tabelle temporanee su file come per l'EPG: in memoria
+                   # crescerebbero con la playlist
+                   diff = PlaylistDiffSync(
+                       cursor, playlist_id,
+                       identity=playlist['sync_identity'] or 'url',
+                       batch_size=SYNC_BATCH_SIZE
                    )
-                   
-                   for i, channel in enumerate(channels, 1):
-                       existing = existing_channels.get(channel.url, {})
-                       tvg_id = existing.get('tvg_id', channel.tvg_id)
+                   await db.enter_context(disk_temp_store(db.conn))
+                   await db.run(diff.begin)
+                   try:
+                       batch = []
+                       async for chunk in response.content.iter_chunked(SYNC_CHUNK_SIZE):
+                           metrics.SYNC_FETCH_BYTES.inc(len(chunk))
+                           digest.update(chunk)
+                           parse_start = time.perf_counter()
+                           try:
+                               batch.extend(parser.feed(chunk))
+                           except Exception as e:
+                               raise HTTPException(
+                                   status_code=400,
+                                   detail=f"Failed to parse M3U content: {str(e)}"
+                               )
+                           parse_seconds += time.perf_counter() - parse_start
+                           if len(batch) >= SYNC_BATCH_SIZE:
+                               write_start = time.perf_counter()
+                               await db.run(diff.add, batch)
+                               write_seconds += time.perf_counter() - write_start
+                               batch = []
                        
-                       extra_tags = channel.extra_tags.copy()
-                       if 'extra_tags' in existing:
-                           existing_extra = json.loads(existing['extra_tags'])
-                           extra_tags.update(existing_extra)
+                       parse_start = time.perf_counter()
+                       batch.extend(parser.close())
+                       parse_seconds += time.perf_counter() - parse_start
+                       metrics.SYNC_STAGE_SECONDS.labels('parse').observe(parse_seconds)
                        
-                       cursor.execute(
-                           """INSERT INTO channels 
-                              (playlist_id, name, url, group_title, logo_url, 
-                               tvg_id, position, extra_tags)
-                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                           (
-                               playlist_id, channel.name, channel.url,
-                               channel.group, channel.logo, tvg_id,
-                               i, json.dumps(extra_tags)
+                       # Server senza validatori: contenuto identico
+                       # all'ultima sincronizzazione, si scarta tutto
+                       content_digest = digest.hexdigest()
+                       unchanged = conditional and content_digest == playlist['upstream_digest']
+                       if unchanged:
+                           await db.run(diff.rollback)
+                       else:
+                           write_start = time.perf_counter()
+                           await db.run(diff.add, batch)
+                           sync_result, touched_playlists = await db.run(
+                               apply_sync, db.conn, diff, playlist_id,
+                               response.headers.get('ETag'),
+                               response.headers.get('Last-Modified'),
+                               content_digest, parser.epg_url
                            )
-                       )
-                   
-                   cursor.execute(
-                       """UPDATE playlists 
-                          SET last_sync = CURRENT_TIMESTAMP
-                          WHERE id = ? AND user_id = ?""",
-                       (playlist_id, user_id)
-                   )
+                           write_seconds += time.perf_counter() - write_start
+                           metrics.SYNC_STAGE_SECONDS.labels('write').observe(write_seconds)
+                           rendered_playlists.invalidate(touched_playlists)
                    
-                   cursor.execute("COMMIT")
-                   create_backup()
+                   except (HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+                       await db.run(diff.rollback)
+                       raise
+                   except Exception as e:
+                       await db.run(diff.rollback)
+                       raise HTTPException(
+                           status_code=500,
+                           detail=f"Database error during sync: {str(e)}"
+                       )
                    
-               except Exception as e:
-                   cursor.execute("ROLLBACK")
-                   raise HTTPException(
-                       status_code=500,
-                       detail=f"Database error during sync: {str(e)}"
-                   )
+                   if unchanged:
+                       return await db.run(
+                           finish_unchanged_sync, db.conn, playlist_id,
+                           response.headers.get('ETag'),
+                           response.headers.get('Last-Modified'),
+                           content_digest
+                       )
+           
+           for operation in ('added', 'changed', 'removed'):
+               metrics.SYNC_ROWS.labels(operation).inc(sync_result[operation])
+           
+           # Il backup serve solo se la sincronizzazione ha cambiato qualcosa;
+           # parte in background, al massimo uno ogni BACKUP_MIN_INTERVAL
+           if sync_result['added'] or sync_result['changed'] or sync_result['removed']:
+               backup_scheduler.request()
                    
            return {
                "message": "Playlist synchronized successfully",
-               "channels_count": len(channels)
+               "not_modified": False,
+               **sync_result
            }
            
-       except aiohttp.ClientError as e:
+       except (aiohttp.ClientError, asyncio.TimeoutError) as e:
            raise HTTPException(
                status_code=400,
                detail=f"Failed to fetch playlist: {str(e)}"
            )
+
+# Parti della sync eseguite sui thread del DB
+def load_sync_source(cursor, playlist_id: int, user_id: int, force: bool):
+   playlist = cursor.execute(
+       "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
+       (playlist_id, user_id)
+   ).fetchone()
+   
+   if not playlist:
+       raise HTTPException(status_code=404, detail="Playlist not found")
+   if not playlist['url']:
+       raise HTTPException(status_code=400, detail="Playlist has no URL")
+   
+   # Richiesta condizionale solo se la playlist ha già dei canali:
+   # una playlist svuotata va sempre ricaricata per intero
+   conditional = not force and cursor.execute(
+       "SELECT 1 FROM channels WHERE playlist_id = ? LIMIT 1",
+       (playlist_id,)
+   ).fetchone() is not None
+   return playlist, conditional
+
+def apply_sync(db, diff: PlaylistDiffSync, playlist_id: int, etag: Optional[str],
+              last_modified: Optional[str], content_digest: str, epg_url: Optional[str]):
+   # Una sola transazione di scrittura, breve: solo i canali nuovi,
+   # cambiati o rimossi vengono scritti. I pragma per i caricamenti
+   # massivi valgono solo per questa transazione
+   cursor = db.cursor()
+   diff.end_staging()
+   with bulk_load_pragmas(db):
+      try:
+          sync_result = diff.apply()
+          mark_upstream_synced(cursor, playlist_id, etag, last_modified, content_digest)
+          cursor.execute(
+              "UPDATE playlists SET upstream_epg_url = ? WHERE id = ?",
+              (epg_url, playlist_id)
+          )
+          touched_playlists = []
+          if sync_result['added'] or sync_result['changed'] or sync_result['removed']:
+              touched_playlists = touch_playlists(cursor, playlist_id)
+          cursor.execute("COMMIT")
+      except Exception:
+          diff.rollback()
+          raise
+   return sync_result, touched_playlists
+
+def finish_unchanged_sync(db, playlist_id: int, etag: Optional[str],
+                          last_modified: Optional[str], content_digest: Optional[str]) -> Dict:
+   cursor = db.cursor()
+   mark_upstream_synced(cursor, playlist_id, etag, last_modified, content_digest)
+   db.commit()
+   return upstream_unchanged_result(cursor, playlist_id)
+
+def mark_upstream_synced(cursor, playlist_id: int, etag: Optional[str],
+                         last_modified: Optional[str], content_digest: Optional[str]):
+   cursor.execute(
+       """UPDATE playlists 
+          SET last_sync = CURRENT_TIMESTAMP,
+              upstream_etag = ?,
+              upstream_last_modified = ?,
+              upstream_digest = ?
+          WHERE id = ?""",
+       (etag, last_modified, content_digest, playlist_id)
+   )
+
+def upstream_unchanged_result(cursor, playlist_id: int) -> Dict:
+   channels_count = cursor.execute(
+       "SELECT COUNT(*) AS count FROM channels WHERE playlist_id = ?",
+       (playlist_id,)
+   ).fetchone()['count']
+   return {
+       "message": "Playlist not modified upstream",
+       "not_modified": True,
+       "channels_count": channels_count,
+       "added": 0,
+       "changed": 0,
+       "removed": 0,
+       "unchanged": channels_count,
+       "rebalanced": False
+   }
+
+# Guida EPG della playlist: epg_url, altrimenti l'x-tvg-url dell'header
+# M3U salvato dall'ultima sincronizzazione. Le guide sono condivise tra
+# le playlist con lo stesso URL
+epg_syncs_running = set()
+
+def playlist_epg_url(cursor, playlist_id: int, user_id: int) -> str:
+   playlist = cursor.execute(
+       "SELECT epg_url, upstream_epg_url FROM playlists WHERE id = ? AND user_id = ?",
+       (playlist_id, user_id)
+   ).fetchone()
+   if not playlist:
+       raise HTTPException(status_code=404, detail="Playlist not found")
+   url = playlist['epg_url'] or playlist['upstream_epg_url']
+   # x-tvg-url può elencare più guide separate da virgola: si usa la prima
+   url = (url or '').split(',')[0].strip()
+   if not url:
+       raise HTTPException(status_code=404, detail="Playlist has no EPG URL")
+   return url
+
+def load_playlist_epg_source(cursor, playlist_id: int, user_id: int) -> Dict:
+   source = cursor.execute(
+       "SELECT * FROM epg_sources WHERE url = ?",
+       (playlist_epg_url(cursor, playlist_id, user_id),)
+   ).fetchone()
+   if not source or not source['last_sync']:
+       raise HTTPException(status_code=404, detail="EPG not synchronized")
+   return source
+
+def epg_timestamp(value: Optional[datetime]) -> int:
+   # Date senza fuso orario intese come UTC
+   if value is None:
+       return int(time.time())
+   if value.tzinfo is None:
+       value = value.replace(tzinfo=timezone.utc)
+   return int(value.timestamp())
+
+async def run_epg_sync(playlist_id: int, user_id: int, force: bool = False) -> Dict:
+   def work():
+       with get_db() as db:
+           return playlist_epg_url(db.cursor(), playlist_id, user_id)
+   url = await run_db(work)
+   if url in epg_syncs_running:
+       raise HTTPException(status_code=409, detail="EPG sync already in progress")
+   epg_syncs_running.add(url)
+   start = time.perf_counter()
+   outcome = 'error'
+   try:
+       with profiling.profile('epg', playlist_id):
+           result = await sync_epg_from_source(url, force)
+       outcome = 'not_modified' if result['not_modified'] else 'updated'
+       return result
+   finally:
+       epg_syncs_running.discard(url)
+       metrics.EPG_SYNC_DURATION.labels(outcome).observe(time.perf_counter() - start)
+
+async def sync_epg_from_source(url: str, force: bool) -> Dict:
+   timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+   async with aiohttp.ClientSession(timeout=timeout) as session:
+       try:
+           # Come per le playlist: connessione gestita sui thread del DB
+           async with DBSession() as db:
+               cursor = db.conn.cursor()
+               source = await db.run(load_epg_source, db.conn, url)
+               
+               request_headers = {}
+               if not force and source['last_sync']:
+                   if source['upstream_etag']:
+                       request_headers['If-None-Match'] = source['upstream_etag']
+                   if source['upstream_last_modified']:
+                       request_headers['If-Modified-Since'] = source['upstream_last_modified']
+               
+               async with session.get(url, headers=request_headers) as response:
+                   if response.status == 304 and request_headers:
+                       return await db.run(
+                           finish_unchanged_epg_sync, db.conn, source['id'],
+                           response.headers.get('ETag') or source['upstream_etag'],
+                           response.headers.get('Last-Modified') or source['upstream_last_modified']
+                       )
+                   
+                   if response.status != 200:
+                       raise HTTPException(
+                           status_code=400,
+                           detail=f"Failed to fetch EPG: HTTP {response.status}"
+                       )
+                   
+                   # Download, decompressione e parsing a blocchi; i programmi
+                   # vanno in tabelle temporanee su disco, quindi la memoria
+                   # non dipende dalla dimensione della guida
+                   decoder = GzipAwareDecoder()
+                   parser = XMLTVStreamParser()
+                   diff = EPGDiffSync(cursor, source['id'])
+                   await db.enter_context(disk_temp_store(db.conn))
+                   await db.run(diff.begin)
+                   try:
+                       channels, programmes = [], []
+                       async for chunk in response.content.iter_chunked(SYNC_CHUNK_SIZE):
+                           metrics.EPG_FETCH_BYTES.inc(len(chunk))
+                           new_channels, new_programmes = parser.feed(decoder.decode(chunk))
+                           channels.extend(new_channels)
+                           programmes.extend(new_programmes)
+                           if len(programmes) >= EPG_BATCH_SIZE:
+                               await db.run(diff.add, channels, programmes)
+                               channels, programmes = [], []
+                       
+                       for new_channels, new_programmes in (parser.feed(decoder.close()), parser.close()):
+                           channels.extend(new_channels)
+                           programmes.extend(new_programmes)
+                       await db.run(diff.add, channels, programmes)
+                       sync_result = await db.run(
+                           diff.apply,
+                           response.headers.get('ETag'),
+                           response.headers.get('Last-Modified')
+                       )
+                   except EPGError as e:
+                       await db.run(diff.rollback)
+                       raise HTTPException(status_code=400, detail=f"Failed to parse EPG: {str(e)}")
+                   except (HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+                       await db.run(diff.rollback)
+                       raise
+                   except Exception as e:
+                       await db.run(diff.rollback)
+                       raise HTTPException(
+                           status_code=500,
+                           detail=f"Database error during EPG sync: {str(e)}"
+                       )
+           
+           for operation, key in (('changed', 'windows_changed'), ('removed', 'windows_removed'),
+                                  ('unchanged', 'windows_unchanged')):
+               metrics.EPG_WINDOWS.labels(operation).inc(sync_result[key])
+           # Niente backup: la guida si riscarica dal provider
+           return {
+               "message": "EPG synchronized successfully",
+               "url": url,
+               "skipped": parser.skipped,
+               **sync_result
+           }
            
+       except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+           raise HTTPException(
+               status_code=400,
+               detail=f"Failed to fetch EPG: {str(e)}"
+           )
+
+def load_epg_source(db, url: str) -> Dict:
+   cursor = db.cursor()
+   cursor.execute("INSERT OR IGNORE INTO epg_sources (url) VALUES (?)", (url,))
+   db.commit()
+   return cursor.execute("SELECT * FROM epg_sources WHERE url = ?", (url,)).fetchone()
+
+def finish_unchanged_epg_sync(db, source_id: int, etag: Optional[str],
+                              last_modified: Optional[str]) -> Dict:
+   cursor = db.cursor()
+   cursor.execute(
+       """UPDATE epg_sources
+          SET last_sync = CURRENT_TIMESTAMP, upstream_etag = ?, upstream_last_modified = ?
+          WHERE id = ?""",
+       (etag, last_modified, source_id)
+   )
+   db.commit()
+   source = cursor.execute(
+       "SELECT url, channels_count, programmes_count FROM epg_sources WHERE id = ?",
+       (source_id,)
+   ).fetchone()
+   return {
+       "message": "EPG not modified upstream",
+       "not_modified": True,
+       "url": source['url'],
+       "channels": source['channels_count'],
+       "programmes": source['programmes_count'],
+   }
+
+@app.post(
+   "/playlists/{playlist_id}/epg/sync",
+   dependencies=[Depends(rate_limit(sync_limiter, user_limit_key))]
+)
+async def sync_playlist_epg(
+   playlist_id: int,
+   request: Request,
+   response: Response,
+   force: bool = False,
+   user_id: int = Depends(get_current_user_id)
+):
+   profile_request = await admin_profile_request(request)
+   result = await run_epg_sync(playlist_id, user_id, force)
+   if profile_request is not None and profile_request.ids:
+       response.headers["X-Profile-Id"] = profile_request.ids[0]
+   return result
+
+@app.get("/playlists/{playlist_id}/epg", response_model=EPGSource)
+async def get_playlist_epg(
+   playlist_id: int,
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+       with get_db() as db:
+           return load_playlist_epg_source(db.cursor(), playlist_id, user_id)
+   return await run_db(work)
+
+@app.get("/playlists/{playlist_id}/epg/now", response_model=EPGNowNext)
+async def get_playlist_epg_now(
+   playlist_id: int,
+   tvg_id: str,
+   at: Optional[datetime] = None,
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+       with get_db() as db:
+           cursor = db.cursor()
+           source = load_playlist_epg_source(cursor, playlist_id, user_id)
+           return now_next(cursor, source['id'], tvg_id, epg_timestamp(at))
+   return await run_db(work)
+
+@app.get("/playlists/{playlist_id}/epg/programmes", response_model=List[EPGProgramme])
+async def get_playlist_epg_programmes(
+   playlist_id: int,
+   tvg_id: str,
+   start: Optional[datetime] = None,
+   end: Optional[datetime] = None,
+   limit: int = Query(EPG_PROGRAMMES_DEFAULT, ge=1, le=EPG_PROGRAMMES_MAX),
+   user_id: int = Depends(get_current_user_id)
+):
+   range_start = epg_timestamp(start)
+   range_end = epg_timestamp(end) if end is not None else range_start + EPG_RANGE_DEFAULT
+   if range_end <= range_start:
+       raise HTTPException(status_code=400, detail="end must be after start")
+   def work():
+       with get_db() as db:
+           cursor = db.cursor()
+           source = load_playlist_epg_source(cursor, playlist_id, user_id)
+           return programmes_between(cursor, source, tvg_id, range_start, range_end, limit)
+   return await run_db(work)
+
+# Abbinamento automatico dei tvg_id ai canali della guida
+def mapping_playlist(cursor, playlist_id: int, user_id: int):
+   playlist = cursor.execute(
+       "SELECT is_custom FROM playlists WHERE id = ? AND user_id = ?",
+       (playlist_id, user_id)
+   ).fetchone()
+   if not playlist:
+       raise HTTPException(status_code=404, detail="Playlist not found")
+   if playlist['is_custom']:
+       raise HTTPException(
+           status_code=400,
+           detail="Custom playlists use channels of other playlists"
+       )
+
+@app.get("/playlists/{playlist_id}/epg/mapping", response_model=List[TvgMappingProposal])
+async def get_tvg_mapping(
+   playlist_id: int,
+   min_score: float = Query(TVG_MATCH_MIN_SCORE, ge=0, le=1),
+   limit: int = Query(TVG_MATCH_LIMIT, ge=1, le=20),
+   include_mapped: bool = False,
+   group_title: Optional[str] = None,
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+       with get_db() as db:
+           cursor = db.cursor()
+           mapping_playlist(cursor, playlist_id, user_id)
+           index = load_tvg_index(cursor, load_playlist_epg_source(cursor, playlist_id, user_id))
+           return propose_mappings(
+               cursor, index, playlist_id, limit, min_score, include_mapped, group_title
+           )
+   return await run_db(work)
+
+@app.post("/playlists/{playlist_id}/epg/mapping", response_model=TvgMappingResult)
+async def apply_tvg_mapping(
+   playlist_id: int,
+   mapping: TvgMappingApply,
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+       with get_db() as db:
+           cursor = db.cursor()
+           mapping_playlist(cursor, playlist_id, user_id)
+           mappings = {item.channel_id: item.tvg_id for item in mapping.mappings}
+           if mapping.min_score is not None:
+               # Gli abbinamenti espliciti hanno la precedenza su quelli automatici
+               index = load_tvg_index(cursor, load_playlist_epg_source(cursor, playlist_id, user_id))
+               for proposal in propose_mappings(cursor, index, playlist_id, 1, mapping.min_score):
+                   if proposal['candidates'] and proposal['channel_id'] not in mappings:
+                       mappings[proposal['channel_id']] = proposal['candidates'][0]['tvg_id']
+           
+           updated = apply_mappings(cursor, playlist_id, mappings.items())
+           if updated:
+               rendered_playlists.invalidate(touch_playlists(cursor, playlist_id))
+           return {"requested": len(mappings), "updated": updated}
+   return await run_db(work)
+
+# Controllo degli stream: uno alla volta per playlist, esiti scritti a
+# blocchi mentre le prove continuano. Se un canale diventa morto (o torna
+# vivo) cambia la versione delle playlist che lo contengono, così le
+# playlist pubbliche con exclude_dead non restano vecchie
+health_checker = StreamHealthChecker()
+
+def health_playlist(cursor, playlist_id: int, user_id: int) -> Dict:
+   playlist = cursor.execute(
+       "SELECT id, is_custom FROM playlists WHERE id = ? AND user_id = ?",
+       (playlist_id, user_id)
+   ).fetchone()
+   if not playlist:
+       raise HTTPException(status_code=404, detail="Playlist not found")
+   return playlist
+
+async def run_health_check(playlist_id: int, user_id: int) -> Dict:
+   if health_checker.is_running(playlist_id):
+       raise HTTPException(status_code=409, detail="Health check already in progress")
+   def load():
+       with get_db() as db:
+           cursor = db.cursor()
+           return health_targets(cursor, health_playlist(cursor, playlist_id, user_id))
+   targets = await run_db(load)
+   
+   async def record(rows):
+       def work():
+           with get_db() as db:
+               record_health(db.cursor(), rows)
+       await run_db(work)
+   
+   start = time.perf_counter()
+   outcome = 'error'
+   try:
+       result = await health_checker.check(playlist_id, targets, record)
+       outcome = 'ok'
+   except HealthCheckRunning as e:
+       outcome = 'conflict'
+       raise HTTPException(status_code=409, detail=str(e))
+   finally:
+       metrics.HEALTH_CHECK_DURATION.labels(outcome).observe(time.perf_counter() - start)
+   
+   changed = result.pop('changed_playlists')
+   if changed:
+       def touch():
+           with get_db() as db:
+               cursor = db.cursor()
+               touched = set()
+               for changed_id in changed:
+                   touched.update(touch_playlists(cursor, changed_id))
+               rendered_playlists.invalidate(touched)
+       await run_db(touch)
+   return {**result, "changed": bool(changed), "duration": round(time.perf_counter() - start, 3)}
+
+@app.post(
+   "/playlists/{playlist_id}/health/check", response_model=HealthCheckResult,
+   dependencies=[Depends(rate_limit(sync_limiter, user_limit_key))]
+)
+async def check_playlist_health(
+   playlist_id: int,
+   user_id: int = Depends(get_current_user_id)
+):
+   return await run_health_check(playlist_id, user_id)
+
+@app.get("/playlists/{playlist_id}/health", response_model=PlaylistHealth)
+async def get_playlist_health(
+   playlist_id: int,
+   health: Optional[HealthFilter] = None,
+   limit: int = Query(CHANNELS_PAGE_DEFAULT, ge=0, le=CHANNELS_PAGE_MAX),
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+       with get_db() as db:
+           cursor = db.cursor()
+           playlist = health_playlist(cursor, playlist_id, user_id)
+           summary = dict(health_summary(cursor, playlist))
+           summary['details'] = channel_health_list(cursor, playlist, health, limit) if limit else []
+           summary['running'] = health_checker.is_running(playlist_id)
+           return summary
+   return await run_db(work)
+
+sync_scheduler = SyncScheduler(run_playlist_sync)
+backup_scheduler = BackupScheduler()
+
+# Valori già tenuti da pool, cache, limiter e backup: letti solo quando
+# /metrics viene interrogato
+def cache_lookups():
+   for name, stats in (('rendered_playlists', rendered_playlists.stats()), ('users', user_cache.stats())):
+       yield (name, 'hit'), stats['hits']
+       yield (name, 'miss'), stats['misses']
+
+def cache_entries():
+   yield ('rendered_playlists',), rendered_playlists.stats()['entries']
+   yield ('users',), user_cache.stats()['size']
+
+def pool_connections():
+   stats = db_pool.stats()
+   yield ('idle',), stats['idle']
+   yield ('in_use',), stats['in_use']
+
+def pool_events():
+   stats = db_pool.stats()
+   for event in ('created', 'reused', 'discarded', 'health_check_failures'):
+       yield (event,), stats[event]
+
+def rate_limit_decisions():
+   for name, limiter in (('login', login_limiter), ('sync', sync_limiter), ('public', public_limiter)):
+       stats = limiter.stats()
+       yield (name, 'allowed'), stats['allowed']
+       yield (name, 'rejected'), stats['rejected']
+
+metrics.registry.callback(
+   'omg_cache_lookups', 'Cache lookups by cache and result', 'counter',
+   cache_lookups, ('cache', 'result')
+)
+metrics.registry.callback(
+   'omg_cache_entries', 'Entries held by each cache', 'gauge', cache_entries, ('cache',)
+)
+metrics.registry.callback(
+   'omg_cache_rendered_playlists_bytes', 'Bytes held by the rendered playlist cache', 'gauge',
+   lambda: [((), rendered_playlists.stats()['bytes'])]
+)
+metrics.registry.callback(
+   'omg_db_pool_connections', 'Pooled DB connections by state', 'gauge',
+   pool_connections, ('state',)
+)
+metrics.registry.callback(
+   'omg_db_pool_events', 'DB pool connection events', 'counter', pool_events, ('event',)
+)
+metrics.registry.callback(
+   'omg_rate_limit_decisions', 'Rate limiter decisions', 'counter',
+   rate_limit_decisions, ('limiter', 'decision')
+)
+metrics.registry.callback(
+   'omg_backup_pending', 'Whether a backup is waiting to run', 'gauge',
+   lambda: [((), int(backup_scheduler.stats()['pending']))]
+)
+
 # Channel management endpoints
+@app.get("/channels/search", response_model=List[ChannelSearchResult])
+async def search_channels(
+   q: str = Query(..., min_length=1, max_length=200),
+   limit: int = Query(SEARCH_DEFAULT, ge=1, le=SEARCH_MAX),
+   playlist_id: Optional[int] = None,
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+      with get_db() as db:
+          return run_channel_search(db.cursor(), user_id, q, limit, playlist_id)
+   return await run_db(work)
+
 @app.post("/playlists/{playlist_id}/channels", response_model=Channel)
 async def add_channel(
    playlist_id: int,
    channel: ChannelCreate,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
        
-       playlist = cursor.execute(
-           "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-           (playlist_id, user_id)
-       ).fetchone()
+          playlist = cursor.execute(
+              "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          ).fetchone()
        
-       if not playlist:
-           raise HTTPException(status_code=404, detail="Playlist not found")
-           
-       try:
-           max_pos = cursor.execute(
-               """SELECT MAX(position) as max_pos 
-                  FROM channels 
-                  WHERE playlist_id = ?""",
-               (playlist_id,)
-           ).fetchone()
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Playlist not found")
            
-           next_pos = (max_pos['max_pos'] or 0) + 1 if max_pos else 1
+          try:
+              next_pos = next_position(cursor, playlist)
            
-           cursor.execute(
-               """INSERT INTO channels 
-                  (playlist_id, name, url, group_title, logo_url, position, 
-                   tvg_id, extra_tags)
-                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-               (
-                   playlist_id, channel.name, channel.url,
-                   channel.group_title, channel.logo_url, next_pos,
-                   channel.tvg_id, json.dumps(channel.extra_tags or {})
-               )
-           )
+              cursor.execute(
+                  """INSERT INTO channels 
+                     (playlist_id, name, url, group_title, logo_url, position, 
+                      tvg_id, extra_tags)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                  (
+                      playlist_id, channel.name, channel.url,
+                      channel.group_title, channel.logo_url, next_pos,
+                      channel.tvg_id, json.dumps(channel.extra_tags or {})
+                  )
+              )
+              new_channel_id = cursor.lastrowid
+              rendered_playlists.invalidate(touch_playlists(cursor, playlist_id))
            
-           new_channel = cursor.execute(
-               "SELECT * FROM channels WHERE id = ?",
-               (cursor.lastrowid,)
-           ).fetchone()
+              new_channel = cursor.execute(
+                  "SELECT * FROM channels WHERE id = ?",
+                  (new_channel_id,)
+              ).fetchone()
            
-           return dict(new_channel)
+              return dict(new_channel)
            
-       except sqlite3.Error as e:
-           raise HTTPException(
-               status_code=500,
-               detail=f"Database error: {str(e)}"
-           )
+          except sqlite3.Error as e:
+              raise HTTPException(
+                  status_code=500,
+                  detail=f"Database error: {str(e)}"
+              )
+   return await run_db(work)
 
 @app.put("/channels/{channel_id}", response_model=Channel)
 async def update_channel(
@@ -407,79 +1237,87 @@ async def update_channel(
    channel: ChannelUpdate,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
        
-       channel_data = cursor.execute("""
-           SELECT c.* 
-           FROM channels c
-           JOIN playlists p ON c.playlist_id = p.id
-           WHERE c.id = ? AND p.user_id = ?
-       """, (channel_id, user_id)).fetchone()
-       
-       if not channel_data:
-           raise HTTPException(status_code=404, detail="Channel not found")
-       
-       update_fields = []
-       values = []
-       
-       if channel.name is not None:
-           update_fields.append("name = ?")
-           values.append(channel.name)
-       if channel.url is not None:
-           update_fields.append("url = ?")
-           values.append(channel.url)
-       if channel.group_title is not None:
-           update_fields.append("group_title = ?")
-           values.append(channel.group_title)
-       if channel.logo_url is not None:
-           update_fields.append("logo_url = ?")
-           values.append(channel.logo_url)
-       if channel.tvg_id is not None:
-           update_fields.append("tvg_id = ?")
-           values.append(channel.tvg_id)
-       if channel.extra_tags is not None:
-           update_fields.append("extra_tags = ?")
-           values.append(json.dumps(channel.extra_tags))
-       
-       if update_fields:
-           values.append(channel_id)
-           cursor.execute(
-               f"""UPDATE channels 
-                   SET {', '.join(update_fields)}
-                   WHERE id = ?""",
-               tuple(values)
-           )
+          channel_data = cursor.execute("""
+              SELECT c.* 
+              FROM channels c
+              JOIN playlists p ON c.playlist_id = p.id
+              WHERE c.id = ? AND p.user_id = ?
+          """, (channel_id, user_id)).fetchone()
+       
+          if not channel_data:
+              raise HTTPException(status_code=404, detail="Channel not found")
+       
+          update_fields = []
+          values = []
+       
+          if channel.name is not None:
+              update_fields.append("name = ?")
+              values.append(channel.name)
+          if channel.url is not None:
+              update_fields.append("url = ?")
+              values.append(channel.url)
+          if channel.group_title is not None:
+              update_fields.append("group_title = ?")
+              values.append(channel.group_title)
+          if channel.logo_url is not None:
+              update_fields.append("logo_url = ?")
+              values.append(channel.logo_url)
+          if channel.tvg_id is not None:
+              update_fields.append("tvg_id = ?")
+              values.append(channel.tvg_id)
+          if channel.extra_tags is not None:
+              update_fields.append("extra_tags = ?")
+              values.append(json.dumps(channel.extra_tags))
+       
+          if update_fields:
+              values.append(channel_id)
+              cursor.execute(
+                  f"""UPDATE channels 
+                      SET {', '.join(update_fields)}
+                      WHERE id = ?""",
+                  tuple(values)
+              )
+              rendered_playlists.invalidate(
+                  touch_playlists(cursor, channel_data['playlist_id'])
+              )
            
-           updated_channel = cursor.execute(
-               "SELECT * FROM channels WHERE id = ?",
-               (channel_id,)
-           ).fetchone()
+              updated_channel = cursor.execute(
+                  "SELECT * FROM channels WHERE id = ?",
+                  (channel_id,)
+              ).fetchone()
            
-           return dict(updated_channel)
+              return dict(updated_channel)
        
-       return dict(channel_data)
+          return dict(channel_data)
+   return await run_db(work)
 
 @app.delete("/channels/{channel_id}")
 async def delete_channel(
    channel_id: int,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
        
-       channel = cursor.execute("""
-           SELECT c.* 
-           FROM channels c
-           JOIN playlists p ON c.playlist_id = p.id
-           WHERE c.id = ? AND p.user_id = ?
-       """, (channel_id, user_id)).fetchone()
+          channel = cursor.execute("""
+              SELECT c.* 
+              FROM channels c
+              JOIN playlists p ON c.playlist_id = p.id
+              WHERE c.id = ? AND p.user_id = ?
+          """, (channel_id, user_id)).fetchone()
        
-       if not channel:
-           raise HTTPException(status_code=404, detail="Channel not found")
+          if not channel:
+              raise HTTPException(status_code=404, detail="Channel not found")
        
-       cursor.execute("DELETE FROM channels WHERE id = ?", (channel_id,))
-       return {"message": "Channel deleted"}
+          rendered_playlists.invalidate(touch_playlists(cursor, channel['playlist_id']))
+          cursor.execute("DELETE FROM channels WHERE id = ?", (channel_id,))
+          return {"message": "Channel deleted"}
+   return await run_db(work)
 
 @app.put("/playlists/{playlist_id}/channels/reorder")
 async def reorder_channels(
@@ -487,125 +1325,253 @@ async def reorder_channels(
    channel_orders: List[ChannelOrder],
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
        
-       playlist = cursor.execute(
-           "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-           (playlist_id, user_id)
-       ).fetchone()
+          playlist = cursor.execute(
+              "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          ).fetchone()
        
-       if not playlist:
-           raise HTTPException(status_code=404, detail="Playlist not found")
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Playlist not found")
        
-       try:
-           cursor.execute("BEGIN TRANSACTION")
+          try:
+              cursor.execute("BEGIN TRANSACTION")
            
-           for order in channel_orders:
-               if playlist['is_custom']:
-                   cursor.execute("""
-                       UPDATE custom_playlist_channels 
-                       SET position = ? 
-                       WHERE playlist_id = ? AND channel_id = ?
-                   """, (order.position, playlist_id, order.id))
-               else:
-                   cursor.execute("""
-                       UPDATE channels 
-                       SET position = ? 
-                       WHERE id = ? AND playlist_id = ?
-                   """, (order.position, order.id, playlist_id))
+              for order in channel_orders:
+                  if playlist['is_custom']:
+                      cursor.execute("""
+                          UPDATE custom_playlist_channels 
+                          SET position = ? 
+                          WHERE playlist_id = ? AND channel_id = ?
+                      """, (order.position, playlist_id, order.id))
+                  else:
+                      cursor.execute("""
+                          UPDATE channels 
+                          SET position = ? 
+                          WHERE id = ? AND playlist_id = ?
+                      """, (order.position, order.id, playlist_id))
            
-           cursor.execute("COMMIT")
-           return {"message": "Channels reordered successfully"}
-           
-       except Exception as e:
-           cursor.execute("ROLLBACK")
-           raise HTTPException(
-               status_code=400,
-               detail=f"Error reordering channels: {str(e)}"
-           )
+              touched_playlists = touch_playlists(cursor, playlist_id)
+              cursor.execute("COMMIT")
+              rendered_playlists.invalidate(touched_playlists)
+              return {"message": "Channels reordered successfully"}
            
+          except Exception as e:
+              cursor.execute("ROLLBACK")
+              raise HTTPException(
+                  status_code=400,
+                  detail=f"Error reordering channels: {str(e)}"
+              )
+   return await run_db(work)
+
+# Spostamento di uno o più canali (in blocco, nell'ordine dato) prima o
+# dopo un altro canale: si aggiornano solo le posizioni dei canali spostati
+@app.post("/playlists/{playlist_id}/channels/move")
+async def move_playlist_channels(
+   playlist_id: int,
+   move: ChannelMove,
+   user_id: int = Depends(get_current_user_id)
+):
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
+       
+          playlist = cursor.execute(
+              "SELECT id, is_custom FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          ).fetchone()
+       
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Playlist not found")
+       
+          try:
+              result = move_channels(
+                  cursor, playlist, move.channel_ids,
+                  before_id=move.before_id, after_id=move.after_id
+              )
+          except ChannelNotFound as e:
+              raise HTTPException(status_code=404, detail=str(e))
+          except MoveError as e:
+              raise HTTPException(status_code=400, detail=str(e))
+       
+          rendered_playlists.invalidate(touch_playlists(cursor, playlist_id))
+          return {"message": "Channels moved successfully", **result}
+   return await run_db(work)
+
 # Public playlist endpoints
 @app.post("/playlists/{playlist_id}/generate-token")
 async def generate_public_token(
    playlist_id: int,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
        
-       playlist = cursor.execute(
-           "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-           (playlist_id, user_id)
-       ).fetchone()
+          playlist = cursor.execute(
+              "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
+              (playlist_id, user_id)
+          ).fetchone()
        
-       if not playlist:
-           raise HTTPException(status_code=404, detail="Playlist not found")
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Playlist not found")
        
-       token = str(uuid.uuid4())
-       cursor.execute(
-           "UPDATE playlists SET public_token = ? WHERE id = ?",
-           (token, playlist_id)
-       )
+          token = str(uuid.uuid4())
+          cursor.execute(
+              "UPDATE playlists SET public_token = ? WHERE id = ?",
+              (token, playlist_id)
+          )
        
-       base_url = "/api/playlists"
-       return {
-           "token": token,
-           "public_url": f"{base_url}/{token}/m3u",
-           "epg_url": playlist['epg_url']
-       }
-
-@app.get("/public/playlist/{token}/m3u", response_class=PlainTextResponse)
-@sleep_and_retry
-@limits(calls=30, period=60)
-async def get_public_playlist(token: str):
-   with get_db() as db:
-       playlist = db.execute(
-           "SELECT * FROM playlists WHERE public_token = ?",
-           (token,)
-       ).fetchone()
-       
-       if not playlist:
-           raise HTTPException(status_code=404, detail="Playlist not found")
-       
-       if playlist['is_custom']:
-           channels_query = """
-               SELECT c.* 
-               FROM channels c
-               JOIN custom_playlist_channels cpc ON c.id = cpc.channel_id
-               WHERE cpc.playlist_id = ?
-               ORDER BY cpc.position, c.name
-           """
-       else:
-           channels_query = """
-               SELECT * FROM channels 
-               WHERE playlist_id = ?
-               ORDER BY position, created_at
-           """
-       
-       rows = db.execute(channels_query, (playlist['id'],)).fetchall()
-       
-       channels = []
-       for row in rows:
-           extra_tags = json.loads(row['extra_tags']) if row['extra_tags'] else {}
-           channels.append(M3UChannel(
-               name=row['name'],
-               url=row['url'],
-               group=row['group_title'],
-               logo=row['logo_url'],
-               tvg_id=row['tvg_id'],
-               extra_tags=extra_tags
-           ))
-       
-       content = generate_m3u(channels, playlist.get('epg_url'))
-       
-       return PlainTextResponse(
-           content,
+          base_url = "/api/playlists"
+          return {
+              "token": token,
+              "public_url": f"{base_url}/{token}/m3u",
+              "epg_url": playlist['epg_url']
+          }
+   return await run_db(work)
+
+def channel_from_row(row: Dict) -> M3UChannel:
+   return M3UChannel(
+       name=row['name'],
+       url=row['url'],
+       group=row['group_title'],
+       logo=row['logo_url'],
+       tvg_id=row['tvg_id'],
+       extra_tags=row['extra_tags']
+   )
+
+async def stream_playlist_m3u(playlist: Dict, compress: bool, exclude_dead: bool = False):
+   if playlist['is_custom']:
+       channels_query = """
+           SELECT c.name, c.url, c.group_title, c.logo_url, c.tvg_id, c.extra_tags
+           FROM channels c
+           JOIN custom_playlist_channels cpc ON c.id = cpc.channel_id
+           WHERE cpc.playlist_id = ? {filter}
+           ORDER BY cpc.position, c.name
+       """
+   else:
+       channels_query = """
+           SELECT c.name, c.url, c.group_title, c.logo_url, c.tvg_id, c.extra_tags
+           FROM channels c
+           WHERE c.playlist_id = ? {filter}
+           ORDER BY c.position, c.created_at
+       """
+   params = [playlist['id']]
+   if exclude_dead:
+       condition, condition_params = health_condition('c', 'not_dead')
+       channels_query = channels_query.format(filter=f"AND {condition}")
+       params.extend(condition_params)
+   else:
+       channels_query = channels_query.format(filter="")
+   
+   # Le righe vengono lette e renderizzate a blocchi: la memoria usata
+   # per richiesta non dipende dalla dimensione della playlist. Intanto
+   # l'output viene accumulato per la cache delle playlist renderizzate
+   # (solo la versione completa: quella filtrata non va in cache)
+   builder = rendered_playlists.builder(
+       playlist['id'], playlist['content_version'], compress, store=not exclude_dead
+   )
+   
+   # Tempo di rendering (senza le attese del client) e byte non compressi
+   rendered = {'seconds': 0.0, 'bytes': 0}
+   
+   # Lettura, rendering e compressione di ogni blocco sui thread del DB
+   def next_chunk(cursor) -> Optional[bytes]:
+       start = time.perf_counter()
+       rows = cursor.fetchmany(PUBLIC_FETCH_SIZE)
+       if not rows:
+           return None
+       chunk = ''.join(render_m3u_entry(channel_from_row(row)) for row in rows).encode('utf-8')
+       data = builder.write(chunk)
+       rendered['bytes'] += len(chunk)
+       rendered['seconds'] += time.perf_counter() - start
+       return data
+   
+   # Connessione gestita sui thread del DB: se il client si disconnette
+   # durante una lettura, torna al pool solo a lettura finita
+   async with DBSession() as db:
+       cursor = await db.run(db.conn.execute, channels_query, params)
+       header = render_m3u_header(playlist['epg_url']).encode('utf-8')
+       rendered['bytes'] += len(header)
+       yield builder.write(header)
+       
+       while True:
+           chunk = await db.run(next_chunk, cursor)
+           if chunk is None:
+               break
+           yield chunk
+   
+   tail = builder.close()
+   metrics.PUBLIC_RENDER_SECONDS.observe(rendered['seconds'])
+   metrics.PUBLIC_RENDER_BYTES.observe(rendered['bytes'])
+   if tail:
+       yield tail
+
+@app.get("/public/playlist/{token}/m3u", response_class=StreamingResponse)
+async def get_public_playlist(token: str, request: Request, exclude_dead: bool = False):
+   def work():
+      with get_db() as db:
+          return db.execute(
+              "SELECT * FROM playlists WHERE public_token = ?",
+              (token,)
+          ).fetchone()
+   playlist = await run_db(work)
+   
+   if not playlist:
+       enforce_rate_limit(public_limiter, public_limit_key(request))
+       raise HTTPException(status_code=404, detail="Playlist not found")
+   
+   version = playlist['content_version']
+   last_modified = playlist['content_updated_at'] or playlist['created_at']
+   compress = accepts_gzip(request.headers.get('accept-encoding'))
+   
+   headers = {
+       "Content-Disposition": f'attachment; filename="{playlist["name"]}.m3u"',
+       "ETag": make_etag(playlist['id'], version, compress, 'alive' if exclude_dead else ''),
+       "Last-Modified": http_date(last_modified),
+       "Cache-Control": "no-cache",
+       "Vary": "Accept-Encoding"
+   }
+   if compress:
+       headers["Content-Encoding"] = "gzip"
+   
+   if is_not_modified(request.headers, headers["ETag"], last_modified):
+       metrics.PUBLIC_RESPONSES.labels('not_modified').inc()
+       headers.pop("Content-Encoding", None)
+       return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+   
+   # Solo le risposte con il corpo consumano token: i decoder che
+   # ricontrollano spesso la playlist ricevono quasi sempre 304
+   enforce_rate_limit(public_limiter, public_limit_key(request, token))
+   
+   await admin_profile_request(request)
+   session = profiling.start_if_requested('public', playlist['id'])
+   if session is not None:
+       headers["X-Profile-Id"] = session.id
+   
+   cached = None if exclude_dead else rendered_playlists.get(playlist['id'], version)
+   if cached is not None:
+       metrics.PUBLIC_RESPONSES.labels('cache').inc()
+       if session is not None:
+           session.finish()
+       return Response(
+           cached.gzip_body if compress else cached.body,
            media_type="application/x-mpegurl",
-           headers={
-               "Content-Disposition": f'attachment; filename="{playlist["name"]}.m3u"'
-           }
+           headers=headers
        )
+   
+   metrics.PUBLIC_RESPONSES.labels('rendered').inc()
+   body = stream_playlist_m3u(playlist, compress, exclude_dead)
+   if session is not None:
+       body = profiling.profiled_stream(body, session)
+   return StreamingResponse(
+       body,
+       media_type="application/x-mpegurl",
+       headers=headers
+   )
 
 # Custom playlist management
 @app.post("/playlists/{playlist_id}/add-channel/{channel_id}")
@@ -614,78 +1580,79 @@ async def add_channel_to_custom_playlist(
    channel_id: int,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       cursor = db.cursor()
+   def work():
+      with get_db() as db:
+          cursor = db.cursor()
        
-       playlist = cursor.execute(
-           """SELECT * FROM playlists 
-              WHERE id = ? AND user_id = ? AND is_custom = 1""",
-           (playlist_id, user_id)
-       ).fetchone()
+          playlist = cursor.execute(
+              """SELECT * FROM playlists 
+                 WHERE id = ? AND user_id = ? AND is_custom = 1""",
+              (playlist_id, user_id)
+          ).fetchone()
        
-       if not playlist:
-           raise HTTPException(status_code=404, detail="Custom playlist not found")
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Custom playlist not found")
        
-       channel = cursor.execute("""
-           SELECT c.* 
-           FROM channels c
-           JOIN playlists p ON c.playlist_id = p.id
-           WHERE c.id = ? AND p.user_id = ?
-       """, (channel_id, user_id)).fetchone()
+          channel = cursor.execute("""
+              SELECT c.* 
+              FROM channels c
+              JOIN playlists p ON c.playlist_id = p.id
+              WHERE c.id = ? AND p.user_id = ?
+          """, (channel_id, user_id)).fetchone()
        
-       if not channel:
-           raise HTTPException(status_code=404, detail="Channel not found")
+          if not channel:
+              raise HTTPException(status_code=404, detail="Channel not found")
        
-       try:
-           max_pos = cursor.execute(
-               """SELECT MAX(position) as max_pos 
-                  FROM custom_playlist_channels 
-                  WHERE playlist_id = ?""",
-               (playlist_id,)
-           ).fetchone()
+          try:
+              next_pos = next_position(cursor, playlist)
            
-           next_pos = (max_pos['max_pos'] or 0) + 1
-           
-           cursor.execute(
-               """INSERT INTO custom_playlist_channels 
-                  (playlist_id, channel_id, position)
-                  VALUES (?, ?, ?)""",
-               (playlist_id, channel_id, next_pos)
-           )
+              cursor.execute(
+                  """INSERT INTO custom_playlist_channels 
+                     (playlist_id, channel_id, position)
+                     VALUES (?, ?, ?)""",
+                  (playlist_id, channel_id, next_pos)
+              )
+              rendered_playlists.invalidate(touch_playlists(cursor, playlist_id))
            
-           return {"message": "Channel added to playlist"}
+              return {"message": "Channel added to playlist"}
            
-       except sqlite3.IntegrityError:
-           raise HTTPException(status_code=400, detail="Channel already in playlist")
+          except sqlite3.IntegrityError:
+              raise HTTPException(status_code=400, detail="Channel already in playlist")
+   return await run_db(work)
 
-@app.get("/playlists/{playlist_id}/channels-available")
+@app.get("/playlists/{playlist_id}/channels-available", response_model=AvailableChannelPage)
 async def get_available_channels(
    playlist_id: int,
+   cursor: Optional[str] = None,
+   limit: int = Query(CHANNELS_PAGE_DEFAULT, ge=1, le=CHANNELS_PAGE_MAX),
+   source_playlist_id: Optional[int] = None,
+   group_title: Optional[str] = None,
+   q: Optional[str] = Query(None, max_length=200),
+   health: Optional[HealthFilter] = None,
    user_id: int = Depends(get_current_user_id)
 ):
-   with get_db() as db:
-       playlist = db.execute(
-           """SELECT * FROM playlists 
-              WHERE id = ? AND user_id = ? AND is_custom = 1""",
-           (playlist_id, user_id)
-       ).fetchone()
-       
-       if not playlist:
-           raise HTTPException(status_code=404, detail="Custom playlist not found")
-       
-       channels = db.execute("""
-           SELECT c.*, p.name as source_playlist_name 
-           FROM channels c
-           JOIN playlists p ON c.playlist_id = p.id
-           WHERE p.user_id = ? AND c.id NOT IN (
-               SELECT channel_id 
-               FROM custom_playlist_channels 
-               WHERE playlist_id = ?
-           )
-           ORDER BY p.name, c.position, c.name
-       """, (user_id, playlist_id)).fetchall()
+   def work():
+      with get_db() as db:
+          playlist = db.execute(
+              """SELECT id FROM playlists 
+                 WHERE id = ? AND user_id = ? AND is_custom = 1""",
+              (playlist_id, user_id)
+          ).fetchone()
+       
+          if not playlist:
+              raise HTTPException(status_code=404, detail="Custom playlist not found")
        
-       return channels
+          try:
+              return fetch_available_page(
+                  db.cursor(), user_id, playlist_id, limit, cursor,
+                  source_playlist_id=source_playlist_id,
+                  group_title=group_title,
+                  health=health,
+                  search=q
+              )
+          except InvalidCursor as e:
+              raise HTTPException(status_code=400, detail=str(e))
+   return await run_db(work)
 
 if __name__ == "__main__":
    import uvicorn
@@ -0,0 +1,307 @@
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from bisect import bisect_left
+import threading
+import time
+import math
+import os
+
+# Metriche in formato testo Prometheus, senza dipendenze esterne.
+# Contatori e istogrammi vengono aggiornati sul percorso delle richieste e
+# dai thread del DB: ogni serie ha il suo lock e un aggiornamento costa
+# una ricerca binaria sui bucket e qualche somma. I valori che esistono
+# già altrove (statistiche del pool, delle cache, dei limiter) vengono
+# letti solo quando /metrics viene interrogato, tramite callback.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+# Se impostato, /metrics richiede "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') or None
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+SIZE_BUCKETS = tuple(2 ** n for n in range(10, 31, 2))  # da 1 KB a 1 GB
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _Metric:
+    kind = ''
+    # I contatori si esportano come <nome>_total, anche in HELP e TYPE
+    suffix = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}: expected labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> List[str]:
+        family = self.name + self.suffix
+        lines = [f'# HELP {family} {self.documentation}', f'# TYPE {family} {self.kind}']
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._samples(key, child))
+        return lines
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+class Counter(_Metric):
+    kind = 'counter'
+    suffix = '_total'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def _samples(self, key, child) -> List[str]:
+        return [f'{self.name}{self.suffix}{_format_labels(self.labelnames, key)} {_format_value(child.value)}']
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _samples(self, key, child) -> List[str]:
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class CallbackMetric:
+    # Valori letti al momento dell'esportazione: la callback restituisce
+    # coppie (valori delle etichette, valore)
+    def __init__(self, name: str, documentation: str, kind: str,
+                 callback: Callable[[], Iterable[Tuple[Sequence[str], float]]],
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def collect(self) -> List[str]:
+        family = self.name + ('_total' if self.kind == 'counter' else '')
+        lines = [f'# HELP {family} {self.documentation}', f'# TYPE {family} {self.kind}']
+        for key, value in self.callback():
+            lines.append(f'{family}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, kind: str,
+                 callback: Callable[[], Iterable[Tuple[Sequence[str], float]]],
+                 labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, kind, callback, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                lines.append(f'# {metric.name}: collection failed: {_escape(str(e))}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Richieste HTTP
+HTTP_REQUESTS = registry.counter(
+    'omg_http_requests', 'HTTP requests by route template and status', ('method', 'route', 'status')
+)
+HTTP_DURATION = registry.histogram(
+    'omg_http_request_duration_seconds', 'HTTP request latency, body included', ('method', 'route')
+)
+
+# Database
+DB_QUEUE_SECONDS = registry.histogram(
+    'omg_db_queue_wait_seconds', 'Time run_db work waits for a free DB thread'
+)
+DB_CALL_SECONDS = registry.histogram(
+    'omg_db_call_seconds', 'Time spent running run_db work on a DB thread'
+)
+DB_SESSION_SECONDS = registry.histogram(
+    'omg_db_session_seconds', 'Time a pooled connection stays checked out by get_db'
+)
+DB_COMMIT_SECONDS = registry.histogram(
+    'omg_db_commit_seconds', 'Commit time at the end of get_db (the write lock is taken earlier)'
+)
+DB_WRITE_LOCK_SECONDS = registry.histogram(
+    'omg_db_write_lock_wait_seconds', 'Write lock wait at explicit BEGIN IMMEDIATE (sync writes)'
+)
+
+# Sync
+SYNC_DURATION = registry.histogram(
+    'omg_sync_duration_seconds', 'Playlist sync duration by outcome', ('outcome',)
+)
+SYNC_STAGE_SECONDS = registry.histogram(
+    'omg_sync_stage_seconds', 'Time per sync stage (parse, write)', ('stage',)
+)
+SYNC_FETCH_BYTES = registry.counter(
+    'omg_sync_fetch_bytes', 'Bytes downloaded from playlist providers'
+)
+SYNC_ROWS = registry.counter(
+    'omg_sync_rows', 'Channel rows written by syncs', ('operation',)
+)
+BACKUP_DURATION = registry.histogram(
+    'omg_backup_duration_seconds', 'Database backup duration by outcome', ('outcome',)
+)
+EPG_SYNC_DURATION = registry.histogram(
+    'omg_epg_sync_duration_seconds', 'EPG sync duration by outcome', ('outcome',)
+)
+EPG_FETCH_BYTES = registry.counter(
+    'omg_epg_fetch_bytes', 'Bytes downloaded from EPG providers (before decompression)'
+)
+EPG_WINDOWS = registry.counter(
+    'omg_epg_windows', 'EPG channel time windows by sync operation', ('operation',)
+)
+HEALTH_PROBES = registry.counter(
+    'omg_health_probes', 'Stream health probes by result', ('status',)
+)
+HEALTH_PROBE_SECONDS = registry.histogram(
+    'omg_health_probe_seconds', 'Stream health probe latency, excluding concurrency waits'
+)
+HEALTH_CHECK_DURATION = registry.histogram(
+    'omg_health_check_duration_seconds', 'Playlist stream health check duration by outcome', ('outcome',)
+)
+
+# Playlist pubbliche
+PUBLIC_RESPONSES = registry.counter(
+    'omg_public_playlist_responses', 'Public playlist responses by source', ('source',)
+)
+PUBLIC_RENDER_SECONDS = registry.histogram(
+    'omg_public_playlist_render_seconds', 'Time to render and stream an uncached public playlist'
+)
+PUBLIC_RENDER_BYTES = registry.histogram(
+    'omg_public_playlist_render_bytes', 'Size of rendered public playlists (uncompressed)',
+    buckets=SIZE_BUCKETS
+)
+
+# Middleware ASGI: latenza e conteggio per modello di route (non per URL,
+# così il numero di serie resta limitato)
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._routes: Optional[Dict[object, str]] = None
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        if self._routes is None or endpoint not in self._routes:
+            router = scope.get('router')
+            routes = getattr(router, 'routes', ())
+            self._routes = {
+                route.endpoint: route.path
+                for route in routes if hasattr(route, 'endpoint')
+            }
+        return self._routes.get(endpoint, 'unmatched')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = self._route(scope)
+            method = scope['method']
+            HTTP_DURATION.labels(method, route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(method, route, status_code).inc()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, HttpUrl, Field
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Literal
 from datetime import datetime
 
 # Auth models
@@ -28,11 +28,18 @@ class UserInDB(User):
     password_hash: str
 
 # Playlist models
+# Come riconoscere un canale tra una sync e l'altra: per URL oppure per
+# tvg_id + nome (utile se il provider ruota gli URL degli stream)
+SyncIdentity = Literal['url', 'tvg_id_name']
+
 class PlaylistBase(BaseModel):
     name: str
     url: Optional[str] = None
     is_custom: bool = False
     epg_url: Optional[str] = None
+    sync_identity: SyncIdentity = 'url'
+    # Secondi tra due sync automatiche: None = default, 0 = disattivata
+    sync_interval: Optional[int] = Field(default=None, ge=0)
 
 class PlaylistCreate(PlaylistBase):
     pass
@@ -41,6 +48,8 @@ class PlaylistUpdate(BaseModel):
     name: Optional[str] = None
     url: Optional[str] = None
     epg_url: Optional[str] = None
+    sync_identity: Optional[SyncIdentity] = None
+    sync_interval: Optional[int] = Field(default=None, ge=0)
 
 # Channel models
 class ChannelBase(BaseModel):
@@ -71,6 +80,22 @@ class Channel(ChannelBase):
     class Config:
         from_attributes = True
 
+# Risultato della ricerca full-text, con la playlist di provenienza
+class ChannelSearchResult(Channel):
+    source_playlist_name: str
+
+# Pagina di canali (paginazione keyset)
+class ChannelPage(BaseModel):
+    channels: List[Channel]
+    next_cursor: Optional[str] = None
+    limit: int
+
+# Pagina di canali aggiungibili a una playlist custom
+class AvailableChannelPage(BaseModel):
+    channels: List[ChannelSearchResult]
+    next_cursor: Optional[str] = None
+    limit: int
+
 # Complete Playlist model (includes channels)
 class Playlist(PlaylistBase):
     id: int
@@ -83,12 +108,118 @@ class Playlist(PlaylistBase):
     class Config:
         from_attributes = True
 
+# Elenco playlist: conteggi aggregati, canali solo se richiesti
+class PlaylistSummary(Playlist):
+    channels_count: int = 0
+    groups_count: int = 0
+
+# Stato dello scheduler di sync
+class SyncJobState(BaseModel):
+    playlist_id: int
+    interval: int
+    next_run: Optional[datetime] = None
+    running: bool = False
+    failures: int = 0
+    last_started: Optional[datetime] = None
+    last_finished: Optional[datetime] = None
+    last_duration: Optional[float] = None
+    last_error: Optional[str] = None
+    last_result: Optional[Dict] = None
+
 # Channel Order Update
 class ChannelOrder(BaseModel):
     id: int
     position: int
 
+# Spostamento di canali prima o dopo un altro canale
+class ChannelMove(BaseModel):
+    channel_ids: List[int] = Field(..., min_length=1, max_length=1000)
+    before_id: Optional[int] = None
+    after_id: Optional[int] = None
+
 # Custom Playlist Channel Add
 class CustomPlaylistChannelAdd(BaseModel):
     channel_id: int
     position: Optional[int] = None
+
+# Guida EPG (XMLTV): orari restituiti in UTC
+class EPGProgramme(BaseModel):
+    channel_id: str
+    start: datetime
+    stop: datetime
+    title: str
+    subtitle: Optional[str] = None
+    description: Optional[str] = None
+    category: Optional[str] = None
+    icon: Optional[str] = None
+    episode: Optional[str] = None
+
+class EPGNowNext(BaseModel):
+    tvg_id: str
+    now: Optional[EPGProgramme] = None
+    next: Optional[EPGProgramme] = None
+
+class EPGSource(BaseModel):
+    url: str
+    last_sync: Optional[datetime] = None
+    channels_count: int = 0
+    programmes_count: int = 0
+
+# Abbinamento automatico dei tvg_id con la guida EPG
+class TvgCandidate(BaseModel):
+    tvg_id: str
+    display_name: Optional[str] = None
+    score: float
+
+class TvgMappingProposal(BaseModel):
+    channel_id: int
+    name: str
+    tvg_id: Optional[str] = None
+    candidates: List[TvgCandidate] = []
+
+class TvgMapping(BaseModel):
+    channel_id: int
+    tvg_id: str
+
+# Abbinamenti espliciti e/o automatici (miglior candidato con punteggio
+# almeno min_score), applicati in una sola transazione
+class TvgMappingApply(BaseModel):
+    mappings: List[TvgMapping] = Field(default_factory=list, max_length=100000)
+    min_score: Optional[float] = Field(default=None, ge=0, le=1)
+
+class TvgMappingResult(BaseModel):
+    requested: int
+    updated: int
+
+# Controllo degli stream: ok all'ultimo controllo, failing se l'ultimo è
+# fallito, dead dopo più fallimenti di seguito, not_dead tutti gli altri
+HealthFilter = Literal['ok', 'failing', 'dead', 'not_dead', 'unchecked']
+
+class ChannelHealth(BaseModel):
+    channel_id: int
+    name: str
+    url: str
+    status: Optional[str] = None
+    http_status: Optional[int] = None
+    latency_ms: Optional[int] = None
+    checked_at: Optional[datetime] = None
+    last_ok: Optional[datetime] = None
+    failures: int = 0
+
+class PlaylistHealth(BaseModel):
+    channels: int = 0
+    checked: int = 0
+    ok: int = 0
+    failing: int = 0
+    dead: int = 0
+    last_checked: Optional[datetime] = None
+    running: bool = False
+    details: List[ChannelHealth] = []
+
+class HealthCheckResult(BaseModel):
+    channels: int
+    urls: int
+    statuses: Dict[str, int]
+    dead: int
+    changed: bool
+    duration: float
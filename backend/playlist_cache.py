@@ -0,0 +1,199 @@
+from typing import Dict, List, Optional, Iterable
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import threading
+import zlib
+import os
+
+# Cache degli output M3U già renderizzati per le playlist pubbliche.
+# Le voci sono indicizzate per playlist e versione del contenuto
+# (playlists.content_version): una versione diversa non viene mai servita,
+# l'invalidazione esplicita serve solo a liberare memoria prima.
+CACHE_MAX_BYTES = int(os.getenv('PLAYLIST_CACHE_MAX_MB', '256')) * 2**20
+CACHE_MAX_ENTRY_BYTES = int(os.getenv('PLAYLIST_CACHE_MAX_ENTRY_MB', '64')) * 2**20
+GZIP_LEVEL = 6
+
+class RenderedPlaylist:
+    __slots__ = ('version', 'body', 'gzip_body')
+
+    def __init__(self, version: int, body: bytes, gzip_body: bytes):
+        self.version = version
+        self.body = body
+        self.gzip_body = gzip_body
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + len(self.gzip_body)
+
+class RenderedPlaylistCache:
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES,
+                 max_entry_bytes: int = CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: "OrderedDict[int, RenderedPlaylist]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, playlist_id: int, version: int) -> Optional[RenderedPlaylist]:
+        with self._lock:
+            entry = self._entries.get(playlist_id)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(playlist_id)
+            self.hits += 1
+            return entry
+
+    def put(self, playlist_id: int, entry: RenderedPlaylist):
+        if entry.size > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(playlist_id, None)
+            if old is not None:
+                if old.version > entry.version:
+                    self._entries[playlist_id] = old
+                    return
+                self._size -= old.size
+            self._entries[playlist_id] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+
+    def invalidate(self, playlist_ids: Optional[Iterable[int]] = None):
+        with self._lock:
+            if playlist_ids is None:
+                self._entries.clear()
+                self._size = 0
+                return
+            for playlist_id in playlist_ids:
+                entry = self._entries.pop(playlist_id, None)
+                if entry is not None:
+                    self._size -= entry.size
+
+    def builder(self, playlist_id: int, version: int, compress: bool,
+                store: bool = True) -> "RenderedPlaylistBuilder":
+        return RenderedPlaylistBuilder(self, playlist_id, version, compress, store)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+# Accumula l'output mentre viene inviato in streaming al client e lo
+# salva in cache (normale e gzip) solo se la risposta arriva fino in fondo.
+# Con compress=True restituisce i blocchi già compressi, così il body viene
+# compresso una volta sola e GZipMiddleware lo lascia passare.
+# Con store=False (varianti filtrate della playlist) non salva niente.
+class RenderedPlaylistBuilder:
+    def __init__(self, cache: RenderedPlaylistCache, playlist_id: int,
+                 version: int, compress: bool, store: bool = True):
+        self._cache = cache
+        self._playlist_id = playlist_id
+        self._version = version
+        self._compress = compress
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        self._raw: Optional[List[bytes]] = [] if store else None
+        self._gzip: Optional[List[bytes]] = [] if store else None
+        self._size = 0
+
+    def write(self, data: bytes) -> bytes:
+        if self._raw is not None:
+            self._size += len(data)
+            if self._size > self._cache.max_entry_bytes:
+                # Troppo grande per la cache: si continua solo a inviare
+                self._raw = self._gzip = None
+            else:
+                self._raw.append(data)
+
+        if self._raw is None and not self._compress:
+            return data
+        compressed = self._compressor.compress(data)
+        if self._gzip is not None:
+            self._gzip.append(compressed)
+        return compressed if self._compress else data
+
+    def close(self) -> bytes:
+        if self._raw is None and not self._compress:
+            return b''
+        tail = self._compressor.flush()
+        if self._raw is not None:
+            self._gzip.append(tail)
+            self._cache.put(self._playlist_id, RenderedPlaylist(
+                self._version, b''.join(self._raw), b''.join(self._gzip)
+            ))
+        return tail if self._compress else b''
+
+rendered_playlists = RenderedPlaylistCache()
+
+# Validatori HTTP
+def make_etag(playlist_id: int, version: int, gzip: bool = False, variant: str = '') -> str:
+    suffix = '-gzip' if gzip else ''
+    variant = f'-{variant}' if variant else ''
+    return f'"{playlist_id}-{version}{variant}{suffix}"'
+
+def http_date(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+def _opaque_tag(etag: str) -> str:
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    if etag.endswith('-gzip"'):
+        etag = etag[:-6] + '"'
+    return etag
+
+def _qvalue(params: List[str]) -> float:
+    for param in params:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                return float(value.strip())
+            except ValueError:
+                return 0.0
+    return 1.0
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    # RFC 7231: gzip (o x-gzip) con q > 0, oppure * con q > 0 se gzip non
+    # è elencato. "gzip;q=0" vuol dire che gzip non è accettato
+    wildcard = None
+    for coding in (accept_encoding or '').split(','):
+        name, *params = coding.split(';')
+        name = name.strip().lower()
+        if name in ('gzip', 'x-gzip'):
+            return _qvalue(params) > 0
+        if name == '*':
+            wildcard = _qvalue(params) > 0
+    return bool(wildcard)
+
+def is_not_modified(headers, etag: str, last_modified: datetime) -> bool:
+    # RFC 7232: If-None-Match (confronto debole) ha la precedenza su
+    # If-Modified-Since, che viene considerato solo se il primo manca
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        current = _opaque_tag(etag)
+        return any(_opaque_tag(tag) == current for tag in if_none_match.split(','))
+
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+    return False
@@ -0,0 +1,398 @@
+from typing import Dict, List, Optional, Tuple
+from array import array
+from bisect import bisect_left
+import json
+import sqlite3
+
+from m3u_utils import M3UChannel
+from database import (
+    bulk_insert, begin_immediate, drop_indexes, rebuild_indexes,
+    search_indexing_suspended, index_channels_for_search, unindex_channels_for_search
+)
+
+# Distanza tra le posizioni assegnate dalla sync: lascia spazio per
+# inserire canali nuovi senza rinumerare quelli esistenti
+POSITION_STEP = 1024
+
+# Identità con cui un canale della playlist remota viene riconosciuto
+# tra quelli già salvati
+SYNC_IDENTITIES = ('url', 'tvg_id_name')
+
+# Primo caricamento: oltre questa soglia gli indici di channels vengono
+# sospesi e ricostruiti alla fine, se il caricamento è la parte più grande
+# della tabella
+DEFER_INDEXES_AFTER = 50_000
+
+INSERT_CHANNEL_SQL = """INSERT INTO channels
+    (playlist_id, name, url, group_title, logo_url, tvg_id, position, extra_tags)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+class TagsEncoder:
+    # I tag extra sono condivisi tra i canali (vedi m3u_utils.share_tags):
+    # ogni insieme viene serializzato una volta sola
+    def __init__(self):
+        self._cache = {}
+
+    def __call__(self, tags) -> Optional[str]:
+        if not tags:
+            return None
+        cached = self._cache.get(id(tags))
+        if cached is not None and cached[0] is tags:
+            return cached[1]
+        encoded = json.dumps(tags)
+        if len(self._cache) < 65536:
+            self._cache[id(tags)] = (tags, encoded)
+        return encoded
+
+def channel_identity(identity: str, url: str, name: str, tvg_id: Optional[str]) -> str:
+    if identity == 'tvg_id_name':
+        return f"{tvg_id or ''}\x1f{name}"
+    return url
+
+def _kept_indexes(old_positions: array) -> bytearray:
+    # Sottosequenza crescente più lunga delle vecchie posizioni (0 = canale
+    # nuovo): quei canali mantengono la posizione, gli altri vengono spostati
+    count = len(old_positions)
+    tails: List[int] = []
+    tail_index: List[int] = []
+    previous = array('q', [-1]) * count
+
+    for i in range(count):
+        value = old_positions[i]
+        if not value:
+            continue
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[k] = value
+            tail_index[k] = i
+        previous[i] = tail_index[k - 1] if k else -1
+
+    kept = bytearray(count)
+    i = tail_index[-1] if tail_index else -1
+    while i >= 0:
+        kept[i] = 1
+        i = previous[i]
+    return kept
+
+def assign_positions(old_positions: array) -> Tuple[array, bool]:
+    # Posizioni finali in ordine di playlist remota. Se tra due canali
+    # mantenuti non c'è spazio per quelli da inserire, rinumera tutto
+    count = len(old_positions)
+    kept = _kept_indexes(old_positions)
+    positions = array('q', old_positions)
+    previous = 0
+    pending: List[int] = []
+
+    for i in range(count):
+        if not kept[i]:
+            pending.append(i)
+            continue
+        current = old_positions[i]
+        if pending:
+            step = (current - previous) // (len(pending) + 1)
+            if step < 1:
+                return array('q', range(POSITION_STEP, (count + 1) * POSITION_STEP, POSITION_STEP)), True
+            for n, index in enumerate(pending, 1):
+                positions[index] = previous + step * n
+            pending = []
+        previous = current
+
+    for n, index in enumerate(pending, 1):
+        positions[index] = previous + POSITION_STEP * n
+    return positions, False
+
+# Sync incrementale: i canali remoti vengono appoggiati in una tabella
+# temporanea man mano che arrivano, poi confrontati con quelli salvati.
+# Si inseriscono solo i nuovi, si aggiornano solo quelli cambiati e si
+# cancellano quelli spariti; gli id restano stabili, quindi anche i
+# riferimenti in custom_playlist_channels.
+# L'appoggio gira in una transazione differita che tocca solo lo schema
+# temp, anche al primo sync: il lock di scrittura del DB viene preso solo
+# in apply(), a download finito.
+class PlaylistDiffSync:
+    def __init__(self, cursor: sqlite3.Cursor, playlist_id: int, identity: str = 'url',
+                 batch_size: int = 1000):
+        if identity not in SYNC_IDENTITIES:
+            raise ValueError(f"Unknown sync identity: {identity}")
+        self.cursor = cursor
+        self.playlist_id = playlist_id
+        self.identity = identity
+        self.batch_size = batch_size
+        self.received = 0
+        self.direct = False
+        self._encode_tags = TagsEncoder()
+
+    def begin(self):
+        # Transazione differita: finché si scrive solo nello schema temp
+        # non prende il lock di scrittura del DB
+        self.cursor.execute("BEGIN")
+        self.cursor.execute("DROP TABLE IF EXISTS temp.sync_incoming")
+        self.cursor.execute("""
+            CREATE TEMP TABLE sync_incoming (
+                seq INTEGER PRIMARY KEY,
+                identity TEXT NOT NULL,
+                name TEXT NOT NULL,
+                url TEXT NOT NULL,
+                group_title TEXT,
+                logo_url TEXT,
+                tvg_id TEXT,
+                extra_tags TEXT
+            )
+        """)
+
+    def add(self, channels: List[M3UChannel]):
+        if not channels:
+            return
+        start = self.received
+        self.received += len(channels)
+        encode_tags = self._encode_tags
+        identity = self.identity
+        bulk_insert(
+            self.cursor,
+            """INSERT INTO temp.sync_incoming
+               (seq, identity, name, url, group_title, logo_url, tvg_id, extra_tags)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                (
+                    seq, channel_identity(identity, ch.url, ch.name, ch.tvg_id),
+                    ch.name, ch.url, ch.group, ch.logo, ch.tvg_id,
+                    encode_tags(ch.extra_tags)
+                )
+                for seq, ch in enumerate(channels, start)
+            )
+        )
+
+    def end_staging(self):
+        # Chiude la transazione di appoggio (le tabelle temporanee restano):
+        # i pragma per i caricamenti massivi vanno applicati fuori
+        if self.cursor.connection.in_transaction:
+            self.cursor.execute("COMMIT")
+
+    def rollback(self):
+        if self.cursor.connection.in_transaction:
+            self.cursor.connection.rollback()
+        for table in ('sync_reindex', 'sync_match', 'sync_current', 'sync_incoming'):
+            self.cursor.execute(f"DROP TABLE IF EXISTS temp.{table}")
+
+    def _copy_incoming(self) -> Dict[str, int]:
+        # Playlist vuota (primo sync): niente confronto, i canali appoggiati
+        # vengono copiati nella tabella definitiva con un'istruzione sola
+        cursor = self.cursor
+        table_rows = cursor.execute("SELECT MAX(rowid) AS n FROM channels").fetchone()['n'] or 0
+        deferred_indexes = []
+        if self.received > DEFER_INDEXES_AFTER and self.received > table_rows:
+            deferred_indexes = drop_indexes(cursor, "channels")
+        # Indice full-text riempito in un colpo solo alla fine
+        with search_indexing_suspended(cursor):
+            cursor.execute("""
+                INSERT INTO channels
+                    (playlist_id, name, url, group_title, logo_url, tvg_id, position, extra_tags)
+                SELECT ?, name, url, group_title, logo_url, tvg_id,
+                       (seq + 1) * ?, COALESCE(extra_tags, '{}')
+                FROM temp.sync_incoming
+                ORDER BY seq
+            """, (self.playlist_id, POSITION_STEP))
+            rebuild_indexes(cursor, deferred_indexes)
+            index_channels_for_search(cursor, "playlist_id = ?", (self.playlist_id,))
+        cursor.execute("DROP TABLE IF EXISTS temp.sync_incoming")
+        return {
+            "channels_count": self.received,
+            "added": self.received,
+            "changed": 0,
+            "removed": 0,
+            "unchanged": 0,
+            "rebalanced": False,
+        }
+
+    def _match(self):
+        # Accoppia i canali per identità; i duplicati vengono accoppiati
+        # nell'ordine in cui compaiono
+        if self.identity == 'tvg_id_name':
+            identity_sql = "COALESCE(tvg_id, '') || char(31) || name"
+        else:
+            identity_sql = "url"
+
+        cursor = self.cursor
+        cursor.execute("DROP TABLE IF EXISTS temp.sync_current")
+        cursor.execute(f"""
+            CREATE TEMP TABLE sync_current AS
+            SELECT id, position, {identity_sql} AS identity,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY {identity_sql} ORDER BY position, id
+                   ) AS occurrence
+            FROM channels
+            WHERE playlist_id = ?
+        """, (self.playlist_id,))
+        cursor.execute(
+            "CREATE INDEX temp.sync_current_identity ON sync_current(identity, occurrence)"
+        )
+
+        cursor.execute("DROP TABLE IF EXISTS temp.sync_match")
+        cursor.execute("""
+            CREATE TEMP TABLE sync_match AS
+            SELECT incoming.seq AS seq, current.id AS channel_id,
+                   current.position AS old_position
+            FROM (
+                SELECT seq, identity,
+                       ROW_NUMBER() OVER (PARTITION BY identity ORDER BY seq) AS occurrence
+                FROM temp.sync_incoming
+            ) AS incoming
+            LEFT JOIN temp.sync_current AS current
+              ON current.identity = incoming.identity
+             AND current.occurrence = incoming.occurrence
+        """)
+        cursor.execute("CREATE UNIQUE INDEX temp.sync_match_seq ON sync_match(seq)")
+        cursor.execute("DROP TABLE temp.sync_current")
+
+    def _write_changes(self, positions: array) -> Tuple[int, int]:
+        cursor = self.cursor
+        last_id = cursor.execute("SELECT MAX(id) AS n FROM channels").fetchone()['n'] or 0
+        cursor.execute("DROP TABLE IF EXISTS temp.sync_reindex")
+        cursor.execute("CREATE TEMP TABLE sync_reindex (id INTEGER PRIMARY KEY)")
+
+        added = changed = 0
+        playlist_id = self.playlist_id
+        # Tuple semplici e tag come testo JSON: si decodificano solo quando
+        # la playlist remota porta dei tag da unire a quelli salvati
+        reader = cursor.connection.cursor()
+        reader.row_factory = None
+        reader.execute("""
+            SELECT m.seq, m.channel_id,
+                   i.name, i.url, i.group_title, i.logo_url, i.tvg_id, i.extra_tags,
+                   c.name, c.url, c.group_title, c.logo_url, c.tvg_id,
+                   CAST(c.extra_tags AS TEXT), c.position
+            FROM temp.sync_match m
+            JOIN temp.sync_incoming i ON i.seq = m.seq
+            LEFT JOIN channels c ON c.id = m.channel_id
+            ORDER BY m.seq
+        """)
+        while True:
+            rows = reader.fetchmany(self.batch_size)
+            if not rows:
+                break
+            inserts = []
+            updates = []
+            reindex = []
+            for (seq, channel_id, name, url, group_title, logo_url, tvg_id, tags_json,
+                 cur_name, cur_url, cur_group_title, cur_logo_url, cur_tvg_id,
+                 cur_tags_json, cur_position) in rows:
+                position = positions[seq]
+
+                if channel_id is None:
+                    inserts.append((
+                        playlist_id, name, url, group_title, logo_url, tvg_id,
+                        position, tags_json or '{}'
+                    ))
+                    continue
+
+                # Come prima della sync incrementale: tvg_id e tag extra
+                # modificati dall'utente hanno la precedenza su quelli remoti
+                if cur_tvg_id is not None:
+                    tvg_id = cur_tvg_id
+                extra_tags_json = cur_tags_json
+                if tags_json:
+                    current_tags = json.loads(cur_tags_json) if cur_tags_json else {}
+                    incoming_tags = json.loads(tags_json)
+                    if not incoming_tags.keys() <= current_tags.keys():
+                        extra_tags_json = json.dumps({**incoming_tags, **current_tags})
+
+                if (
+                    name != cur_name
+                    or url != cur_url
+                    or group_title != cur_group_title
+                    or logo_url != cur_logo_url
+                    or tvg_id != cur_tvg_id
+                    or extra_tags_json != cur_tags_json
+                    or position != cur_position
+                ):
+                    updates.append((
+                        name, url, group_title, logo_url, tvg_id,
+                        extra_tags_json or '{}', position, channel_id
+                    ))
+                    if (
+                        name != cur_name
+                        or group_title != cur_group_title
+                        or tvg_id != cur_tvg_id
+                    ):
+                        reindex.append((channel_id,))
+
+            if inserts:
+                added += bulk_insert(cursor, INSERT_CHANNEL_SQL, inserts)
+            if reindex:
+                cursor.executemany("INSERT INTO temp.sync_reindex (id) VALUES (?)", reindex)
+                unindex_channels_for_search(cursor, "id IN (SELECT id FROM temp.sync_reindex)")
+            if updates:
+                cursor.executemany(
+                    """UPDATE channels
+                       SET name = ?, url = ?, group_title = ?, logo_url = ?,
+                           tvg_id = ?, extra_tags = ?, position = ?
+                       WHERE id = ?""",
+                    updates
+                )
+                changed += len(updates)
+            if reindex:
+                index_channels_for_search(cursor, "id IN (SELECT id FROM temp.sync_reindex)")
+                cursor.execute("DELETE FROM temp.sync_reindex")
+
+        reader.close()
+        if added:
+            index_channels_for_search(
+                cursor, "playlist_id = ? AND id > ?", (playlist_id, last_id)
+            )
+        cursor.execute("DROP TABLE IF EXISTS temp.sync_reindex")
+        return added, changed
+
+    def apply(self) -> Dict[str, int]:
+        # Scrive in una transazione BEGIN IMMEDIATE lasciata aperta: il
+        # chiamante aggiunge le sue modifiche e fa COMMIT
+        cursor = self.cursor
+        self.end_staging()
+        begin_immediate(cursor)
+        self.direct = cursor.execute(
+            "SELECT 1 FROM channels WHERE playlist_id = ? LIMIT 1",
+            (self.playlist_id,)
+        ).fetchone() is None
+        if self.direct:
+            return self._copy_incoming()
+
+        self._match()
+
+        # Posizioni: servono solo interi, non i canali
+        old_positions = array('q', bytes(8 * self.received))
+        reader = cursor.connection.cursor()
+        reader.row_factory = None
+        for seq, old_position in reader.execute(
+            "SELECT seq, old_position FROM temp.sync_match WHERE channel_id IS NOT NULL"
+        ):
+            # Le posizioni salvate partono da 1; 0 indica un canale nuovo
+            old_positions[seq] = max(old_position or 0, 1)
+        reader.close()
+        positions, rebalanced = assign_positions(old_positions)
+
+        cursor.execute("""
+            DELETE FROM channels
+            WHERE playlist_id = ? AND id NOT IN (
+                SELECT channel_id FROM temp.sync_match WHERE channel_id IS NOT NULL
+            )
+        """, (self.playlist_id,))
+        removed = cursor.rowcount
+
+        # Indice full-text aggiornato a blocchi: i canali nuovi hanno id
+        # maggiori di quelli esistenti, quelli con testo cambiato passano
+        # da temp.sync_reindex
+        with search_indexing_suspended(cursor):
+            added, changed = self._write_changes(positions)
+        cursor.execute("DROP TABLE IF EXISTS temp.sync_match")
+        cursor.execute("DROP TABLE IF EXISTS temp.sync_incoming")
+
+        return {
+            "channels_count": self.received,
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+            "unchanged": self.received - added - changed,
+            "rebalanced": rebalanced,
+        }
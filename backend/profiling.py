@@ -0,0 +1,312 @@
+from typing import Dict, List, Optional, Tuple
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+import tracemalloc
+import threading
+import asyncio
+import json
+import uuid
+import time
+import sys
+import os
+import re
+
+# Profilazione su richiesta delle sync e dei download pubblici: un
+# campionatore legge ogni PROFILE_INTERVAL secondi lo stack di tutti i
+# thread (event loop e thread del DB) e tracemalloc registra le
+# allocazioni. Si attiva per una singola richiesta (header X-Profile da un
+# amministratore; "X-Profile: cpu" salta tracemalloc, che rallenta molto)
+# o sempre per i percorsi in PROFILE_REQUESTS (es. "sync,public").
+# Un solo profilo alla volta: campionatore e tracemalloc
+# valgono per tutto il processo, quindi il rapporto include anche le
+# richieste concorrenti. Da spento costa un controllo di una variabile
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '1') == '1'
+PROFILE_REQUESTS = {kind.strip() for kind in os.getenv('PROFILE_REQUESTS', '').split(',') if kind.strip()}
+PROFILE_MEMORY = os.getenv('PROFILE_MEMORY', '1') == '1'
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '20'))
+# Oltre questa durata il profilo si chiude da solo (es. risposta in
+# streaming abbandonata prima di iniziare)
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '600'))
+PROFILE_PATH = Path("data/profiles")
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOP = 30
+PROFILE_STACK_DEPTH = 40
+
+_PROFILE_ID_RE = re.compile(r'^[\w-]+$')
+# Il tempo cumulativo si conta solo per le funzioni dell'applicazione: i
+# frame di threading e asyncio sono in ogni stack e non dicono nulla
+_APP_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+# Frame in cui un thread sta solo aspettando lavoro: non sono tempo di CPU
+_IDLE_FRAMES = {
+    ('thread.py', '_worker'),
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+}
+
+class ProfilerBusy(Exception):
+    pass
+
+# Un solo profilo o snapshot di memoria alla volta
+_active = threading.Lock()
+# Rapporti scritti fuori dall'event loop
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profile')
+class ProfileRequest:
+    __slots__ = ('memory', 'ids')
+
+    def __init__(self, memory: bool):
+        self.memory = memory
+        self.ids: List[str] = []
+
+# Profilo chiesto dalla richiesta corrente: lo usa il primo punto
+# profilato che incontra, il suo id finisce in ids
+_requested: ContextVar[Optional[ProfileRequest]] = ContextVar('profile_requested', default=None)
+
+def request_profile(memory: bool = True) -> ProfileRequest:
+    request = ProfileRequest(memory)
+    _requested.set(request)
+    return request
+
+def _location(code, line: int) -> str:
+    path = Path(code.co_filename)
+    return f"{path.parent.name}/{path.name}:{line}"
+
+class ProfileSession:
+    def __init__(self, kind: str, target, memory: bool = True, interval: float = PROFILE_INTERVAL):
+        self.kind = kind
+        self.target = target
+        self.memory = memory
+        self.interval = interval
+        self.id = f"{time.strftime('%Y%m%d_%H%M%S')}_{kind}_{target}_{uuid.uuid4().hex[:6]}"
+        self._stop = threading.Event()
+        self._finished = False
+        self._finish_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._self_samples: Counter = Counter()
+        self._cumulative: Counter = Counter()
+        self._stacks: Counter = Counter()
+        self._threads: Counter = Counter()
+        self._samples = 0
+        self._started = 0.0
+        self._elapsed = 0.0
+        self._memory: Tuple[int, int] = (0, 0)
+
+    def start(self):
+        self.created = time.time()
+        self._started = time.perf_counter()
+        if self.memory:
+            tracemalloc.start()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        own = threading.get_ident()
+        names: Dict[int, str] = {}
+        while not self._stop.wait(self.interval):
+            if time.perf_counter() - self._started > PROFILE_MAX_SECONDS:
+                self.finish()
+                return
+            self._samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                self._threads[names.get(ident, str(ident))] += 1
+                self._self_samples[(code.co_name, _location(code, frame.f_lineno))] += 1
+
+                stack = []
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_name, _location(code, code.co_firstlineno))
+                    if key not in seen and code.co_filename.startswith(_APP_DIR):
+                        seen.add(key)
+                        self._cumulative[key] += 1
+                    if len(stack) < PROFILE_STACK_DEPTH:
+                        stack.append(code.co_name)
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def finish(self):
+        # Il campionamento si ferma subito; snapshot e scrittura del
+        # rapporto, che su sync grandi richiedono tempo, vanno in background
+        with self._finish_lock:
+            if self._finished:
+                return
+            self._finished = True
+        self._stop.set()
+        self._elapsed = time.perf_counter() - self._started
+        if self.memory:
+            self._memory = tracemalloc.get_traced_memory()
+        _writer.submit(self._write)
+
+    def _write(self):
+        try:
+            self._thread.join()
+            snapshot = tracemalloc.take_snapshot() if self.memory else None
+            report = self._report(snapshot)
+            PROFILE_PATH.mkdir(parents=True, exist_ok=True)
+            partial = PROFILE_PATH / f"{self.id}.json.partial"
+            partial.write_text(json.dumps(report, indent=1))
+            partial.replace(PROFILE_PATH / f"{self.id}.json")
+            _prune()
+        except Exception as e:
+            print(f"Profile {self.id} failed: {e}")
+        finally:
+            if self.memory:
+                tracemalloc.stop()
+            _active.release()
+
+    def _report(self, snapshot) -> Dict:
+        def top(counter: Counter, limit: int = PROFILE_TOP) -> List[Dict]:
+            total = sum(self._threads.values()) or 1
+            return [
+                {"function": name, "location": location, "samples": count,
+                 "percent": round(count * 100 / total, 1)}
+                for (name, location), count in counter.most_common(limit)
+            ]
+
+        current, peak = self._memory
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "target": self.target,
+            "created": self.created,
+            "duration": self._elapsed,
+            "interval": self.interval,
+            "samples": self._samples,
+            "threads": dict(self._threads.most_common()),
+            "self": top(self._self_samples),
+            "cumulative": top(self._cumulative),
+            "stacks": [
+                {"stack": stack, "samples": count}
+                for stack, count in self._stacks.most_common(PROFILE_TOP)
+            ],
+            "memory": {
+                "traced_current": current,
+                "traced_peak": peak,
+                "top": allocation_report(snapshot),
+            } if snapshot is not None else None,
+        }
+
+def allocation_report(snapshot, limit: int = PROFILE_TOP) -> List[Dict]:
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ))
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size": stat.size,
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics('lineno')[:limit]
+    ]
+
+def start_if_requested(kind: str, target) -> Optional[ProfileSession]:
+    request = _requested.get()
+    if request is None:
+        if kind not in PROFILE_REQUESTS:
+            return None
+        memory = PROFILE_MEMORY
+    else:
+        _requested.set(None)
+        memory = request.memory
+    if not _active.acquire(blocking=False):
+        return None
+    session = ProfileSession(kind, target, memory)
+    try:
+        session.start()
+    except Exception:
+        _active.release()
+        raise
+    if request is not None:
+        request.ids.append(session.id)
+    return session
+
+@contextmanager
+def profile(kind: str, target):
+    session = start_if_requested(kind, target)
+    try:
+        yield session
+    finally:
+        if session is not None:
+            session.finish()
+
+async def profiled_stream(chunks, session: ProfileSession):
+    # Il profilo di una risposta in streaming dura fino all'ultimo blocco
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        session.finish()
+
+# Snapshot della memoria: traccia le allocazioni per qualche secondo e
+# riporta quelle ancora vive, con la memoria residente del processo
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+async def memory_snapshot(seconds: float, limit: int = PROFILE_TOP) -> Dict:
+    if not _active.acquire(blocking=False):
+        raise ProfilerBusy("Another profile is running")
+    try:
+        tracemalloc.start()
+        try:
+            await asyncio.sleep(seconds)
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        top = await asyncio.get_running_loop().run_in_executor(_writer, allocation_report, snapshot, limit)
+    finally:
+        _active.release()
+    return {
+        "seconds": seconds,
+        "rss": _rss_bytes(),
+        "traced_current": current,
+        "traced_peak": peak,
+        "top": top,
+    }
+
+# Rapporti salvati
+def _prune():
+    reports = sorted(PROFILE_PATH.glob("*.json"), key=lambda path: path.stat().st_mtime)
+    for path in reports[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        path.unlink(missing_ok=True)
+
+def list_profiles() -> List[Dict]:
+    if not PROFILE_PATH.exists():
+        return []
+    profiles = []
+    for path in sorted(PROFILE_PATH.glob("*.json"), key=lambda path: path.stat().st_mtime, reverse=True):
+        stat = path.stat()
+        parts = path.stem.split('_')
+        profiles.append({
+            "id": path.stem,
+            "kind": parts[2] if len(parts) > 3 else None,
+            "target": parts[3] if len(parts) > 3 else None,
+            "created": stat.st_mtime,
+            "size": stat.st_size,
+        })
+    return profiles
+
+def load_profile(profile_id: str) -> Optional[Dict]:
+    if not _PROFILE_ID_RE.match(profile_id):
+        return None
+    path = PROFILE_PATH / f"{profile_id}.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
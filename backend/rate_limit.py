@@ -0,0 +1,92 @@
+from typing import Callable, Dict, Optional, Tuple
+from collections import OrderedDict
+import math
+import time
+import os
+
+from fastapi import Depends, HTTPException, Request, status
+
+# Rate limiting a token bucket per chiave (IP, utente, token pubblico).
+# Ogni chiave costa una tupla (token rimasti, ultimo aggiornamento) in un
+# OrderedDict in ordine di uso: oltre max_keys si scartano le meno recenti,
+# che nel frattempo si sono quasi sempre ricaricate del tutto. Chi supera
+# il limite riceve subito 429 con Retry-After, senza attese nel loop.
+# Lo stato è per processo: con più worker ognuno ha i suoi contatori
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '10000'))
+# Dietro un reverse proxy l'IP del client arriva in X-Forwarded-For. Ogni
+# proxy aggiunge in fondo l'indirizzo da cui ha ricevuto la richiesta: vale
+# solo la voce scritta dal primo dei RATE_LIMIT_PROXY_HOPS proxy fidati,
+# contando da destra. Le voci più a sinistra le sceglie il client
+RATE_LIMIT_TRUST_PROXY = os.getenv('RATE_LIMIT_TRUST_PROXY', '0') == '1'
+RATE_LIMIT_PROXY_HOPS = int(os.getenv('RATE_LIMIT_PROXY_HOPS', '1'))
+
+class TokenBucketLimiter:
+    def __init__(self, calls: int, period: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.capacity = float(calls)
+        self.rate = calls / period
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+
+    def hit(self, key: str, cost: float = 1.0) -> float:
+        # 0 se la richiesta passa, altrimenti i secondi da attendere
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = self.capacity
+        else:
+            tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            self._buckets.move_to_end(key)
+
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            self.rejected += 1
+            return (cost - tokens) / self.rate
+
+        self._buckets[key] = (tokens - cost, now)
+        if bucket is None and len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        self.allowed += 1
+        return 0.0
+
+    def reset(self, key: Optional[str] = None):
+        if key is None:
+            self._buckets.clear()
+        else:
+            self._buckets.pop(key, None)
+
+    def stats(self) -> Dict:
+        return {"keys": len(self._buckets), "allowed": self.allowed, "rejected": self.rejected}
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = [
+            address.strip()
+            for address in ','.join(request.headers.getlist('x-forwarded-for')).split(',')
+            if address.strip()
+        ]
+        if len(forwarded) >= RATE_LIMIT_PROXY_HOPS > 0:
+            return forwarded[-RATE_LIMIT_PROXY_HOPS]
+    return request.client.host if request.client else 'unknown'
+
+def enforce_rate_limit(limiter: TokenBucketLimiter, limit_key: str):
+    # Per gli endpoint che devono decidere prima se la richiesta va
+    # contata (es. le risposte 304 non consumano token)
+    if not RATE_LIMIT_ENABLED:
+        return
+    retry_after = limiter.hit(limit_key)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+def rate_limit(limiter: TokenBucketLimiter, key: Callable[..., str]):
+    # Dipendenza FastAPI; key è a sua volta una dipendenza che restituisce
+    # la chiave (es. client_ip o l'id dell'utente autenticato)
+    async def dependency(limit_key: str = Depends(key)):
+        enforce_rate_limit(limiter, limit_key)
+    return dependency
@@ -0,0 +1,312 @@
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from collections import defaultdict
+from urllib.parse import urlsplit
+import contextlib
+import asyncio
+import time
+import os
+
+import aiohttp
+
+from metrics import HEALTH_PROBES, HEALTH_PROBE_SECONDS
+
+# Controllo degli stream di una playlist: ogni URL viene provato con una
+# HEAD (o una GET parziale se il server non la accetta) e dei manifest
+# HLS si leggono solo i primi byte. Le richieste condividono una sessione
+# aiohttp e sono limitate in totale e per host, così anche una playlist
+# da decine di migliaia di canali sullo stesso provider non lo sommerge
+HEALTH_CONCURRENCY = int(os.getenv('HEALTH_CONCURRENCY', '50'))
+HEALTH_PER_HOST = int(os.getenv('HEALTH_PER_HOST', '4'))
+HEALTH_TIMEOUT = float(os.getenv('HEALTH_TIMEOUT', '10'))
+HEALTH_CONNECT_TIMEOUT = float(os.getenv('HEALTH_CONNECT_TIMEOUT', '5'))
+# Controlli falliti di seguito prima di considerare morto un canale:
+# un errore isolato non lo toglie dalle playlist pubbliche
+HEALTH_DEAD_AFTER = max(1, int(os.getenv('HEALTH_DEAD_AFTER', '2')))
+# Molti provider rifiutano i client che non sembrano player
+HEALTH_USER_AGENT = os.getenv('HEALTH_USER_AGENT', 'VLC/3.0.20 LibVLC/3.0.20')
+HEALTH_MANIFEST_BYTES = 64 * 1024
+HEALTH_SNIFF_BYTES = 16
+HEALTH_WRITE_BATCH = 500
+
+# Risposte alla HEAD di server che accettano solo GET
+HEAD_FALLBACK_STATUSES = frozenset({400, 403, 405, 501})
+MANIFEST_SIGNATURE = b'#EXTM3U'
+_SNIFF_STRIP = b'\xef\xbb\xbf \t\r\n'
+
+HealthRecorder = Callable[[List[Tuple]], Awaitable[None]]
+
+class HealthCheckRunning(RuntimeError):
+    pass
+
+def is_manifest(url: str, content_type: Optional[str] = None) -> bool:
+    if content_type and 'mpegurl' in content_type.lower():
+        return True
+    return urlsplit(url).path.lower().endswith(('.m3u8', '.m3u'))
+
+async def read_head(content: aiohttp.StreamReader, limit: int) -> bytes:
+    # Quanto basta per riconoscere il contenuto, mai oltre limit
+    data = b''
+    while len(data) < HEALTH_SNIFF_BYTES:
+        chunk = await content.read(limit - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+class StreamHealthChecker:
+    def __init__(self, concurrency: int = HEALTH_CONCURRENCY,
+                 per_host: int = HEALTH_PER_HOST, timeout: float = HEALTH_TIMEOUT):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._host_waiting: Dict[str, int] = defaultdict(int)
+        self._running = set()
+
+    def is_running(self, key: int) -> bool:
+        return key in self._running
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessione e semafori legati all'event loop in cui sono nati
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._host_slots = {}
+            self._host_waiting = defaultdict(int)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.concurrency, limit_per_host=self.per_host, ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=self.timeout, sock_connect=HEALTH_CONNECT_TIMEOUT
+                ),
+                headers={'User-Agent': HEALTH_USER_AGENT},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, host: str):
+        # Prima il posto sull'host, poi quello globale: chi aspetta un host
+        # occupato non tiene fermi gli altri
+        semaphore = self._host_slots.get(host)
+        if semaphore is None:
+            semaphore = self._host_slots[host] = asyncio.Semaphore(self.per_host)
+        self._host_waiting[host] += 1
+        try:
+            async with semaphore:
+                async with self._slots:
+                    yield
+        finally:
+            self._host_waiting[host] -= 1
+            if not self._host_waiting[host]:
+                del self._host_waiting[host]
+                del self._host_slots[host]
+
+    async def _get(self, session: aiohttp.ClientSession, url: str) -> Tuple[str, int]:
+        headers = {'Range': f'bytes=0-{HEALTH_MANIFEST_BYTES - 1}'}
+        async with session.get(url, headers=headers) as response:
+            if response.status >= 400:
+                return 'http_error', response.status
+            data = (await read_head(response.content, HEALTH_MANIFEST_BYTES)).lstrip(_SNIFF_STRIP)
+            if is_manifest(str(response.url), response.headers.get('Content-Type')):
+                valid = data.startswith(MANIFEST_SIGNATURE)
+            else:
+                valid = bool(data)
+            return ('ok' if valid else 'invalid'), response.status
+
+    async def _request(self, session: aiohttp.ClientSession, url: str) -> Tuple[str, int]:
+        if is_manifest(url):
+            return await self._get(session, url)
+        async with session.head(url, allow_redirects=True) as response:
+            if response.status >= 400 and response.status not in HEAD_FALLBACK_STATUSES:
+                return 'http_error', response.status
+            if response.status < 400 and not is_manifest(
+                str(response.url), response.headers.get('Content-Type')
+            ):
+                return 'ok', response.status
+        return await self._get(session, url)
+
+    async def probe(self, url: str) -> Dict:
+        parts = urlsplit(url)
+        if parts.scheme.lower() not in ('http', 'https') or not parts.hostname:
+            HEALTH_PROBES.labels('unsupported').inc()
+            return {"status": 'unsupported', "http_status": None, "latency_ms": None}
+        session = self._get_session()
+        http_status = None
+        async with self._slot(parts.hostname.lower()):
+            # La latenza non comprende l'attesa di un posto libero
+            start = time.perf_counter()
+            try:
+                status, http_status = await asyncio.wait_for(
+                    self._request(session, url), self.timeout
+                )
+            except asyncio.TimeoutError:
+                status = 'timeout'
+            except (aiohttp.ClientError, OSError, ValueError):
+                status = 'error'
+            elapsed = time.perf_counter() - start
+        HEALTH_PROBES.labels(status).inc()
+        HEALTH_PROBE_SECONDS.observe(elapsed)
+        return {"status": status, "http_status": http_status, "latency_ms": round(elapsed * 1000)}
+
+    async def check(self, key: int, targets: List[Tuple[int, int, str, int]],
+                    record: HealthRecorder) -> Dict:
+        # targets: (canale, playlist del canale, URL, fallimenti precedenti).
+        # Un URL presente in più canali viene provato una volta sola; i
+        # risultati arrivano a record a blocchi, mentre le prove continuano
+        if key in self._running:
+            raise HealthCheckRunning("Health check already in progress")
+        self._running.add(key)
+        try:
+            by_url: Dict[str, List[Tuple[int, int, int]]] = defaultdict(list)
+            for channel_id, playlist_id, url, failures in targets:
+                by_url[url].append((channel_id, playlist_id, failures))
+            pending = iter(by_url.items())
+            statuses: Dict[str, int] = defaultdict(int)
+            changed = set()
+            dead = 0
+            batch: List[Tuple] = []
+
+            async def flush():
+                nonlocal batch
+                rows, batch = batch, []
+                await record(rows)
+
+            async def worker():
+                nonlocal dead
+                # Un numero fisso di worker sullo stesso iteratore: i
+                # task non crescono con la playlist
+                for url, channels in pending:
+                    result = await self.probe(url)
+                    now = int(time.time())
+                    status = result['status']
+                    for channel_id, playlist_id, previous in channels:
+                        if status == 'ok':
+                            failures = 0
+                        elif status == 'unsupported':
+                            failures = previous
+                        else:
+                            failures = previous + 1
+                        if (previous >= HEALTH_DEAD_AFTER) != (failures >= HEALTH_DEAD_AFTER):
+                            changed.add(playlist_id)
+                        dead += failures >= HEALTH_DEAD_AFTER
+                        statuses[status] += 1
+                        batch.append((
+                            channel_id, status, result['http_status'], result['latency_ms'], now,
+                            now if status == 'ok' else None, failures, channel_id, url
+                        ))
+                    if len(batch) >= HEALTH_WRITE_BATCH:
+                        await flush()
+
+            workers = [
+                asyncio.create_task(worker())
+                for _ in range(min(self.concurrency, len(by_url)))
+            ]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+            if batch:
+                await flush()
+            return {
+                "channels": len(targets),
+                "urls": len(by_url),
+                "statuses": dict(statuses),
+                "dead": dead,
+                "changed_playlists": sorted(changed),
+            }
+        finally:
+            self._running.discard(key)
+
+# Canali di una playlist (o, per le custom, quelli che contiene) con alias c
+def _channels_source(playlist: Dict) -> str:
+    if playlist['is_custom']:
+        return """
+            FROM custom_playlist_channels cpc
+            JOIN channels c ON c.id = cpc.channel_id
+            LEFT JOIN channel_health h ON h.channel_id = c.id
+            WHERE cpc.playlist_id = ?
+        """
+    return """
+        FROM channels c
+        LEFT JOIN channel_health h ON h.channel_id = c.id
+        WHERE c.playlist_id = ?
+    """
+
+def health_targets(cursor, playlist: Dict) -> List[Tuple[int, int, str, int]]:
+    rows = cursor.execute(
+        "SELECT c.id, c.playlist_id, c.url, COALESCE(h.failures, 0) AS failures"
+        + _channels_source(playlist),
+        (playlist['id'],)
+    ).fetchall()
+    return [(row['id'], row['playlist_id'], row['url'], row['failures']) for row in rows]
+
+def record_health(cursor, rows: List[Tuple]):
+    # Solo canali che esistono ancora con lo stesso URL: un URL cambiato
+    # durante il controllo non eredita l'esito di quello vecchio
+    cursor.executemany("""
+        INSERT INTO channel_health
+            (channel_id, status, http_status, latency_ms, checked_at, last_ok, failures)
+        SELECT ?, ?, ?, ?, ?, ?, ?
+        WHERE EXISTS (SELECT 1 FROM channels WHERE id = ? AND url = ?)
+        ON CONFLICT (channel_id) DO UPDATE SET
+            status = excluded.status,
+            http_status = excluded.http_status,
+            latency_ms = excluded.latency_ms,
+            checked_at = excluded.checked_at,
+            last_ok = COALESCE(excluded.last_ok, channel_health.last_ok),
+            failures = excluded.failures
+    """, rows)
+
+def health_condition(alias: str, health: str) -> Tuple[str, List]:
+    # Filtri per stato: ok all'ultimo controllo, failing se l'ultimo è
+    # fallito, dead dopo HEALTH_DEAD_AFTER fallimenti di seguito
+    row = f"SELECT 1 FROM channel_health h WHERE h.channel_id = {alias}.id"
+    if health == 'ok':
+        return f"EXISTS ({row} AND h.status = 'ok')", []
+    if health == 'failing':
+        return f"EXISTS ({row} AND h.failures > 0)", []
+    if health == 'dead':
+        return f"EXISTS ({row} AND h.failures >= ?)", [HEALTH_DEAD_AFTER]
+    if health == 'not_dead':
+        return f"NOT EXISTS ({row} AND h.failures >= ?)", [HEALTH_DEAD_AFTER]
+    if health == 'unchecked':
+        return f"NOT EXISTS ({row})", []
+    raise ValueError(f"Unknown health filter: {health}")
+
+def health_summary(cursor, playlist: Dict) -> Dict:
+    return cursor.execute(
+        """SELECT COUNT(*) AS channels,
+                  COUNT(h.channel_id) AS checked,
+                  COALESCE(SUM(h.status = 'ok'), 0) AS ok,
+                  COALESCE(SUM(h.failures > 0), 0) AS failing,
+                  COALESCE(SUM(h.failures >= ?), 0) AS dead,
+                  MAX(h.checked_at) AS last_checked"""
+        + _channels_source(playlist),
+        (HEALTH_DEAD_AFTER, playlist['id'])
+    ).fetchone()
+
+def channel_health_list(cursor, playlist: Dict, health: Optional[str], limit: int) -> List[Dict]:
+    # Prima i canali con più fallimenti di seguito
+    sql = """SELECT c.id AS channel_id, c.name, c.url, h.status, h.http_status,
+                    h.latency_ms, h.checked_at, h.last_ok, COALESCE(h.failures, 0) AS failures"""
+    sql += _channels_source(playlist)
+    params: List = [playlist['id']]
+    if health is not None:
+        condition, condition_params = health_condition('c', health)
+        sql += f" AND {condition}"
+        params.extend(condition_params)
+    sql += " ORDER BY COALESCE(h.failures, 0) DESC, c.id LIMIT ?"
+    params.append(limit)
+    return cursor.execute(sql, params).fetchall()
@@ -0,0 +1,301 @@
+from typing import Awaitable, Callable, Dict, List, Optional
+from collections import defaultdict
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+import asyncio
+import random
+import time
+import os
+
+from database import get_db, run_db
+
+# Sincronizzazione periodica di tutte le playlist con URL.
+# Intervallo per playlist in secondi (playlists.sync_interval): NULL usa il
+# default, 0 disattiva la sync automatica. Lo scheduler vive nel processo,
+# con più worker uvicorn ognuno avrebbe il suo: va abilitato su uno solo.
+SYNC_SCHEDULER_ENABLED = os.getenv('SYNC_SCHEDULER_ENABLED', '1') == '1'
+SYNC_DEFAULT_INTERVAL = int(os.getenv('SYNC_DEFAULT_INTERVAL', str(6 * 3600)))
+SYNC_MAX_CONCURRENCY = int(os.getenv('SYNC_MAX_CONCURRENCY', '4'))
+SYNC_MAX_PER_HOST = int(os.getenv('SYNC_MAX_PER_HOST', '1'))
+SYNC_JITTER = 0.1
+SYNC_STARTUP_SPREAD = 300
+SYNC_BACKOFF_BASE = 60
+SYNC_BACKOFF_MAX = 6 * 3600
+SYNC_REFRESH_INTERVAL = 60
+
+SyncFunc = Callable[[int, int, bool], Awaitable[Dict]]
+
+class SyncAlreadyRunning(Exception):
+    pass
+
+def jittered(seconds: float, jitter: float = SYNC_JITTER) -> float:
+    return seconds * random.uniform(1 - jitter, 1 + jitter)
+
+def backoff_delay(failures: int, interval: int) -> float:
+    # Esponenziale sui fallimenti consecutivi, mai oltre l'intervallo normale
+    delay = min(SYNC_BACKOFF_BASE * 2 ** (failures - 1), SYNC_BACKOFF_MAX, interval)
+    return jittered(delay)
+
+def url_host(url: str) -> str:
+    return (urlsplit(url).hostname or '').lower()
+
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def _datetime(value: Optional[float]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+class SyncJob:
+    __slots__ = (
+        'playlist_id', 'user_id', 'host', 'interval', 'next_run', 'running',
+        'failures', 'last_started', 'last_finished', 'last_duration',
+        'last_error', 'last_result'
+    )
+
+    def __init__(self, playlist_id: int, user_id: int, host: str, interval: int):
+        self.playlist_id = playlist_id
+        self.user_id = user_id
+        self.host = host
+        self.interval = interval
+        self.next_run: Optional[float] = None
+        self.running = False
+        self.failures = 0
+        self.last_started: Optional[float] = None
+        self.last_finished: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_result: Optional[Dict] = None
+
+    def as_dict(self) -> Dict:
+        return {
+            "playlist_id": self.playlist_id,
+            "interval": self.interval,
+            "next_run": _datetime(self.next_run),
+            "running": self.running,
+            "failures": self.failures,
+            "last_started": _datetime(self.last_started),
+            "last_finished": _datetime(self.last_finished),
+            "last_duration": self.last_duration,
+            "last_error": self.last_error,
+            "last_result": self.last_result,
+        }
+
+class SyncScheduler:
+    def __init__(self, sync: SyncFunc,
+                 max_concurrency: int = SYNC_MAX_CONCURRENCY,
+                 max_per_host: int = SYNC_MAX_PER_HOST,
+                 default_interval: int = SYNC_DEFAULT_INTERVAL):
+        self._sync = sync
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.default_interval = default_interval
+        self._jobs: Dict[int, SyncJob] = {}
+        # Sync manuali in corso, anche per playlist senza job
+        self._manual = set()
+        self._active = 0
+        self._host_active: Dict[str, int] = defaultdict(int)
+        self._tasks = set()
+        self._run_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._dirty = True
+
+    # Ciclo di vita
+    def start(self):
+        if self._run_task is None:
+            self._wakeup = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+            self._run_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        if self._run_task is not None:
+            tasks.append(self._run_task)
+            self._run_task = None
+        self._loop = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def reload(self):
+        # Da chiamare quando le playlist cambiano: rilegge il DB al prossimo
+        # giro. Può arrivare anche dai thread del DB
+        self._dirty = True
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    # Stato
+    def state(self, user_id: int, playlist_id: Optional[int] = None) -> List[Dict]:
+        return [
+            job.as_dict() for job in self._jobs.values()
+            if job.user_id == user_id
+            and (playlist_id is None or job.playlist_id == playlist_id)
+        ]
+
+    def is_running(self, playlist_id: int, user_id: int) -> bool:
+        job = self._jobs.get(playlist_id)
+        if job is not None and job.user_id == user_id and job.running:
+            return True
+        return playlist_id in self._manual
+
+    # Sync manuale: salta i limiti di concorrenza ma aggiorna lo stato
+    # e impedisce allo scheduler di lanciare la stessa playlist in parallelo.
+    # Controllo e prenotazione avvengono senza await in mezzo: di due
+    # richieste concorrenti solo una parte, l'altra riceve SyncAlreadyRunning
+    async def run_now(self, playlist_id: int, user_id: int, force: bool = False) -> Dict:
+        job = self._jobs.get(playlist_id)
+        if job is not None and job.user_id != user_id:
+            job = None
+        if playlist_id in self._manual or (job is not None and job.running):
+            raise SyncAlreadyRunning(playlist_id)
+        self._manual.add(playlist_id)
+        try:
+            if job is None:
+                return await self._sync(playlist_id, user_id, force)
+            job.running = True
+            try:
+                return await self._execute(job, force)
+            finally:
+                job.running = False
+        finally:
+            self._manual.discard(playlist_id)
+
+    # Elenco delle playlist da sincronizzare: la query gira sui thread del
+    # DB, i job vengono aggiornati solo dall'event loop
+    async def refresh(self):
+        self._apply(await run_db(self._load_playlists))
+
+    @staticmethod
+    def _load_playlists() -> List[Dict]:
+        with get_db() as db:
+            return db.execute(
+                """SELECT id, user_id, url, sync_interval, last_sync
+                   FROM playlists
+                   WHERE url IS NOT NULL AND url != ''
+                     AND (sync_interval IS NULL OR sync_interval > 0)"""
+            ).fetchall()
+
+    def _apply(self, rows: List[Dict]):
+        now = time.time()
+        seen = set()
+        for row in rows:
+            playlist_id = row['id']
+            interval = row['sync_interval'] or self.default_interval
+            seen.add(playlist_id)
+            job = self._jobs.get(playlist_id)
+            if job is None:
+                job = SyncJob(playlist_id, row['user_id'], url_host(row['url']), interval)
+                last_sync = _timestamp(row['last_sync'])
+                if last_sync is not None and last_sync + interval > now:
+                    job.next_run = last_sync + jittered(interval)
+                else:
+                    # Mai sincronizzata o in ritardo: si spalma l'avvio
+                    job.next_run = now + random.uniform(0, min(interval, SYNC_STARTUP_SPREAD))
+                self._jobs[playlist_id] = job
+                continue
+
+            job.host = url_host(row['url'])
+            if job.interval != interval:
+                job.interval = interval
+                if not job.failures and job.next_run > now + interval:
+                    job.next_run = now + jittered(interval)
+
+        for playlist_id in list(self._jobs):
+            if playlist_id not in seen and not self._jobs[playlist_id].running:
+                del self._jobs[playlist_id]
+
+    async def _run(self):
+        last_refresh = 0.0
+        while True:
+            now = time.time()
+            if self._dirty or now - last_refresh >= SYNC_REFRESH_INTERVAL:
+                self._dirty = False
+                last_refresh = now
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    print(f"Sync scheduler: refresh failed: {e}")
+
+            self._wakeup.clear()
+            self._dispatch(now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_delay(now))
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, now: float):
+        due = sorted(
+            (job for job in self._jobs.values()
+             if not job.running and job.playlist_id not in self._manual
+             and job.next_run <= now),
+            key=lambda job: job.next_run
+        )
+        for job in due:
+            if self._active >= self.max_concurrency:
+                break
+            if self._host_active[job.host] >= self.max_per_host:
+                continue
+            self._active += 1
+            self._host_active[job.host] += 1
+            job.running = True
+            task = asyncio.create_task(self._run_job(job, job.host))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _next_delay(self, now: float) -> float:
+        # I job in attesa per i limiti ripartono quando un altro termina
+        upcoming = [
+            job.next_run for job in self._jobs.values()
+            if not job.running and job.next_run > now
+        ]
+        delay = min(upcoming, default=now + SYNC_REFRESH_INTERVAL) - now
+        return max(1.0, min(delay, SYNC_REFRESH_INTERVAL))
+
+    async def _run_job(self, job: SyncJob, host: str):
+        try:
+            await self._execute(job, False)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        finally:
+            job.running = False
+            self._active -= 1
+            self._host_active[host] -= 1
+            if not self._host_active[host]:
+                del self._host_active[host]
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def _execute(self, job: SyncJob, force: bool) -> Dict:
+        job.last_started = time.time()
+        start = time.perf_counter()
+        try:
+            result = await self._sync(job.playlist_id, job.user_id, force)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.last_duration = time.perf_counter() - start
+            job.last_finished = time.time()
+            job.failures += 1
+            job.last_error = str(getattr(e, 'detail', None) or e)
+            if getattr(e, 'status_code', None) == 404:
+                # Playlist eliminata nel frattempo
+                self._jobs.pop(job.playlist_id, None)
+            job.next_run = job.last_finished + backoff_delay(job.failures, job.interval)
+            raise
+
+        job.last_duration = time.perf_counter() - start
+        job.last_finished = time.time()
+        job.failures = 0
+        job.last_error = None
+        job.last_result = result
+        job.next_run = job.last_finished + jittered(job.interval)
+        return result
@@ -0,0 +1,11 @@
+import pytest
+
+from database import init_db
+
+@pytest.fixture
+def db_dir(tmp_path, monkeypatch):
+    # Database nuovo per ogni test: il pool scarta le connessioni quando
+    # cambia il percorso
+    monkeypatch.chdir(tmp_path)
+    init_db()
+    return tmp_path
@@ -0,0 +1,120 @@
+# Piani di esecuzione della lista dei canali aggiungibili a una playlist
+# custom: nessun ordinamento in memoria, nessuna scansione completa,
+# esclusione sulla chiave primaria di custom_playlist_channels
+import pytest
+
+from database import get_db
+from channel_query import (
+    available_channels_query, fetch_available_page, fts_match_query,
+    search_channels, search_channels_query
+)
+from benchmarks.available_channels_bench import FILTERS, PAGE_SIZE, populate
+
+CHANNELS = 20_000
+CUSTOM_EXCLUSION = 'sqlite_autoindex_custom_playlist_channels_1 (playlist_id=? AND channel_id=?)'
+
+@pytest.fixture(scope='module')
+def catalog(tmp_path_factory):
+    # Dati condivisi dai test del modulo, in sola lettura
+    monkeypatch = pytest.MonkeyPatch()
+    monkeypatch.chdir(tmp_path_factory.mktemp('catalog'))
+    custom_id = populate(CHANNELS)
+    with get_db() as db:
+        yield db.cursor(), custom_id
+    monkeypatch.undo()
+
+def query_filters(filters):
+    filters = dict(filters)
+    if 'search' in filters:
+        filters['match'] = fts_match_query(filters.pop('search'))
+    return filters
+
+def query_plan(cursor, sql, params):
+    return [row['detail'] for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+def keyset_pages(query, params):
+    # Prima pagina, pagina successiva e pagina dentro una sola sorgente
+    return (
+        (query + " ORDER BY p.name, p.id, c.position, c.id LIMIT ?", params + [PAGE_SIZE]),
+        (
+            query + " AND (p.name, p.id) > (?, ?) ORDER BY p.name, p.id, c.position, c.id LIMIT ?",
+            params + ['Sorgente 1', 1, PAGE_SIZE]
+        ),
+        (
+            query + " AND p.id = ? AND (c.position, c.id) > (?, ?) ORDER BY c.position, c.id LIMIT ?",
+            params + [1, 0, 0, PAGE_SIZE]
+        ),
+    )
+
+@pytest.mark.parametrize('label, filters', FILTERS, ids=[label for label, _ in FILTERS])
+def test_available_channels_plan(catalog, label, filters):
+    cursor, custom_id = catalog
+    query, params = available_channels_query(1, custom_id, **query_filters(filters))
+    for sql, sql_params in keyset_pages(query, params):
+        detail = query_plan(cursor, sql, sql_params)
+        text = '\n'.join(detail)
+        assert 'TEMP B-TREE' not in text, text
+        assert CUSTOM_EXCLUSION in text, text
+        assert not any(step in ('SCAN c', 'SCAN p') for step in detail), text
+        assert any(step.startswith('SEARCH c USING INDEX idx_channels_playlist_') for step in detail), text
+
+@pytest.mark.parametrize(
+    'label, filters',
+    [(label, filters) for label, filters in FILTERS if 'search' in filters],
+    ids=[label for label, filters in FILTERS if 'search' in filters]
+)
+def test_search_first_plan(catalog, label, filters):
+    # Poche corrispondenze: si parte da channels_fts e si ordinano solo quelle
+    cursor, custom_id = catalog
+    query, params = available_channels_query(1, custom_id, search_first=True, **query_filters(filters))
+    detail = query_plan(
+        cursor, query + " ORDER BY p.name, p.id, c.position, c.id LIMIT ?", params + [PAGE_SIZE]
+    )
+    text = '\n'.join(detail)
+    assert detail[0].startswith('SCAN channels_fts VIRTUAL TABLE'), text
+    assert 'SEARCH c USING INTEGER PRIMARY KEY (rowid=?)' in detail, text
+    assert CUSTOM_EXCLUSION in text, text
+
+@pytest.mark.parametrize('label, filters', FILTERS, ids=[label for label, _ in FILTERS])
+def test_pages_cover_full_query(catalog, label, filters):
+    # Scorrendo le pagine si ottengono tutte le righe della query completa,
+    # nello stesso ordine
+    cursor, custom_id = catalog
+    query, params = available_channels_query(1, custom_id, **query_filters(filters))
+    expected = [row['id'] for row in cursor.execute(
+        query + " ORDER BY p.name, p.id, c.position, c.id", params
+    )]
+    assert expected
+    seen = []
+    after = None
+    while True:
+        page = fetch_available_page(cursor, 1, custom_id, 97, after, **filters)
+        seen.extend(row['id'] for row in page['channels'])
+        after = page['next_cursor']
+        if after is None:
+            break
+    assert seen == expected
+
+# Ricerca ordinata per rilevanza su tutte le corrispondenze
+def test_search_ranks_every_match(db_dir):
+    with get_db() as db:
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO playlists (user_id, name) VALUES (1, 'Sport')")
+        playlist_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO channels (playlist_id, name, url, group_title, position) VALUES (?, ?, ?, ?, ?)",
+            [
+                (playlist_id, f'Sport Channel Extra Number {i}', f'http://stream/{i}', 'Varie', i)
+                for i in range(5_000)
+            ] + [(playlist_id, 'Sport', 'http://stream/sport', 'Sport', 5_000)]
+        )
+        rows = search_channels(cursor, 1, 'sport', 10)
+        assert rows[0]['name'] == 'Sport'
+        assert len(rows) == 10
+
+        # FTS5 restituisce le corrispondenze già in ordine di rank
+        for source in (None, playlist_id):
+            detail = query_plan(cursor, *search_channels_query(1, fts_match_query('sport'), 10, source))
+            assert not any('TEMP B-TREE' in step for step in detail), detail
+            assert any(step.startswith('SCAN channels_fts VIRTUAL TABLE') for step in detail), detail
+            assert not any(step in ('SCAN c', 'SCAN p') for step in detail), detail
@@ -0,0 +1,111 @@
+# Nessun accesso al DB sull'event loop: durante una sync e mentre si
+# serve una playlist pubblica tutte le query devono girare sui thread del
+# DB, e il loop deve restare reattivo
+import asyncio
+import threading
+import time
+
+import pytest
+from aiohttp import web
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+import database
+import main as server
+from database import get_db
+from benchmarks.parse_m3u_bench import synthetic_playlist
+
+SYNC_CHANNELS = 20_000
+PUBLIC_CHANNELS = 5_000
+# Margine ampio per macchine lente: con il DB sul loop la sync lo blocca
+# per secondi
+MAX_LOOP_LAG = 0.5
+
+@pytest.fixture
+def query_threads(db_dir, monkeypatch):
+    # Thread da cui parte ogni query sulle connessioni aperte dal pool
+    threads = set()
+    connect = database.connect
+
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(lambda _: threads.add(threading.current_thread().name))
+        return conn
+
+    monkeypatch.setattr(database, 'connect', traced_connect)
+    # Le connessioni già nel pool non sono tracciate
+    database.db_pool.close_all()
+    yield threads
+    database.db_pool.close_all()
+
+async def start_upstream(body):
+    async def handler(request):
+        return web.Response(body=body, content_type='audio/x-mpegurl')
+    app = web.Application()
+    app.router.add_get('/list.m3u', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}/list.m3u'
+
+async def fetch_public(token):
+    request = Request({
+        'type': 'http', 'method': 'GET', 'path': f'/public/playlist/{token}/m3u',
+        'headers': [], 'query_string': b''
+    })
+    response = await server.get_public_playlist(token, request)
+    size = 0
+    if isinstance(response, StreamingResponse):
+        async for chunk in response.body_iterator:
+            size += len(chunk)
+    return size
+
+async def max_lag(until):
+    # Ritardo massimo di un timer da 10 ms finché until non è finito
+    worst = 0.0
+    while not until.done():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        worst = max(worst, time.perf_counter() - start - 0.01)
+    return worst
+
+def test_sync_and_public_playlist_stay_off_the_loop(query_threads, monkeypatch):
+    # Nessuna cache: ogni richiesta pubblica legge davvero dal DB
+    monkeypatch.setattr(server.rendered_playlists, 'max_entry_bytes', 0)
+    with get_db() as db:
+        cursor = db.cursor()
+        cursor.execute(
+            "INSERT INTO playlists (user_id, name, public_token) VALUES (1, 'public', 'loop-test')"
+        )
+        cursor.executemany(
+            "INSERT INTO channels (playlist_id, name, url, position) VALUES (?, ?, ?, ?)",
+            [(cursor.lastrowid, f'Channel {i}', f'http://stream/{i}', i) for i in range(PUBLIC_CHANNELS)]
+        )
+    query_threads.clear()
+
+    async def scenario():
+        upstream, url = await start_upstream(synthetic_playlist(SYNC_CHANNELS).encode('utf-8'))
+        try:
+            with get_db() as db:
+                playlist_id = db.execute(
+                    "INSERT INTO playlists (user_id, name, url) VALUES (1, 'sync', ?)", (url,)
+                ).lastrowid
+            query_threads.clear()
+
+            sync = asyncio.ensure_future(server.run_playlist_sync(playlist_id, 1, True))
+            lag = asyncio.ensure_future(max_lag(sync))
+            sizes = []
+            while not sync.done():
+                sizes.append(await fetch_public('loop-test'))
+            return sync.result(), await lag, sizes
+        finally:
+            await upstream.cleanup()
+
+    result, lag, sizes = asyncio.run(scenario())
+
+    assert result['added'] == SYNC_CHANNELS
+    assert sizes and len(set(sizes)) == 1
+    assert query_threads and all(name.startswith('db') for name in query_threads), query_threads
+    assert lag < MAX_LOOP_LAG, f'event loop fermo per {lag:.3f} s'
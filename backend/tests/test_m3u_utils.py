@@ -0,0 +1,102 @@
+import pickle
+
+import pytest
+
+from m3u_utils import M3UChannel, M3UStreamParser, FrozenTags, iter_m3u, parse_m3u, share_tags
+from benchmarks.legacy_m3u import legacy_parse_m3u
+from benchmarks.parse_m3u_bench import PARITY_CORPUS, synthetic_playlist
+
+def as_dicts(channels):
+    return [channel.to_dict() for channel in channels]
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+# Parità con il parser originale
+@pytest.mark.parametrize('content', PARITY_CORPUS + [synthetic_playlist(500)])
+def test_parity_with_legacy_parser(content):
+    expected = as_dicts(legacy_parse_m3u(content))
+    data = content.encode('utf-8')
+    assert as_dicts(parse_m3u(content)) == expected
+    assert as_dicts(parse_m3u(data)) == expected
+    for size in (1, 7, 4096):
+        assert as_dicts(iter_m3u(chunked(data, size))) == expected
+
+# Righe divise tra i blocchi: lo streaming deve dare lo stesso risultato
+# di parse_m3u sul contenuto intero
+PLAYLIST = (
+    '#EXTM3U x-tvg-url="http://epg/guide.xml"\n'
+    '#EXTVLCOPT:http-user-agent=UA\n'
+    '#EXTINF:-1 tvg-id="a.it" group-title="News",Canale è A\n'
+    'http://stream/a\n'
+    '#EXTINF:-1 tvg-id="b.it",Canale 日本 B\n'
+    'http://stream/b\n'
+)
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r', '\x85', '\x0b'])
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 64])
+def test_stream_matches_parse_m3u(newline, size):
+    content = PLAYLIST.replace('\n', newline)
+    expected = as_dicts(parse_m3u(content))
+    assert [channel['url'] for channel in expected] == ['http://stream/a', 'http://stream/b']
+    assert as_dicts(iter_m3u(chunked(content.encode('utf-8'), size))) == expected
+    assert as_dicts(iter_m3u(chunked(content, size))) == expected
+
+def test_crlf_split_across_chunks():
+    parser = M3UStreamParser()
+    channels = parser.feed(b'#EXTINF:-1,A\r')
+    channels += parser.feed(b'\nhttp://stream/a\r')
+    channels += parser.feed(b'\n')
+    channels += parser.close()
+    assert [(channel.name, channel.url) for channel in channels] == [('A', 'http://stream/a')]
+
+def test_line_spanning_many_chunks():
+    url = 'http://stream/' + 'x' * 10_000
+    content = f'#EXTINF:-1,Lungo\n{url}\n'.encode('utf-8')
+    channels = list(iter_m3u(chunked(content, 3)))
+    assert [channel.url for channel in channels] == [url]
+
+def test_byte_order_mark_split_across_chunks():
+    content = '\ufeff#EXTM3U\n#EXTINF:-1 tvg-id="a",A\nhttp://stream/a'.encode('utf-8')
+    assert as_dicts(iter_m3u(chunked(content, 1))) == as_dicts(parse_m3u(content))
+    assert as_dicts(parse_m3u(content))[0]['tvg_id'] == 'a'
+
+def test_header_epg_url():
+    parser = M3UStreamParser()
+    channels = parser.feed(PLAYLIST.encode('utf-8')) + parser.close()
+    assert parser.epg_url == 'http://epg/guide.xml'
+    assert channels[0].extra_tags['epg_url'] == 'http://epg/guide.xml'
+
+# Tag condivisi e in sola lettura
+def test_frozen_tags_are_read_only():
+    channel = M3UChannel('A', 'http://stream/a', extra_tags={'EXTVLCOPT': 'x=y'})
+    tags = channel.extra_tags
+    assert isinstance(tags, FrozenTags)
+    for mutate in (
+        lambda: tags.__setitem__('k', 'v'),
+        lambda: tags.__delitem__('EXTVLCOPT'),
+        lambda: tags.update(k='v'),
+        lambda: tags.pop('EXTVLCOPT'),
+        lambda: tags.popitem(),
+        lambda: tags.setdefault('k', 'v'),
+        lambda: tags.clear(),
+    ):
+        with pytest.raises(TypeError):
+            mutate()
+    with pytest.raises(TypeError):
+        tags |= {'k': 'v'}
+    assert channel.extra_tags == {'EXTVLCOPT': 'x=y'}
+
+def test_frozen_tags_copy_and_pickle():
+    tags = share_tags({'EXTVLCOPT': 'x=y'})
+    copy = tags.copy()
+    copy['k'] = 'v'
+    assert type(copy) is dict and 'k' not in tags
+    restored = pickle.loads(pickle.dumps(tags))
+    assert type(restored) is FrozenTags and restored == tags
+
+def test_equal_tags_are_shared():
+    first = M3UChannel('A', 'http://stream/a', extra_tags={'EXTVLCOPT': 'x=y'})
+    second = M3UChannel('B', 'http://stream/b', extra_tags={'EXTVLCOPT': 'x=y'})
+    assert first.extra_tags is second.extra_tags
+    assert M3UChannel('C', 'http://stream/c').extra_tags == {}
@@ -0,0 +1,23 @@
+import pytest
+
+from playlist_cache import accepts_gzip
+
+@pytest.mark.parametrize('header, expected', [
+    (None, False),
+    ('', False),
+    ('identity', False),
+    ('deflate, br', False),
+    ('gzip', True),
+    ('x-gzip', True),
+    ('GZIP;Q=1', True),
+    ('gzip, deflate, br', True),
+    ('gzip;q=0.5', True),
+    ('gzip;q=0', False),
+    ('gzip; q=0.000', False),
+    ('gzip;q=invalid', False),
+    ('br, *', True),
+    ('*;q=0', False),
+    ('gzip;q=0, *', False),
+])
+def test_accepts_gzip(header, expected):
+    assert accepts_gzip(header) is expected
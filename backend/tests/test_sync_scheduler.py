@@ -0,0 +1,29 @@
+import asyncio
+
+from sync_scheduler import SyncAlreadyRunning, SyncScheduler
+
+def test_concurrent_manual_syncs_run_once():
+    calls = []
+
+    async def sync(playlist_id, user_id, force):
+        calls.append(playlist_id)
+        await asyncio.sleep(0.05)
+        return {'playlist_id': playlist_id}
+
+    async def scenario():
+        scheduler = SyncScheduler(sync)
+        results = await asyncio.gather(
+            *(scheduler.run_now(1, 1) for _ in range(3)),
+            scheduler.run_now(2, 1),
+            return_exceptions=True
+        )
+        assert not scheduler.is_running(1, 1)
+        # Finita la sync, la playlist si può sincronizzare di nuovo
+        await scheduler.run_now(1, 1)
+        return results
+
+    results = asyncio.run(scenario())
+    assert results[0] == {'playlist_id': 1}
+    assert all(isinstance(result, SyncAlreadyRunning) for result in results[1:3])
+    assert results[3] == {'playlist_id': 2}
+    assert calls == [1, 2, 1]
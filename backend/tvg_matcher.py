@@ -0,0 +1,256 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from collections import OrderedDict, defaultdict
+import unicodedata
+import threading
+import heapq
+import math
+import re
+
+# Abbinamento automatico dei tvg_id: nomi dei canali e nomi della guida
+# EPG vengono normalizzati (senza qualità, prefissi di paese,
+# punteggiatura) e confrontati per trigrammi. Un indice invertito
+# trigramma -> nomi della guida evita il confronto di ogni canale con
+# ogni nome: per ogni canale si leggono solo le liste dei trigrammi più
+# rari, che bastano a trovare tutti i candidati sopra la soglia
+# (prefix filtering), poi si calcola il coefficiente di Dice esatto
+TVG_MATCH_MIN_SCORE = 0.5
+TVG_MATCH_LIMIT = 3
+# Alternative proposte solo se vicine al migliore (punteggio almeno
+# questa frazione): "X Channel" e "Y Channel" condividono metà dei
+# trigrammi ma non sono alternative utili, e cercarle costa molto
+TVG_ALTERNATIVE_RATIO = 0.8
+# Numeri diversi ("Sport 1" / "Sport 2", "+1") pesano più dei trigrammi
+NUMBER_MISMATCH_PENALTY = 0.7
+# Indici tenuti in memoria (uno per guida)
+TVG_INDEX_CACHE = 2
+
+QUALITY_WORDS = frozenset({
+    'hd', 'fhd', 'uhd', 'sd', 'hq', 'lq', 'mhd', '4k', '8k', 'hdr', 'hevc', 'h264', 'h265',
+    'x264', 'x265', '2160p', '1080p', '1080i', '720p', '576p', '576i', '480p', '50fps',
+    '60fps', 'fps', 'backup', 'raw', 'vip', 'multi', 'live', 'orig', 'original',
+})
+COUNTRY_CODES = frozenset({
+    'it', 'uk', 'gb', 'us', 'usa', 'fr', 'de', 'ger', 'es', 'pt', 'nl', 'be', 'ch', 'at',
+    'pl', 'ro', 'gr', 'tr', 'ru', 'ar', 'br', 'ca', 'au', 'ie', 'se', 'no', 'dk', 'fi',
+    'al', 'hr', 'rs', 'ba', 'bg', 'cz', 'sk', 'hu', 'si', 'mx', 'in', 'pk', 'ex', 'lat',
+    'ita', 'eng', 'fra', 'spa', 'deu', 'arab', 'latino',
+})
+
+# "IT: ", "|IT| ", "[UK] ", "US - ", "FR | " all'inizio del nome
+_COUNTRY_PREFIX_RE = re.compile(r'^[\W_]*([a-z]{2,6})\s*[:|\]\)\-–]+\s*')
+_ID_SUFFIX_RE = re.compile(r'@[^.]*$|\.[a-z]{2,3}$')
+_ID_COUNTRY_RE = re.compile(r'\.([a-z]{2,3})(?:@[^.]*)?$')
+_SEPARATOR_RE = re.compile(r'[\W_]+')
+_NUMBER_RE = re.compile(r'\d+')
+
+def _fold(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+
+def name_country(name: Optional[str], is_id: bool = False) -> Optional[str]:
+    # Paese indicato nel nome ("IT: Rai 1", "Rai 1 IT") o nell'id ("Rai1.it"),
+    # usato solo per ordinare candidati con lo stesso punteggio
+    if not name:
+        return None
+    text = _fold(name)
+    if is_id:
+        match = _ID_COUNTRY_RE.search(text)
+        return match.group(1) if match else None
+    match = _COUNTRY_PREFIX_RE.match(text)
+    if match and match.group(1) in COUNTRY_CODES:
+        return match.group(1)
+    words = _SEPARATOR_RE.sub(' ', text).split()
+    if len(words) > 1 and words[-1] in COUNTRY_CODES:
+        return words[-1]
+    return None
+
+def normalize_name(name: Optional[str], is_id: bool = False) -> str:
+    if not name:
+        return ''
+    text = _fold(name)
+    if is_id:
+        # Id della guida: "Rai1.it", "BBCOne.uk@HD"
+        text = _ID_SUFFIX_RE.sub('', _ID_SUFFIX_RE.sub('', text))
+    match = _COUNTRY_PREFIX_RE.match(text)
+    if match and match.group(1) in COUNTRY_CODES and match.end() < len(text):
+        text = text[match.end():]
+    text = text.replace('+', ' plus ').replace('&', ' and ')
+    words = [word for word in _SEPARATOR_RE.sub(' ', text).split() if word not in QUALITY_WORDS]
+    if len(words) > 1 and words[-1] in COUNTRY_CODES:
+        words.pop()
+    return ' '.join(words)
+
+def trigrams(normalized: str) -> frozenset:
+    # Senza spazi: "rai uno" e "raiuno" hanno gli stessi trigrammi
+    text = '^' + normalized.replace(' ', '') + '$'
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+class TvgIndex:
+    def __init__(self, channels: Iterable[Tuple[str, Optional[str]]]):
+        # Ogni canale della guida entra con il nome e con l'id normalizzati
+        self.channel_ids: List[str] = []
+        self.display_names: List[Optional[str]] = []
+        self._countries: List[Optional[str]] = []
+        self._owner: List[int] = []
+        self._grams: List[frozenset] = []
+        self._numbers: List[Tuple[str, ...]] = []
+        self._exact: Dict[str, List[int]] = defaultdict(list)
+        # Liste di trigrammi separate per dimensione del nome
+        buckets: Dict[int, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(list))
+        for channel_id, display_name in channels:
+            owner = len(self.channel_ids)
+            self.channel_ids.append(channel_id)
+            self.display_names.append(display_name)
+            self._countries.append(name_country(channel_id, is_id=True))
+            aliases = {normalize_name(display_name), normalize_name(channel_id, is_id=True)}
+            for alias in aliases:
+                compact = alias.replace(' ', '')
+                if not compact:
+                    continue
+                number = len(self._owner)
+                self._owner.append(owner)
+                grams = trigrams(alias)
+                self._grams.append(grams)
+                self._numbers.append(tuple(_NUMBER_RE.findall(alias)))
+                self._exact[compact].append(number)
+                bucket = buckets[len(grams)]
+                for gram in grams:
+                    bucket[gram].append(number)
+        self._buckets = {size: dict(bucket) for size, bucket in buckets.items()}
+        self._cache: Dict[Tuple[str, float, int], List[Tuple[int, float]]] = {}
+        self.known_ids = frozenset(self.channel_ids)
+
+    def __len__(self):
+        return len(self.channel_ids)
+
+    def _search(self, normalized: str, min_score: float, limit: int) -> List[Tuple[int, float]]:
+        # I migliori `limit` canali della guida, in ordine decrescente
+        compact = normalized.replace(' ', '')
+        if not compact:
+            return []
+        numbers = tuple(_NUMBER_RE.findall(normalized))
+        best: Dict[int, float] = {}
+        for alias in self._exact.get(compact, ()):
+            best[self._owner[alias]] = 1.0
+
+        grams = trigrams(normalized)
+        size = len(grams)
+        all_grams = self._grams
+        threshold = min_score
+        if best:
+            threshold = 1.0 if len(best) >= limit else max(min_score, TVG_ALTERNATIVE_RATIO)
+        # Dimensioni (numero di trigrammi) a partire da quelle più vicine:
+        # con s trigrammi servono almeno ceil(t * (size + s) / 2) trigrammi
+        # in comune per arrivare a Dice t, quindi basta leggere le
+        # size - overlap + 1 liste più rare (prefix filtering). Trovati
+        # `limit` candidati, la soglia sale al punteggio dell'ultimo
+        for other_size in sorted(self._buckets, key=lambda other: abs(other - size)):
+            if 2 * min(size, other_size) < threshold * (size + other_size):
+                continue
+            bucket = self._buckets[other_size]
+            overlap = max(1, math.ceil(threshold * (size + other_size) / 2))
+            postings = sorted((bucket.get(gram, ()) for gram in grams), key=len)
+            candidates = set()
+            for posting in postings[:size - overlap + 1]:
+                candidates.update(posting)
+            for alias in candidates:
+                score = 2 * len(grams & all_grams[alias]) / (size + other_size)
+                if self._numbers[alias] != numbers:
+                    score *= NUMBER_MISMATCH_PENALTY
+                if score >= threshold:
+                    owner = self._owner[alias]
+                    if score > best.get(owner, 0):
+                        best[owner] = score
+            if best:
+                top = heapq.nlargest(limit, best.values())
+                threshold = max(threshold, top[0] * TVG_ALTERNATIVE_RATIO)
+                if len(top) >= limit:
+                    threshold = max(threshold, top[-1])
+        # I pari merito dell'ultimo restano: match() li ordina per paese
+        return sorted(
+            ((owner, score) for owner, score in best.items() if score >= threshold),
+            key=lambda item: -item[1]
+        )
+
+    def match(self, name: Optional[str], tvg_id: Optional[str] = None,
+              limit: int = TVG_MATCH_LIMIT, min_score: float = TVG_MATCH_MIN_SCORE) -> List[Dict]:
+        best: Dict[int, float] = {}
+        queries = {normalize_name(name)}
+        if tvg_id:
+            queries.add(normalize_name(tvg_id, is_id=True))
+        for query in queries:
+            # Molti canali hanno lo stesso nome normalizzato ("X HD", "X FHD")
+            key = (query, min_score, limit)
+            results = self._cache.get(key)
+            if results is None:
+                results = self._cache[key] = self._search(query, min_score, limit)
+            for owner, score in results:
+                if score > best.get(owner, 0):
+                    best[owner] = score
+        # A parità di punteggio prima i canali del paese indicato nel nome
+        country = name_country(name)
+        ranked = sorted(best.items(), key=lambda item: (
+            -round(item[1], 3), self._countries[item[0]] != country, self.channel_ids[item[0]]
+        ))[:limit]
+        return [
+            {
+                "tvg_id": self.channel_ids[owner],
+                "display_name": self.display_names[owner],
+                "score": round(score, 3),
+            }
+            for owner, score in ranked
+            if score >= ranked[0][1] * TVG_ALTERNATIVE_RATIO
+        ]
+
+_indexes: "OrderedDict[Tuple[int, str], TvgIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+def load_index(cursor, source: Dict) -> TvgIndex:
+    # Un indice per guida, ricostruito solo dopo una nuova sync
+    key = (source['id'], str(source['last_sync']))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    reader = cursor.connection.cursor()
+    reader.row_factory = None
+    reader.execute(
+        "SELECT channel_id, display_name FROM epg_channels WHERE source_id = ?",
+        (source['id'],)
+    )
+    index = TvgIndex(reader)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > TVG_INDEX_CACHE:
+            _indexes.popitem(last=False)
+    return index
+
+def propose_mappings(cursor, index: TvgIndex, playlist_id: int, limit: int = TVG_MATCH_LIMIT,
+                     min_score: float = TVG_MATCH_MIN_SCORE, include_mapped: bool = False,
+                     group_title: Optional[str] = None) -> List[Dict]:
+    # Canali senza tvg_id o con un tvg_id assente dalla guida
+    sql = "SELECT id, name, tvg_id FROM channels WHERE playlist_id = ?"
+    params: List = [playlist_id]
+    if group_title is not None:
+        sql += " AND group_title = ?"
+        params.append(group_title)
+    proposals = []
+    for row in cursor.execute(sql + " ORDER BY position, id", params).fetchall():
+        if not include_mapped and row['tvg_id'] in index.known_ids:
+            continue
+        proposals.append({
+            "channel_id": row['id'],
+            "name": row['name'],
+            "tvg_id": row['tvg_id'],
+            "candidates": index.match(row['name'], row['tvg_id'], limit, min_score),
+        })
+    return proposals
+
+def apply_mappings(cursor, playlist_id: int, mappings: Iterable[Tuple[int, str]]) -> int:
+    # Nella transazione del chiamante; solo i canali della playlist
+    cursor.executemany(
+        "UPDATE channels SET tvg_id = ? WHERE id = ? AND playlist_id = ? AND tvg_id IS NOT ?",
+        ((tvg_id, channel_id, playlist_id, tvg_id) for channel_id, tvg_id in mappings)
+    )
+    return max(cursor.rowcount, 0)
@@ -17,8 +17,8 @@ export function ChannelList({
   const [search, setSearch] = useState('');
   const [groupFilter, setGroupFilter] = useState('');
   
-  const { updateChannelOrder } = useStore(state => ({
-    updateChannelOrder: state.playlists.updateChannelOrder
+  const { moveChannels } = useStore(state => ({
+    moveChannels: state.playlists.moveChannels
   }));
 
   const groups = [...new Set(channels.map(ch => ch.group_title).filter(Boolean))];
@@ -40,17 +40,15 @@ export function ChannelList({
       return;
     }
 
-    const newIndex = direction === 'up' ? currentIndex - 1 : currentIndex + 1;
-    const updatedChannels = [...filteredChannels];
-    [updatedChannels[currentIndex], updatedChannels[newIndex]] = 
-    [updatedChannels[newIndex], updatedChannels[currentIndex]];
+    // Si sposta solo il canale, prima o dopo quello adiacente
+    const neighbour = direction === 'up' ?
+      filteredChannels[currentIndex - 1] :
+      filteredChannels[currentIndex + 1];
 
-    const channelOrders = updatedChannels.map((channel, index) => ({
-      id: channel.id,
-      position: index + 1
-    }));
-
-    await updateChannelOrder(playlistId, channelOrders);
+    await moveChannels(playlistId, {
+      channel_ids: [channelId],
+      ...(direction === 'up' ? { before_id: neighbour.id } : { after_id: neighbour.id })
+    });
   };
 
   if (channels.length === 0) {
@@ -91,7 +91,7 @@ export function PlaylistList({ playlists = [] }) {
              <div className="grid grid-cols-2 gap-4 text-sm">
                <div>
                  <p className="text-gray-500">Channels</p>
-                 <p className="font-medium">{playlist.channels.length}</p>
+                 <p className="font-medium">{playlist.channels_count ?? playlist.channels.length}</p>
                </div>
                <div>
                  <p className="text-gray-500">Last Sync</p>
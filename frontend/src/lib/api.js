@@ -125,9 +125,18 @@ export const playlists = {
     return data;
   },
   
-  getAvailableChannels: async (playlistId) => {
+  moveChannels: async (playlistId, move) => {
+    const { data } = await api.post(
+      `/playlists/${playlistId}/channels/move`,
+      move
+    );
+    return data;
+  },
+  
+  getAvailableChannels: async (playlistId, params = {}) => {
     const { data } = await api.get(
-      `/playlists/${playlistId}/channels-available`
+      `/playlists/${playlistId}/channels-available`,
+      { params }
     );
     return data;
   },
@@ -284,6 +284,22 @@ export const createPlaylistsSlice = (set, get) => ({
      }
    },
 
+   moveChannels: async (playlistId, move) => {
+     try {
+       await playlistsApi.moveChannels(playlistId, move);
+       await get().playlists.loadPlaylist(playlistId);
+       return true;
+     } catch (error) {
+       set(state => ({
+         playlists: {
+           ...state.playlists,
+           error: error.response?.data?.detail || 'Failed to move channels'
+         }
+       }));
+       return false;
+     }
+   },
+
    clearError: () => {
      set(state => ({
        playlists: { ...state.playlists, error: null }